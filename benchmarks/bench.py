@@ -0,0 +1,278 @@
+"""Micro-benchmarks for PyRoomba's hot paths.
+
+Runs each benchmark against an in-memory serial port (no robot required),
+prints a table of results and optionally writes them as JSON so runs can be
+compared over time:
+
+    python benchmarks/bench.py -o results.json
+    python benchmarks/bench.py -f poll
+
+Alongside speed, each benchmark reports the objects each operation leaves
+behind, measured with the garbage collector's allocation counter
+(gc.get_count()) with collection disabled. The counter covers gc-tracked
+objects (dictionaries, lists, tuples, instances and the like, but not ints
+or strings) and goes back down when they're freed, so this is not a count
+of allocations: temporaries freed within an operation cancel out, and what
+remains is what each operation retains, its result included (results are
+kept alive until the count is taken). Python 2 has no cheap way to count
+allocations outright. The JSON output also includes the growth in live
+objects per operation after a collection, which catches leaks.
+"""
+
+import gc
+import json
+import os
+import platform
+import sys
+from getopt import getopt
+from struct import pack
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pyroomba
+from pyroomba import sensors
+from pyroomba.clock import monotonic
+
+class MemorySerial(object):
+    """A pyserial compliant port which endlessly repeats a canned byte string"""
+    def __init__(self, data = ''):
+        self.data = data
+        self._position = 0
+
+    @property
+    def in_waiting(self):
+        return len(self.data)
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def read(self, size = 1):
+        data = self.data
+        if not data:
+            return ''
+        chunks = []
+        while size > 0:
+            chunk = data[self._position:self._position + size]
+            chunks.append(chunk)
+            size -= len(chunk)
+            self._position = (self._position + len(chunk)) % len(data)
+        return ''.join(chunks)
+
+    def write(self, data):
+        return len(data)
+
+    def flushInput(self):
+        pass
+
+    def setBaudrate(self, baud_rate):
+        pass
+
+    def close(self):
+        pass
+
+def frame(packets, zeroed = ()):
+    """Builds a valid stream frame for a list of sensors, with made up values (0 for the named sensors)"""
+    body = ''.join([ pack('>B' + format, packet, name not in zeroed and 1 or 0) for packet, format, name in packets ])
+    data = bytearray(pack('BB', 19, len(body)) + body)
+    data.append((-sum(data)) & 0xff)
+    return bytes(data)
+
+def corrupt(data):
+    """Flips the checksum of a frame"""
+    return data[:-1] + chr((ord(data[-1]) + 1) & 0xff)
+
+def streaming_robot(packets, data):
+    robot = pyroomba.Roomba(None, serial_port = MemorySerial(data))
+    robot.stream_samples(*packets)
+    return robot
+
+# Benchmark definitions. Each is a function returning the operation to time.
+BENCHMARKS = []
+
+def benchmark(name):
+    def register(function):
+        BENCHMARKS.append((name, function))
+        return function
+    return register
+
+def command(name, call):
+    @benchmark('send.' + name)
+    def setup():
+        robot = pyroomba.Roomba(None, serial_port = MemorySerial())
+        return lambda: call(robot)
+
+command('cmd', lambda r: r.cmd(135))
+command('drive', lambda r: r.drive(200, 500))
+command('drive_direct', lambda r: r.drive_direct(200, -200))
+command('drive_pwm', lambda r: r.drive_pwm(100, 100))
+command('motors', lambda r: r.motors(main = True, vacuum = True))
+command('motors_pwm', lambda r: r.motors_pwm(100, -50, 20))
+command('leds', lambda r: r.leds(128, 255, dock = True))
+command('display_ascii', lambda r: r.display_ascii('ABCD'))
+command('buttons', lambda r: r.buttons(clean = True))
+command('define_song', lambda r: r.define_song(0, [60, 62, 64, 65], [16, 16, 16, 16]))
+command('play_song', lambda r: r.play_song(0))
+command('set_clock', lambda r: r.set_clock(1, 12, 30))
+
+def poll_benchmark(name, packets, data):
+    @benchmark(name)
+    def setup():
+        return streaming_robot(packets, data).poll
+
+poll_benchmark('poll.1_sensor', [sensors.DISTANCE], frame([sensors.DISTANCE]))
+poll_benchmark('poll.10_sensors', sensors.SENSORS[:10], frame(sensors.SENSORS[:10]))
+poll_benchmark('poll.all_sensors', sensors.SENSORS, frame(sensors.SENSORS))
+
+@benchmark('poll.lazy_all_sensors')
+def setup():
+    packets = sensors.SENSORS
+    robot = streaming_robot(packets, frame(packets))
+    robot.lazy_samples = True
+    return lambda: robot.poll().voltage
+
+poll_benchmark('poll.unplanned', [sensors.DISTANCE], frame([sensors.ANGLE, sensors.WALL]))
+poll_benchmark('poll.resync', [sensors.DISTANCE], '\x00\x01\x02' * 10 + frame([sensors.DISTANCE]))
+
+@benchmark('poll.bad_checksum')
+def setup():
+    good = frame([sensors.DISTANCE])
+    robot = streaming_robot([sensors.DISTANCE], corrupt(good) + good)
+    def operation():
+        try:
+            robot.poll()
+        except pyroomba.ChecksumError:
+            pass
+    return operation
+
+@benchmark('read_sensor_list.all_sci')
+def setup():
+    packets = sensors.ALL_SCI[1]
+    robot = pyroomba.Roomba(None, serial_port = MemorySerial(''.join([ pack('>' + format, 1) for packet, format, name in packets ])))
+    return lambda: robot._read_sensor_list(packets)
+
+@benchmark('process_events.all_handlers')
+def setup():
+    packets = sensors.SENSORS
+    robot = streaming_robot(packets, frame(packets))
+    loop = pyroomba.EventLoop(robot)
+    def handler(robot, name, value):
+        pass
+    for packet, format, name in packets:
+        loop.on(name, handler)
+    return loop.process_events
+
+def change_benchmark(name, zeroed):
+    # Every frame is the same unless some sensors are zeroed every other frame
+    @benchmark(name)
+    def setup():
+        packets = sensors.SENSORS
+        data = frame(packets)
+        if zeroed:
+            data += frame(packets, zeroed)
+        robot = streaming_robot(packets, data)
+        loop = pyroomba.EventLoop(robot)
+        def handler(robot, name, value):
+            pass
+        for packet, format, name in packets:
+            loop.on_change(name, handler)
+        return loop.process_events
+
+change_benchmark('process_events.change_handlers', ())
+change_benchmark('process_events.one_change', ('voltage',))
+change_benchmark('process_events.all_change', [ name for packet, format, name in sensors.SENSORS ])
+
+@benchmark('dynamics.update')
+def setup():
+    dynamics = pyroomba.RoombaDynamics()
+    trace = [ ((i * 7) & 0xffff, (i * 9) & 0xffff) for i in range(10000) ]
+    dynamics.initialize_priors(trace[0])
+    state = [0]
+    def operation():
+        i = state[0] = (state[0] + 1) % len(trace)
+        dynamics.update(dynamics.normalize(trace[i]), 0.015)
+    return operation
+
+@benchmark('dynamics.pose_integrator')
+def setup():
+    pose = pyroomba.PoseIntegrator()
+    trace = [ ((i * 7) & 0xffff, (i * 9) & 0xffff) for i in range(10000) ]
+    state = [0]
+    def operation():
+        i = state[0] = (state[0] + 1) % len(trace)
+        left, right = trace[i]
+        pose.update(left, right)
+    return operation
+
+# Measurement
+def measure(operation, duration):
+    """Returns (operations per second, objects retained per operation, live object growth per operation)"""
+    operation() # Warm up caches
+    count = 1
+    while True:
+        start = monotonic()
+        for i in xrange(count):
+            operation()
+        elapsed = monotonic() - start
+        if elapsed >= duration:
+            break
+        count *= 2
+    rate = count / elapsed
+
+    gc.collect()
+    objects = len(gc.get_objects())
+    results = []
+    gc.disable()
+    try:
+        # The counter goes up with every gc-tracked allocation and down with
+        # every deallocation, so hold on to whatever each operation returns
+        # (as a caller would, at least for a while)
+        before = gc.get_count()[0]
+        for i in xrange(1000):
+            results.append(operation())
+        retained = (gc.get_count()[0] - before) / 1000.0
+    finally:
+        gc.enable()
+    del results
+    gc.collect()
+    growth = (len(gc.get_objects()) - objects) / 1000.0
+    return rate, retained, growth
+
+def main(argv):
+    opts, args = getopt(argv, 'o:f:d:', ['output=', 'filter=', 'duration='])
+    output = None
+    pattern = ''
+    duration = 0.2
+    for o, a in opts:
+        if o in ('-o', '--output'):
+            output = a
+        elif o in ('-f', '--filter'):
+            pattern = a
+        elif o in ('-d', '--duration'):
+            duration = float(a)
+
+    results = []
+    for name, setup in BENCHMARKS:
+        if pattern not in name:
+            continue
+        rate, retained, growth = measure(setup(), duration)
+        results.append({
+            'name': name,
+            'ops_per_sec': rate,
+            'retained_objects_per_op': retained,
+            'live_objects_per_op': growth,
+        })
+        sys.stdout.write('%-32s %14.0f ops/s %10.1f retained objects/op\n' % (name, rate, retained))
+
+    if output:
+        report = {
+            'time': time(),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'results': results,
+        }
+        with open(output, 'w') as f:
+            json.dump(report, f, indent = 2, sort_keys = True)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -13,4 +13,20 @@ robot's built-in odometry.
 from roomba import *
 from roomba_dynamics import *
 from events import *
+from frames import *
+from async_roomba import *
+from telemetry import *
+from capture import *
+from emulator import *
+from workers import *
+from commands import *
+from fleet import *
+from server import *
+from wire import *
+from sinks import *
+from metrics import *
+from tracing import *
+from handshake import *
+from pipeline import *
+from scheduler import *
 import sensors
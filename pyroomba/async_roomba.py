@@ -0,0 +1,334 @@
+import asyncore
+import os
+from collections import deque
+from threading import current_thread
+from time import sleep
+
+try:
+    from serial import Serial
+except ImportError:
+    pass # roomba already complained
+
+from roomba import RoombaBase
+from events import EventLoop
+from frames import ChecksumError
+from frames import MalformedFrameError
+from clock import monotonic
+from handshake import Handshake
+
+__all__ = ['AsyncRoomba', 'AsyncEventLoop']
+
+class _Channel(asyncore.dispatcher):
+    """Shovels bytes between an AsyncRoomba and its socket or file descriptor"""
+    def __init__(self, robot, sock = None, fd = None, map = None):
+        asyncore.dispatcher.__init__(self, sock, map)
+        self._robot = robot
+        if fd is not None:
+            # The same dance asyncore.file_dispatcher does, minus the
+            # inheritance
+            import fcntl
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL, 0)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            self.set_socket(asyncore.file_wrapper(fd), map)
+            self.connected = True
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        robot = self._robot
+        robot._loop_thread = current_thread() # See _QueueHandshake
+        return robot._writable()
+
+    def handle_read(self):
+        data = self.recv(4096)
+        if data:
+            self._robot._received(data)
+
+    def handle_write(self):
+        self._robot._write_some(self)
+
+    def handle_close(self):
+        self.close()
+
+class _QueueHandshake(Handshake):
+    """Ready once everything an AsyncRoomba queued before it has been written and waited out.
+
+    An AsyncRoomba can't wait for the robot to answer without blocking its
+    loop, so mode changes hold back later commands for a settling time
+    instead; this lets callers find out when that time is up. Nothing is
+    heard from the robot, so the handshake is never confirmed.
+
+    Only the asyncore loop can make the handshake ready, so wait() must be
+    called from some other thread; called from the thread running the
+    loop it raises RuntimeError rather than waiting out the timeout."""
+
+    confirmed = False
+
+    def __init__(self, robot, timeout = 1.0):
+        super(_QueueHandshake, self).__init__(robot, timeout)
+        self.reached = False
+
+    def _reach(self):
+        self.reached = True
+
+    def check(self, blocking):
+        if not self.reached and blocking:
+            if self.robot._loop_thread is current_thread():
+                raise RuntimeError('Waiting on an AsyncRoomba from the thread running its asyncore loop, which would never finish')
+            sleep(0.001) # Another thread is running the loop
+        return self.reached
+
+class AsyncRoomba(RoombaBase):
+    """A Roomba driven by an asyncore event loop rather than blocking reads.
+
+    AsyncRoomba offers the same command methods as Roomba, but none of them
+    block: commands are queued and written whenever the robot's channel is
+    writable, and sensor data is delivered to callbacks as it arrives. This
+    allows a single thread running asyncore.loop() to drive any number of
+    robots (and any other asyncore channels, such as network clients).
+
+    The robot can be reached over a serial port, which is put into
+    non-blocking mode, or over an already connected socket (e.g., a
+    serial-to-WiFi bridge):
+
+        robot = AsyncRoomba('/dev/tty.roomba')
+        robot.start()
+        robot.safe()
+        robot.stream(handle_sample, sensors.DISTANCE, sensors.ANGLE)
+        asyncore.loop(timeout = 0.015)
+
+    Mode changes which require the robot to settle (start(), safe(), etc.)
+    hold back subsequent commands rather than sleeping, so the loop should
+    be run with a short timeout for those delays to be honored promptly.
+    They take block and timeout as Roomba's do, but never block; the
+    handshake they return is ready once the robot has had time to settle.
+    As with Roomba, query_list() and sensors() should not be used while a
+    sample stream is running.
+
+    Commands go through the same buffering (buffer_commands()) and tracing
+    (add_tracer()) as Roomba's; an AsyncEventLoop flushes buffered commands
+    after each sample."""
+
+    def __init__(self, port = None, baud = 115200, serial_port = None, sock = None, map = None):
+        """Instantiate a new AsyncRoomba on a serial port or socket.
+
+        Arguments are as for Roomba, plus:
+         sock: A connected socket to use instead of a serial port.
+         map: The asyncore channel map to register with (defaults to the
+            global asyncore map)."""
+        if sock is None and serial_port is None:
+            serial_port = Serial(port, baudrate = baud, timeout = 0)
+        super(AsyncRoomba, self).__init__(port, baud, 0, serial_port = serial_port or sock)
+        self._outgoing = deque() # Pending writes; floats are pauses, callables actions
+        self._hold_until = 0
+        self._queries = deque() # (size, decode, callback) for outstanding queries
+        self._response = ''
+        self._listeners = []
+        self._loop_thread = None # The thread last seen running the asyncore loop
+        if sock is not None:
+            self._channel = _Channel(self, sock = sock, map = map)
+        else:
+            self._channel = _Channel(self, fd = serial_port.fileno(), map = map)
+
+    # Output
+    def _write(self, data):
+        """Queue commands for the robot"""
+        self._outgoing.append(data)
+
+    def _hold(self, seconds):
+        """Holds back any commands queued after this point for some number of seconds"""
+        self._outgoing.append(float(seconds))
+
+    def _writable(self):
+        outgoing = self._outgoing
+        while outgoing and not isinstance(outgoing[0], str):
+            head = outgoing[0]
+            if isinstance(head, float):
+                if not self._hold_until:
+                    self._hold_until = monotonic() + head
+                if monotonic() < self._hold_until:
+                    return False
+                self._hold_until = 0
+            else:
+                head() # Something to do once the preceding commands are out
+            outgoing.popleft()
+        return bool(outgoing)
+
+    def _write_some(self, channel):
+        outgoing = self._outgoing
+        chunks = []
+        while outgoing and isinstance(outgoing[0], str):
+            chunks.append(outgoing.popleft())
+        data = ''.join(chunks)
+        sent = channel.send(data)
+        if sent < len(data):
+            outgoing.appendleft(data[sent:])
+
+    def _handshake(self, modes, block, timeout):
+        """Holds back later commands while the robot changes modes, returning a handshake ready once they may go"""
+        self._hold(0.1)
+        return self._queued(timeout)
+
+    def _queued(self, timeout):
+        """Returns a handshake ready once everything queued so far is done with"""
+        handshake = _QueueHandshake(self, timeout = timeout)
+        self._outgoing.append(handshake._reach)
+        return handshake
+
+    def baud(self, baud_rate, block = True, timeout = 1.0):
+        """Changes the baudrate at which the Roomba communicates.
+
+        The port changes rate once the command is out and the robot has had
+        a tenth of a second to follow; block is ignored."""
+        if not baud_rate in self.BAUD_RATES:
+            raise ValueError('Invalid baud rate specified')
+        self.send('BB', 129, self.BAUD_RATES[baud_rate])
+        self._hold(0.1)
+        self._outgoing.append(lambda: self.port.setBaudrate(baud_rate))
+        return self._queued(timeout)
+
+    def start(self, block = True, timeout = 1.0):
+        """Start controlling the robot; later commands are held back for a tenth of a second to allow the Roomba to change modes.
+
+        block is ignored."""
+        self.cmd(128)
+        self._hold(0.1)
+        self.cmd(130)
+        return self._handshake(self.MODES[1:], block, timeout)
+
+    # Input
+    def _received(self, data):
+        """Handles bytes arriving from the robot"""
+        if self._queries:
+            response = self._response + data
+            queries = self._queries
+            while queries and len(response) >= queries[0][0]:
+                size, decode, callback = queries.popleft()
+                reply, response = response[:size], response[size:]
+                callback(self, decode(reply))
+            if queries:
+                self._response = response
+                return
+            self._response = ''
+            data = response
+            if not data:
+                return
+        parser = self._parser
+        parser.feed(data)
+        sinks = self._sinks
+        if sinks:
+            self._read_at = monotonic()
+        while True:
+            try:
+                frame = parser.next_raw_frame()
+            except ChecksumError:
+                continue # The parser has already resynchronized; carry on
+            if frame is None:
+                break
+            for sink in sinks:
+                sink.write_frame(frame, self._read_at)
+            if self._listeners:
+                try:
+                    if self._tracers:
+                        readings = self._traced_decode(frame[2:-1])
+                    else:
+                        readings = self._decode_frame(frame[2:-1])
+                except MalformedFrameError:
+                    continue
+                for listener in self._listeners:
+                    listener(self, readings)
+                if self._tracers:
+                    self._end_frame()
+        self._flush_sinks() # The next feed() may move the frames
+
+    def _expect(self, size, decode, callback):
+        self._queries.append((size, decode, callback))
+
+    def sensors(self, sensor, callback):
+        """Request a single sensor packet, calling callback(robot, value) with the response"""
+        sensor_id, format, name = sensor
+        self.send('BB', 142, sensor_id)
+        if isinstance(format, list):
+            self._expect(sensor.size, lambda response: self._unpack_sensor_list(format, response), callback)
+        else:
+            self._expect(sensor.size, lambda response: response, callback)
+
+    def query_list(self, *sensors, **options):
+        """Requests a sample of a collection of the Roomba's sensors.
+
+        The readings are passed to the function given as the callback keyword
+        argument, as callback(robot, readings)."""
+        callback = options['callback']
+        packet_list = [ packet for packet, format, name in sensors ]
+        count = len(packet_list)
+        self.send('BB' + 'B' * count, 149, count, *packet_list)
+        self._expect(sum(sensor.size for sensor in sensors), lambda response: self._unpack_sensor_list(sensors, response), callback)
+
+    def stream(self, callback, *sensors):
+        """Starts streaming samples of the given sensors, calling callback(robot, readings) with each one as it arrives"""
+        self.listen(callback)
+        self.stream_samples(*sensors)
+
+    def listen(self, callback):
+        """Registers a callback to receive every sample from the current stream"""
+        self._listeners.append(callback)
+
+    def unlisten(self, callback):
+        """Removes a callback registered with listen() or stream()"""
+        self._listeners.remove(callback)
+
+    def pause_stream(self, block = True, timeout = 1.0):
+        """Pauses the sample stream (if any) coming from the Roomba.
+
+        block is ignored; the handshake returned is ready once the command
+        is out."""
+        self.send('BB', 150, 0)
+        self.streaming = False
+        self._parser.clear()
+        return self._queued(timeout)
+
+    def close(self):
+        """Closes the channel (and serial port, if any) used to control the Roomba"""
+        self._channel.close()
+        if self.port is not None and hasattr(self.port, 'close'):
+            self.port.close()
+
+class AsyncEventLoop(EventLoop):
+    """An EventLoop for an AsyncRoomba.
+
+    Rather than polling the robot, handlers are run as samples arrive on the
+    robot's asyncore channel. Any number of AsyncEventLoops can share a
+    single asyncore.loop(), so start() does not spawn a thread; it simply
+    starts the sample stream."""
+    def __init__(self, robot):
+        super(AsyncEventLoop, self).__init__(robot)
+        robot.listen(self._on_sample)
+
+    def _on_sample(self, robot, readings):
+        if self.running:
+            self.process_readings(readings)
+
+    def run(self, timeout = 0.015, map = None):
+        """Starts sampling, and runs the asyncore loop in the calling thread until stop() is called.
+
+        Once stopped, the loop carries on until everything queued for the
+        robot (including the command pausing the stream) has been written."""
+        assert not self.running
+        self.start_sampling()
+        while self.running:
+            asyncore.loop(timeout, map = map, count = 1)
+        robot = self._robot
+        while robot._outgoing and robot._channel.connected:
+            asyncore.loop(timeout, map = map, count = 1)
+
+    def stop(self):
+        """Stops sampling and halts the event loop."""
+        self.running = False
+        self._robot.pause_stream()
+
+    def start(self):
+        """Starts sampling; events are processed by whichever thread runs asyncore.loop()."""
+        assert not self.running
+        self.start_sampling()
+
@@ -0,0 +1,172 @@
+import mmap
+from struct import Struct
+from time import sleep
+from time import time
+
+from clock import monotonic
+
+__all__ = ['CaptureSerial', 'ReplaySerial']
+
+# A capture file is a header followed by a series of records, one for each
+# read from the serial port that returned data. Records hold the time of the
+# read in seconds since the capture started (from a monotonic clock), the
+# number of bytes read and then the bytes themselves. Reads of more than
+# RECORD_MAX bytes are split across several records with the same time.
+HEADER = Struct('<8sd') # Magic, wall clock time at which capture started
+RECORD = Struct('<dH') # Seconds since start, byte count
+MAGIC = b'PYRMBCAP'
+RECORD_MAX = 0xffff
+
+class CaptureSerial(object):
+    """Wraps a pyserial compliant port, logging every byte read from it to a capture file.
+
+    Everything other than reads is passed straight through to the wrapped
+    port. Roomba.capture() is the usual way to set one of these up:
+
+        roomba = Roomba('/dev/tty.roomba')
+        roomba.capture('flight.cap')
+
+    The resulting file can be played back with ReplaySerial."""
+    def __init__(self, port, path):
+        self.port = port
+        self._log = open(path, 'wb')
+        self._origin = monotonic()
+        self._log.write(HEADER.pack(MAGIC, time()))
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+    def read(self, size = 1):
+        data = self.port.read(size)
+        if data:
+            elapsed = monotonic() - self._origin
+            for start in xrange(0, len(data), RECORD_MAX):
+                chunk = data[start:start + RECORD_MAX]
+                self._log.write(RECORD.pack(elapsed, len(chunk)))
+                self._log.write(chunk)
+        return data
+
+    def close_capture(self):
+        """Stops capturing and closes the capture file, leaving the port open"""
+        self._log.close()
+
+    def close(self):
+        self.close_capture()
+        self.port.close()
+
+class ReplaySerial(object):
+    """A fake serial port which plays back a capture file written by CaptureSerial.
+
+    Pass one of these to Roomba as its serial_port to reproduce a session
+    without the robot:
+
+        roomba = Roomba(None, serial_port = ReplaySerial('flight.cap'))
+
+    By default bytes become available to read at the same pace they were
+    originally received. A speed of 10 replays ten times faster, and a
+    speed of None makes everything available immediately (useful for
+    benchmarking). The file is memory-mapped and read sequentially, so
+    captures of any size can be replayed without loading them into memory.
+    Anything written to the port is discarded.
+
+    As with a real port, a read waits at most timeout seconds (forever if
+    None) for bytes which aren't due yet, returning whatever it has (or
+    nothing) when the time is up. Once the capture is exhausted reads
+    return whatever is left, as though they timed out."""
+    def __init__(self, path, speed = 1.0, timeout = 0.030):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, self.started = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a capture file' % path)
+        self.speed = speed
+        self.timeout = timeout
+        self._next = HEADER.size # Offset of the next unread record
+        self._position = self._end = 0 # Unread bytes of the current record
+        self._origin = None
+        # Records from self._next up to self._due_end are known to be due,
+        # holding self._due_bytes between them, so in_waiting only ever
+        # looks at each record once
+        self._due_end = self._next
+        self._due_bytes = 0
+
+    def _due(self, timestamp):
+        """Seconds until a byte captured at timestamp should be readable"""
+        if not self.speed:
+            return 0
+        if self._origin is None:
+            self._origin = monotonic() - timestamp / self.speed
+        return self._origin + timestamp / self.speed - monotonic()
+
+    def _advance(self, deadline):
+        """Moves on to the next record, sleeping until it is due but not past deadline (if not None). Returns False if it isn't ready or there are no more."""
+        offset = self._next
+        if offset + RECORD.size > len(self._map):
+            return False
+        timestamp, count = RECORD.unpack_from(self._map, offset)
+        delay = self._due(timestamp)
+        if delay > 0:
+            if deadline is not None:
+                remaining = deadline - monotonic()
+                if remaining < delay:
+                    if remaining > 0:
+                        sleep(remaining)
+                    return False
+            sleep(delay)
+        self._position = offset + RECORD.size
+        self._end = self._next = self._position + count
+        if self._due_end > offset:
+            self._due_bytes -= count
+        else:
+            self._due_end, self._due_bytes = self._next, 0
+        return True
+
+    @property
+    def in_waiting(self):
+        """Number of bytes which are due to have arrived"""
+        offset = self._due_end
+        waiting = self._due_bytes
+        size = len(self._map)
+        while offset + RECORD.size <= size:
+            timestamp, count = RECORD.unpack_from(self._map, offset)
+            if self._due(timestamp) > 0:
+                break
+            waiting += count
+            offset += RECORD.size + count
+        self._due_end, self._due_bytes = offset, waiting
+        return waiting + self._end - self._position
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def read(self, size = 1):
+        deadline = None
+        if self.timeout is not None:
+            deadline = monotonic() + self.timeout
+        chunks = []
+        while size > 0:
+            if self._position == self._end and not self._advance(deadline):
+                break
+            stop = min(self._position + size, self._end)
+            chunks.append(self._map[self._position:stop])
+            size -= stop - self._position
+            self._position = stop
+        return b''.join(chunks)
+
+    def write(self, data):
+        return len(data)
+
+    def flushInput(self):
+        """Discards any bytes which are due to have arrived"""
+        self._position = self._end
+        while self._advance(0):
+            self._position = self._end
+
+    reset_input_buffer = flushInput
+
+    def setBaudrate(self, baud_rate):
+        pass
+
+    def close(self):
+        self._map.close()
+        self._file.close()
@@ -0,0 +1,37 @@
+"""A monotonic clock for timing samples and scheduling.
+
+time.time() can jump backwards or forwards when the system clock is
+adjusted, which makes it useless for measuring intervals. Python 3 provides
+time.monotonic(); on Python 2 we ask the C library for CLOCK_MONOTONIC
+ourselves, falling back to time.time() if that isn't possible.
+"""
+
+__all__ = ['monotonic']
+
+try:
+    from time import monotonic
+except ImportError:
+    try:
+        import ctypes
+        import ctypes.util
+        import os
+        import sys
+
+        class _timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        _CLOCK_MONOTONIC = sys.platform == 'darwin' and 6 or 1 # See <time.h>
+        _librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno = True)
+        _clock_gettime = _librt.clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+        def monotonic():
+            """Returns the value of a clock that never goes backwards, in seconds"""
+            t = _timespec()
+            if _clock_gettime(_CLOCK_MONOTONIC, ctypes.pointer(t)) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            return t.tv_sec + t.tv_nsec * 1e-9
+        monotonic()
+    except Exception:
+        from time import time as monotonic
@@ -0,0 +1,108 @@
+from threading import Lock
+
+__all__ = ['CommandShadow']
+
+# Commands which set some piece of the robot's state outright, so that only
+# the most recent one matters. Commands setting the same state share a slot.
+SLOTS = {
+    137: 'drive', # drive
+    145: 'drive', # drive_direct
+    146: 'drive', # drive_pwm
+    138: 'motors', # motors
+    144: 'motors', # motors_pwm
+    139: 'leds', # leds
+    162: 'scheduling_leds',
+    163: 'display', # display_raw
+    164: 'display', # display_ascii
+}
+
+# Commands after which the robot's state can no longer be assumed to match
+# what we last sent it (mode changes, cleaning cycles, docking)
+RESETS = set([128, 129, 130, 131, 132, 133, 134, 135, 136, 143])
+
+class CommandShadow(object):
+    """Remembers the last state-setting command of each kind sent to the robot, coalescing and dropping redundant ones.
+
+    Commands like drive_direct() and leds() set some piece of the robot's
+    state outright, so when they are issued faster than the robot can act
+    on them only the latest matters. Rather than being written immediately
+    these commands are held, one per kind, until the next flush(), at which
+    point everything held goes out in a single write. Commands identical to
+    the last one actually sent are dropped altogether.
+
+    Every other command (mode changes, songs, sensor requests) is written
+    immediately, preceded by anything held so ordering is preserved. Mode
+    changes also forget what was last sent, since the robot may have reset
+    its motors and LEDs. A state-setting command which can't wait for the
+    next flush (e.g., stopping) can be sent the same way with immediate().
+
+    Roomba.buffer_commands() installs one of these; EventLoop and Roomba.run()
+    flush it once per tick."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._held = {} # Slot -> command bytes waiting for the next flush
+        self._order = [] # Slots in the order they were first held
+        self._sent = {} # Slot -> command bytes last written
+        self.coalesced = 0 # Held commands replaced before being sent
+        self.redundant = 0 # Commands dropped as identical to what was sent
+
+    def queue(self, data):
+        """Takes a packed command, returning whatever should be written to the port right away"""
+        slot = SLOTS.get(ord(data[0]))
+        with self._lock:
+            if slot is None:
+                held = self._take()
+                if ord(data[0]) in RESETS:
+                    self._sent.clear()
+                return held + data
+            if slot in self._held:
+                self.coalesced += 1
+            else:
+                self._order.append(slot)
+            self._held[slot] = data
+            return ''
+
+    def immediate(self, data):
+        """Takes a packed command which must go out now, returning it preceded by anything held.
+
+        A held command of the same kind is superseded by it, and the command
+        is sent even if identical to the last one of its kind."""
+        slot = SLOTS.get(ord(data[0]))
+        with self._lock:
+            if slot in self._held:
+                self.coalesced += 1
+                del self._held[slot]
+                self._order.remove(slot)
+            held = self._take()
+            if slot is not None:
+                self._sent[slot] = data
+            elif ord(data[0]) in RESETS:
+                self._sent.clear()
+            return held + data
+
+    def flush(self):
+        """Returns the bytes of every held command, forgetting them"""
+        with self._lock:
+            return self._take()
+
+    def _take(self):
+        if not self._held:
+            return ''
+        sent = self._sent
+        chunks = []
+        for slot in self._order:
+            data = self._held[slot]
+            if sent.get(slot) == data:
+                self.redundant += 1
+                continue
+            sent[slot] = data
+            chunks.append(data)
+        self._held.clear()
+        del self._order[:]
+        return ''.join(chunks)
+
+    def forget(self):
+        """Forgets what was last sent, so the next command of each kind is sent even if identical"""
+        with self._lock:
+            self._sent.clear()
@@ -0,0 +1,356 @@
+from collections import deque
+from math import cos
+from math import pi
+from math import sin
+from random import Random
+from struct import pack
+from threading import Condition
+
+from clock import monotonic
+import sensors as sensor_list
+
+__all__ = ['VirtualRoomba']
+
+# Number of argument bytes following each fixed-length opcode
+_ARGUMENTS = {
+    128: 0, 129: 1, 130: 0, 131: 0, 132: 0, 133: 0, 134: 0, 135: 0, 136: 0,
+    137: 4, 138: 1, 139: 3, 141: 1, 142: 1, 143: 0, 144: 3, 145: 4, 146: 4,
+    150: 1, 164: 4, 165: 1, 168: 3,
+}
+
+_PASSIVE, _SAFE, _FULL = 1, 2, 3
+
+def _signed(high, low):
+    value = (high << 8) | low
+    if value & 0x8000:
+        value -= 0x10000
+    return value
+
+class VirtualRoomba(object):
+    """A pure-Python Roomba, pretending to be the serial port it's attached to.
+
+    VirtualRoomba understands the Open Interface opcodes Roomba sends (mode
+    changes, driving, sensor queries and streams, songs and the display) and
+    answers them the way a 500 series robot would, including streaming
+    checksummed frames every 15ms. Driving moves the robot around a square
+    room using simple differential-drive kinematics, updating the encoders,
+    distance and angle sensors, and bumping into the walls sets the bump
+    sensors. Pass one as the serial_port of a Roomba to run code without a
+    robot:
+
+        robot = Roomba(None, serial_port = VirtualRoomba(seed = 42))
+
+    By default the emulator runs in real time. With realtime = False time
+    only advances when a read needs more data, so a stream is produced as
+    fast as it can be consumed and, together with a seed, runs are exactly
+    reproducible.
+
+    Faults can be injected to exercise error handling:
+     drop_rate: Probability that a frame loses one of its bytes.
+     corrupt_rate: Probability that a frame's checksum is wrong.
+     spike_rate, spike: Probability that a frame is delayed, and by how
+        many seconds. Later frames queue up behind it, as on a real link."""
+
+    TICK = 0.015 # The Roomba's internal update period
+    WHEEL_BASE = 235.0 # mm
+    COUNTS_PER_MM = 508.8 / (72.0 * pi) # Encoder counts per mm of wheel travel
+
+    def __init__(self, seed = None, realtime = True, timeout = 0.030, room = 2000.0, drop_rate = 0.0, corrupt_rate = 0.0, spike_rate = 0.0, spike = 0.1):
+        """Create a robot sitting in passive mode in the middle of a square room room mm across"""
+        self.timeout = timeout
+        self.realtime = realtime
+        self.room = room
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.spike_rate = spike_rate
+        self.spike = spike
+        self._random = Random(seed)
+        self._condition = Condition()
+        self._time = 0.0 # Virtual clock, when not running in real time
+        self._origin = monotonic()
+        self._next_tick = 0.0
+        self._input = bytearray()
+        self._output = deque() # (time available, bytes)
+        self._output_ready = 0.0 # Time the last queued output becomes available
+        self._stream = None
+        self._streaming = False
+        self.mode = 0
+        self.songs = {}
+        self.song = 0 # Last song played
+        self._song_end = 0.0 # When it finishes
+        self.display = ''
+        self.x = self.y = self.theta = 0.0
+        self.left_velocity = self.right_velocity = 0 # mm/s
+        self.velocity = self.radius = 0 # As last requested by drive()
+        self.left_encoder = self.right_encoder = 0.0 # Counts, before rollover
+        self.distance = self.angle = 0.0 # Accumulated since last read
+        self.bumps = 0
+        self.buttons = 0
+        self.values = {
+            'voltage': 16000,
+            'battery_charge': 2500,
+            'battery_capacity': 3000,
+            'temperature': 25,
+        }
+
+    # Time
+    def _now(self):
+        if self.realtime:
+            return monotonic() - self._origin
+        return self._time
+
+    def _advance(self, now):
+        """Runs the simulation forward to now, one 15ms tick at a time"""
+        while self._next_tick <= now:
+            self._step(self.TICK)
+            if self._stream is not None and self._streaming:
+                self._emit(self._frame(self._stream), self._next_tick)
+            self._next_tick += self.TICK
+
+    def _step(self, dt):
+        """Integrates the robot's motion over dt seconds"""
+        left = self.left_velocity * dt
+        right = self.right_velocity * dt
+        if not (left or right):
+            return
+        d_theta = (right - left) / self.WHEEL_BASE
+        d = (left + right) / 2.0
+        heading = self.theta + d_theta / 2
+        x = self.x + d * cos(heading)
+        y = self.y + d * sin(heading)
+        self.theta += d_theta
+        limit = self.room / 2 - self.WHEEL_BASE / 2
+        self.bumps = 0
+        if abs(x) > limit or abs(y) > limit:
+            # Hit a wall; work out which side of the bumper took it
+            if abs(x) > limit:
+                wall = 0.0 if x > 0 else pi
+            else:
+                wall = pi / 2 if y > 0 else -pi / 2
+            bearing = (wall - self.theta + pi) % (2 * pi) - pi
+            self.bumps = bearing > 0.2 and 2 or bearing < -0.2 and 1 or 3
+            return # The wall doesn't move, and neither do we
+        self.x, self.y = x, y
+        self.distance += d
+        self.angle += d_theta * 180 / pi
+        self.left_encoder += left * self.COUNTS_PER_MM
+        self.right_encoder += right * self.COUNTS_PER_MM
+
+    # Output
+    def _emit(self, data, when):
+        """Queues bytes to become readable at a given time, behind anything already queued"""
+        when = max(when, self._output_ready)
+        self._output_ready = when
+        self._output.append((when, data))
+        self._condition.notify_all()
+
+    def _frame(self, packets):
+        """Builds a checksummed stream frame for a list of packets, applying any faults"""
+        body = ''.join([ pack('B', packet) + self._data(packet) for packet in packets ])
+        frame = bytearray(pack('BB', 19, len(body)) + body)
+        frame.append((-sum(frame)) & 0xff)
+        random = self._random
+        if self.corrupt_rate and random.random() < self.corrupt_rate:
+            frame[-1] = (frame[-1] + 1) & 0xff
+        if self.drop_rate and random.random() < self.drop_rate:
+            del frame[random.randrange(len(frame))]
+        if self.spike_rate and random.random() < self.spike_rate:
+            self._output_ready += self.spike
+        return bytes(frame)
+
+    def _data(self, packet):
+        """Packs the current value of a sensor packet"""
+        if packet == 0:
+            return ''.join([ self._pack(sensor) for sensor in sensor_list.ALL_SCI[1] ])
+        sensor = sensor_list.SENSOR_ID_MAP.get(packet)
+        if sensor is None:
+            return ''
+        return self._pack(sensor)
+
+    def _pack(self, sensor):
+        packet, format, name = sensor
+        return pack('>' + format, self._value(name))
+
+    def _value(self, name):
+        """Current reading of a sensor by name"""
+        if name == 'distance':
+            value, self.distance = int(self.distance), self.distance - int(self.distance)
+            return value
+        if name == 'angle':
+            value, self.angle = int(self.angle), self.angle - int(self.angle)
+            return value
+        if name == 'bump_wheel_drops':
+            return self.bumps
+        if name == 'buttons':
+            return self.buttons
+        if name == 'left_encoder':
+            return int(self.left_encoder) & 0xffff
+        if name == 'right_encoder':
+            return int(self.right_encoder) & 0xffff
+        if name == 'oi_mode':
+            return self.mode
+        if name == 'requested_velocity':
+            return self.velocity
+        if name == 'requested_radius':
+            return self.radius
+        if name == 'requested_left_velocity':
+            return self.left_velocity
+        if name == 'requested_right_velocity':
+            return self.right_velocity
+        if name == 'song_number':
+            return self.song
+        if name == 'song_playing':
+            return int(self._now() < self._song_end)
+        if name == 'stream_packets':
+            return len(self._stream or [])
+        return self.values.get(name, 0)
+
+    # Input
+    def _execute(self):
+        """Runs every complete command in the input buffer"""
+        data = self._input
+        while data:
+            opcode = data[0]
+            if opcode in _ARGUMENTS:
+                size = 1 + _ARGUMENTS[opcode]
+            elif opcode in (148, 149):
+                size = len(data) > 1 and 2 + data[1] or 0
+            elif opcode == 140:
+                size = len(data) > 2 and 3 + 2 * data[2] or 0
+            else:
+                size = 1 # Not something we understand; skip it
+            if not size or len(data) < size:
+                return # Wait for the rest of the command
+            self._command(opcode, data[1:size])
+            del data[:size]
+
+    def _command(self, opcode, args):
+        if opcode == 128:
+            self.mode = _PASSIVE
+        elif not self.mode:
+            return # Until started the robot ignores everything
+        elif opcode in (130, 131):
+            self.mode = _SAFE
+        elif opcode == 132:
+            self.mode = _FULL
+        elif opcode == 133:
+            self.mode = _PASSIVE
+            self._drive_wheels(0, 0)
+        elif opcode == 140:
+            self.songs[args[0]] = [ (args[i], args[i + 1]) for i in range(2, len(args), 2) ]
+        elif opcode == 142:
+            self._emit(self._data(args[0]), self._now())
+        elif opcode == 148:
+            self._stream = list(args[1:])
+            self._streaming = True
+        elif opcode == 149:
+            self._emit(''.join([ self._data(packet) for packet in args[1:] ]), self._now())
+        elif opcode == 150:
+            self._streaming = bool(args[0])
+        elif opcode == 164:
+            self.display = str(args)
+        elif not self.mode or self.mode == _PASSIVE:
+            return # Everything else needs safe or full mode
+        elif opcode == 141:
+            self._play(args[0])
+        elif opcode == 137:
+            self._drive(_signed(args[0], args[1]), _signed(args[2], args[3]))
+        elif opcode == 145:
+            self._drive_wheels(_signed(args[2], args[3]), _signed(args[0], args[1]))
+        elif opcode == 146:
+            self._drive_wheels(_signed(args[2], args[3]) * 500 // 255, _signed(args[0], args[1]) * 500 // 255)
+
+    def _play(self, number):
+        """Plays a defined song, ignoring undefined ones as the robot does"""
+        notes = self.songs.get(number)
+        if notes is None:
+            return
+        self.song = number
+        self._song_end = self._now() + sum(duration for note, duration in notes) / 64.0
+
+    def _drive(self, velocity, radius):
+        self.velocity, self.radius = velocity, radius
+        if radius in (-0x8000, 0x7fff):
+            self._drive_wheels(velocity, velocity, remember = False)
+        elif radius == -1:
+            self._drive_wheels(velocity, -velocity, remember = False)
+        elif radius == 1:
+            self._drive_wheels(-velocity, velocity, remember = False)
+        else:
+            half = self.WHEEL_BASE / 2
+            self._drive_wheels(int(velocity * (radius - half) / radius), int(velocity * (radius + half) / radius), remember = False)
+
+    def _drive_wheels(self, left, right, remember = True):
+        self.left_velocity, self.right_velocity = left, right
+        if remember:
+            self.velocity = self.radius = 0
+
+    # pyserial interface
+    def write(self, data):
+        with self._condition:
+            self._advance(self._now())
+            self._input.extend(data)
+            self._execute()
+        return len(data)
+
+    def _available(self, now):
+        """Number of bytes readable at time now"""
+        count = 0
+        for when, data in self._output:
+            if when > now:
+                break
+            count += len(data)
+        return count
+
+    @property
+    def in_waiting(self):
+        with self._condition:
+            now = self._now()
+            self._advance(now)
+            return self._available(now)
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def read(self, size = 1):
+        with self._condition:
+            deadline = self._now() + (self.timeout or 0)
+            chunks = []
+            while size > 0:
+                now = self._now()
+                self._advance(now)
+                output = self._output
+                if output and output[0][0] <= now:
+                    when, data = output.popleft()
+                    if len(data) > size:
+                        output.appendleft((when, data[size:]))
+                        data = data[:size]
+                    chunks.append(data)
+                    size -= len(data)
+                    continue
+                # Nothing to read yet; wait for the next frame or response
+                ready = output and output[0][0] or (self._streaming and self._stream is not None and self._next_tick) or None
+                if ready is None or ready > deadline:
+                    if self.realtime and now < deadline:
+                        self._condition.wait(deadline - now)
+                        continue
+                    self._time = max(self._time, deadline)
+                    break
+                if self.realtime:
+                    self._condition.wait(ready - now)
+                else:
+                    self._time = ready
+            return ''.join(chunks)
+
+    def flushInput(self):
+        with self._condition:
+            self._advance(self._now())
+            self._output.clear()
+
+    reset_input_buffer = flushInput
+
+    def setBaudrate(self, baud_rate):
+        pass
+
+    def close(self):
+        pass
@@ -1,7 +1,51 @@
 from threading import Thread
 
+from clock import monotonic
+from frames import FrameError
+from frames import MalformedFrameError
+from scheduler import TickScheduler
+import sensors as sensor_list
+from telemetry import Telemetry
+from workers import HandlerPool
+
 __all__ = ['EventLoop']
 
+_MISSING = object() # Stands in for the value of a sensor we haven't seen
+
+def _changed(old, value):
+    return True # Only asked once we know the value changed
+
+class _EdgeTable(object):
+    """The change, threshold and bit handlers for each sensor, and the last frame they were run for"""
+    __slots__ = ('handlers', 'body', 'plan', 'slices')
+
+    def __init__(self, handlers):
+        self.handlers = handlers # (sensor name, (test, handler) pairs) for every sensor with any
+        self.body = None # Body of the last frame, if the readings came as one
+        self.plan = None # The DecodePlan laying that frame out, if any
+        self.slices = {} # DecodePlan -> (sensor name, start, stop, handlers) for each sensor it carries
+
+class _InlineRunner(object):
+    """Stands in for a HandlerPool once metrics or tracers are enabled, running handlers inline but timing and tracing them"""
+    def __init__(self, loop):
+        self._loop = loop
+
+    def submit(self, action, args):
+        metrics = self._loop.metrics
+        tracers = self._loop._tracers
+        name = args[1]
+        start = monotonic()
+        for tracer in tracers:
+            tracer.before_handler(action, name, start)
+        try:
+            action(*args)
+        finally:
+            end = monotonic()
+            if metrics is not None:
+                metrics.time_handler(action, end - start)
+            for tracer in tracers:
+                tracer.after_handler(action, name, end)
+
 class EventLoop(object):
     """Event loop processing for Roomba robots. 
     
@@ -15,7 +59,7 @@ class EventLoop(object):
      - Better: Call start() and allow this class to spawn off a background 
          event loop
      - Best: Call run() to allow event processing to occur in the main thread 
-         with on call to your idle-function per loop
+         with one call to your idle-function per loop
     
     As to the matter of thread-safety, EventLoop is written in a lock-free
     fashion. What this means is that you can have as many threads reading
@@ -29,32 +73,65 @@ class EventLoop(object):
         call read() on the same serial port at the same time, so don't do it."""
         super(EventLoop, self).__init__()
         self._robot = robot
-        self._sensors = []
-        self._handlers = {}
+        self._sensors = set()
+        self._handlers = {} # Sensor name -> (handlers, (test, handler) pairs)
+        self._always = () # (sensor name, handlers) for every sensor with plain handlers
+        self._edges = _EdgeTable(()) # See _subscribe()
+        self._previous = {} # Last value seen of each sensor with edge handlers
+        self._dropped = frozenset() # Names of sensors removed by set_sensors(), whose handlers no longer run
+        self._listeners = () # Called with every sample, see on_sample()
         self.latest = {}
+        self.telemetry = None
+        self.pool = None
+        self.metrics = None
+        self._tracers = ()
+        self._runner = None # The pool, or an _InlineRunner, if handlers aren't simply called
         self.running = False
         self._thread = None
-        self._idle = None
+        self.scheduler = TickScheduler() # Paces run()
+        self.bad_frames = 0 # Frames skipped for bad checksums or contents
+    
+    @property
+    def robot(self):
+        """The robot this event loop is attached to"""
+        return self._robot
     
     def set_sensors(self, *sensors):
-        """Sets the list of sensors to be read on each pass through the event loop."""
+        """Sets the list of sensors to be read on each pass through the event loop.
+        
+        If the loop is running the robot's stream is switched to the new
+        sensors in place (see Roomba.stream_samples()), without pausing it,
+        so handlers for sensors in both sets see no gap. Handlers for a
+        sensor which is dropped stop running straight away, even for frames
+        of the old layout still in flight, and change and threshold handlers
+        start afresh if it is added again."""
+        removed = self._sensors - set(sensors)
         self._sensors = set(sensors)
+        dropped = set(self._dropped)
+        for sensor in removed:
+            for name in (sensor.name,) + sensor.names:
+                self._previous.pop(name, None)
+                dropped.add(name)
+        for sensor in sensors:
+            dropped.difference_update((sensor.name,) + sensor.names)
+        self._dropped = frozenset(dropped) # Replaced, not modified, as _dispatch() may be iterating it
+        self._edges = _EdgeTable(self._edges.handlers) # Forget the last frame and its layout
         if self.running:
-            self._robot.stream_samples(sensors)
+            self._robot.stream_samples(*self._sensors)
     
     def add_sensor(self, sensor):
         """Adds a sensor to the query list.
         
         If the event loop is running this will begin querying the sensor
         immediately."""
-        self.set_sensors(self._sensors | set([sensor]))
+        self.set_sensors(*(self._sensors | set([sensor])))
     
     def remove_sensor(self, sensor):
         """Removes a sensor from the query list.
         
         If the event loop is running this will stop querying the sensor
         immediately."""
-        self.set_sensors(self._sensors - set([sensor]))
+        self.set_sensors(*(self._sensors - set([sensor])))
     
     def start_sampling(self):
         """Asks the Roomba to start returning samples for the sensor query list.
@@ -69,35 +146,372 @@ class EventLoop(object):
         daemonize itself
         """
         self.running = True
-        self._robot.stream_samples(sensors)
+        self._robot.stream_samples(*self._sensors)
     
     def process_events(self):
-        """Runs one pass of the event-loop, polling for sensor data and running any event handlers."""
-        readings = self._robot.poll()
-        for name, value in readings:
-            if self._handlers.has_key(name):
-                self._handlers[name](self._robot, name, value)
+        """Runs one pass of the event-loop, polling for sensor data and running any event handlers.
+        
+        Frames with bad checksums, or which can't be decoded, are counted in
+        self.bad_frames and otherwise ignored, whatever the robot's
+        frame_errors policy: one corrupted frame (e.g., from a burst of
+        interference) shouldn't bring down the loop."""
+        robot = self._robot
+        try:
+            packet = robot.next_frame()
+        except FrameError:
+            self.bad_frames += 1
+            return # The robot has already resynchronized
+        if packet is None:
+            return # Timed out waiting for a sample
+        if self.decoding(): # Otherwise only the robot's sinks want this frame
+            self._process_frame(packet)
+        robot.flush_commands()
+    
+    def decoding(self):
+        """Returns whether samples need decoding.
+        
+        They don't if the loop has no handlers, sample handlers or telemetry
+        while the robot has frame sinks (see add_sink()): the loop then just
+        keeps the raw frames flowing to the sinks, and self.latest is not
+        updated."""
+        return bool(self._handlers or self._listeners or self.telemetry is not None or not self._robot.forwarding)
+    
+    def add_sink(self, sink):
+        """Passes every raw frame the loop reads to a FrameSink. See Roomba.add_sink()."""
+        self._robot.add_sink(sink)
+    
+    def remove_sink(self, sink):
+        """Stops passing frames to a sink"""
+        self._robot.remove_sink(sink)
+    
+    def process_readings(self, readings):
+        """Runs the event handlers for a sample obtained by some other means (e.g., by an AsyncRoomba)."""
+        self._dispatch(readings)
+        self._robot.flush_commands()
+    
+    def process_frame(self, packet):
+        """Runs the event handlers for the body of a stream frame read by some other means (e.g., by a Fleet, from Roomba.read_frames()).
+        
+        The frame is decoded only if need be (see on_change()); frames which
+        can't be are counted in self.bad_frames."""
+        self._process_frame(packet)
+        self._robot.flush_commands()
+    
+    def _process_frame(self, packet):
+        body = packet.tobytes()
+        if body == self._edges.body and not (self._always or self._listeners or self.telemetry is not None):
+            return # Nothing has changed, and only edge handlers would run
+        robot = self._robot
+        try:
+            if robot._tracers:
+                readings = robot._traced_decode(packet)
+            else:
+                readings = robot._decode_frame(packet)
+        except MalformedFrameError:
+            self.bad_frames += 1
+            return
+        self._dispatch(readings, body)
+    
+    def _dispatch(self, readings, body = None):
+        """Runs the event handlers for a set of sensor readings, given the frame body they were decoded from if there was one"""
+        robot = self._robot
+        pool = self._runner
+        dropped = self._dropped
+        for name, always in self._always:
+            value = readings.get(name, _MISSING)
+            if value is _MISSING or (dropped and name in dropped):
+                continue
+            for action in always:
+                if pool is None:
+                    action(robot, name, value)
+                else:
+                    pool.submit(action, (robot, name, value))
+        edges = self._edges
+        if edges.handlers and (body is None or body != edges.body):
+            previous = self._previous
+            last, plan = edges.body, edges.plan
+            if last is not None and plan is not None and plan.lays_out(body):
+                # Laid out like the last frame, so only the sensors whose
+                # bytes differ can have changed
+                changed = [ (name, readings[name], handlers) for name, start, stop, handlers in self._slices(edges, plan) if body[start:stop] != last[start:stop] ]
+            else:
+                changed = []
+                for name, handlers in edges.handlers:
+                    value = readings.get(name, _MISSING)
+                    if value is _MISSING or (dropped and name in dropped):
+                        continue
+                    if value != previous.get(name, _MISSING):
+                        changed.append((name, value, handlers))
+                plan = body is not None and self._plan_for(body) or None
+            edges.body, edges.plan = body, plan
+            for name, value, handlers in changed:
+                old = previous.get(name, _MISSING)
+                previous[name] = value
+                for test, action in handlers:
+                    if test(old, value):
+                        if pool is None:
+                            action(robot, name, value)
+                        else:
+                            pool.submit(action, (robot, name, value))
+        for listener in self._listeners:
+            listener(robot, readings)
         self.latest = readings
+        if self.telemetry is not None:
+            self.telemetry.append(readings)
+        if robot._tracers:
+            robot._end_frame() # See add_tracer()
+    
+    def _slices(self, edges, plan):
+        """Returns where each sensor in an _EdgeTable lies in frames laid out by a plan"""
+        slices = edges.slices.get(plan)
+        if slices is None:
+            dropped = self._dropped
+            slices = []
+            for name, handlers in edges.handlers:
+                field = plan.fields.get(name)
+                if field is not None and name not in dropped:
+                    codec, offset = field
+                    slices.append((name, offset, offset + codec.size, handlers))
+            slices = edges.slices[plan] = tuple(slices)
+        return slices
+    
+    def _plan_for(self, body):
+        """Returns the robot's DecodePlan laying out a frame body, or None if it has none"""
+        for plan in self._robot._plans:
+            if plan.lays_out(body):
+                return plan
+        return None
+    
+    def record(self, capacity = 240000):
+        """Starts keeping a history of sensor readings.
+        
+        Every sample processed from here on is appended to a Telemetry ring
+        holding at most capacity samples (the default is roughly an hour at
+        the Roomba's 15ms update rate), available as self.telemetry:
+        
+            loop.record()
+            ...
+            recent_distances = loop.telemetry.window('distance', 5.0)
+        """
+        self.telemetry = Telemetry(capacity)
+        return self.telemetry
+    
+    def use_workers(self, workers = 4, queue_size = 64, policy = 'coalesce'):
+        """Runs event handlers on a pool of worker threads instead of the event-loop thread.
+        
+        The event loop then only queues handler calls, so it never waits on
+        a slow handler and can keep up with the Roomba's stream. Calls to any
+        one handler still happen in order, one at a time. See HandlerPool for
+        the meaning of queue_size and the overflow policies; the pool is
+        available as self.pool for its statistics."""
+        if self.pool is not None:
+            self.pool.close()
+        self.pool = HandlerPool(workers, queue_size, policy)
+        self._update_runner()
+        return self.pool
+    
+    def instrument(self, metrics = None):
+        """Starts measuring the health of the robot's serial link and this loop, returning the Metrics.
+        
+        Besides everything Roomba.instrument() measures, the execution time
+        of each handler is recorded, and the depth of the worker pool's queue
+        (see use_workers()) is included as a gauge."""
+        self.metrics = metrics = self._robot.instrument(metrics)
+        self._update_runner()
+        metrics.gauge('handler_queue', lambda: self.pool is not None and self.pool.depth() or 0)
+        metrics.gauge('loop_overruns', lambda: self.scheduler.overruns)
+        return metrics
+    
+    def add_tracer(self, tracer):
+        """Registers a Tracer with the robot (see Roomba.add_tracer()), and to be called around every handler invocation.
+        
+        The tracer's frame spans (before_frame() and after_frame()) then
+        cover dispatching each frame's readings as well as decoding them."""
+        self._robot.add_tracer(tracer)
+        self._robot.deferred_frame_end = True
+        self._tracers += (tracer,)
+        self._update_runner()
+    
+    def remove_tracer(self, tracer):
+        """Unregisters a Tracer"""
+        self._robot.remove_tracer(tracer)
+        self._tracers = tuple(t for t in self._tracers if t is not tracer)
+        self._robot.deferred_frame_end = bool(self._tracers)
+        self._update_runner()
+    
+    def _update_runner(self):
+        # Handlers are only routed through a runner when something needs to
+        # see them run; otherwise _dispatch() calls them directly
+        pool = self.pool
+        if pool is not None:
+            pool.metrics = self.metrics
+            pool.tracers = self._tracers
+            self._runner = pool
+        elif self.metrics is not None or self._tracers:
+            self._runner = _InlineRunner(self)
+        else:
+            self._runner = None
     
     def on(self, sensor_name, action):
-        """Adds an event handler for a given sensor.
+        """Adds an event handler for a given sensor, called with every sample.
         
         Event handlers should be of the form:
         
             def handler(robot, sensor_name, value):
                 # Code to process event
         
-        Handlers will be called on the event-loop thread. Implementors should
-        ensure thread-safety of their code accordingly.
+        Any number of handlers may be added for the same sensor; they are
+        called in the order they were added. Handlers will be called on the
+        event-loop thread (or a worker thread, see use_workers()).
+        Implementors should ensure thread-safety of their code accordingly.
         """
-        self._handlers[sensor_name] = action
+        self._subscribe(sensor_name, action)
+    
+    def on_change(self, sensor_name, action):
+        """Adds an event handler for a given sensor, called only when its value changes.
+        
+        The handler is also called for the first sample of the sensor. Edge
+        handlers (these, and those of on_threshold() and on_bits()) only look
+        at the raw frames: a frame identical to the last is skipped without
+        being decoded (unless other handlers need it), and otherwise only the
+        bytes of the sensors with edge handlers are compared, so they cost
+        next to nothing on frames where nothing happens."""
+        self._subscribe(sensor_name, action, _changed)
+    
+    def on_threshold(self, sensor_name, threshold, action, direction = 'both'):
+        """Adds an event handler for a given sensor, called when its value crosses a threshold.
+        
+        A rising crossing is one from below threshold to at or above it; a
+        falling crossing the reverse. Direction may be 'rising', 'falling' or
+        'both'."""
+        if direction == 'rising':
+            test = lambda old, value: old is not _MISSING and old < threshold <= value
+        elif direction == 'falling':
+            test = lambda old, value: old is not _MISSING and value < threshold <= old
+        elif direction == 'both':
+            test = lambda old, value: old is not _MISSING and (old < threshold) != (value < threshold)
+        else:
+            raise ValueError('Unknown threshold direction %r' % direction)
+        self._subscribe(sensor_name, action, test)
     
-    def run(self):
-        """Starts sampling, and runs the event loop in the calling thread."""
+    def on_bits(self, sensor_name, mask, action, edge = 'both'):
+        """Adds an event handler for a bit-field sensor, called when any of the bits in mask change.
+        
+        This is most useful for the packed sensors like bump_wheel_drops and
+        buttons; for example to be told when the left bumper is pressed:
+        
+            loop.on_bits('bump_wheel_drops', 0x02, handler, 'rising')
+        
+        The mask may also be given as the name of a bit, or a list of them,
+        as defined by the sensor (see Sensor.bits):
+        
+            loop.on_bits('bump_wheel_drops', 'bump_left', handler, 'rising')
+        
+        Edge may be 'rising' (a bit was set), 'falling' (a bit was cleared)
+        or 'both'. The handler receives the whole sensor value."""
+        if isinstance(mask, (str, list, tuple)):
+            bits = sensor_list.SENSOR_NAME_MAP[sensor_name].bits
+            names = isinstance(mask, str) and [mask] or mask
+            try:
+                mask = reduce(lambda mask, name: mask | bits[name], names, 0)
+            except KeyError as e:
+                raise ValueError('Sensor %s has no bit %s' % (sensor_name, e.args[0]))
+        if edge == 'rising':
+            test = lambda old, value: old is not _MISSING and value & ~old & mask
+        elif edge == 'falling':
+            test = lambda old, value: old is not _MISSING and old & ~value & mask
+        elif edge == 'both':
+            test = lambda old, value: old is not _MISSING and (old ^ value) & mask
+        else:
+            raise ValueError('Unknown edge %r' % edge)
+        self._subscribe(sensor_name, action, test)
+    
+    def on_sample(self, action):
+        """Adds a handler called with every sample as a whole, as action(robot, readings).
+        
+        Sample handlers always run on the event-loop thread, after the
+        sensor handlers, so they should be quick; they are intended for
+        passing samples on to other consumers (see TelemetryServer)."""
+        self._listeners += (action,)
+    
+    def off(self, sensor_name, action):
+        """Removes every subscription of a handler to a given sensor"""
+        handlers = dict(self._handlers)
+        always, edges = handlers.get(sensor_name, ((), ()))
+        always = tuple(a for a in always if a != action)
+        edges = tuple((test, a) for test, a in edges if a != action)
+        if always or edges:
+            handlers[sensor_name] = (always, edges)
+        else:
+            handlers.pop(sensor_name, None)
+        self._set_handlers(handlers)
+    
+    def _subscribe(self, sensor_name, action, test = None):
+        # The handler table is replaced rather than modified so the event
+        # loop thread never sees it half-updated
+        handlers = dict(self._handlers)
+        always, edges = handlers.get(sensor_name, ((), ()))
+        if test is None:
+            always += (action,)
+        else:
+            edges += ((test, action),)
+        handlers[sensor_name] = (always, edges)
+        self._set_handlers(handlers)
+    
+    def _set_handlers(self, handlers):
+        self._always = tuple((name, always) for name, (always, edges) in handlers.iteritems() if always)
+        # A new table, so sensors with new edge handlers get compared in full
+        # on the next frame even if it's identical to the last
+        self._edges = _EdgeTable(tuple((name, edges) for name, (always, edges) in handlers.iteritems() if edges))
+        self._handlers = handlers
+    
+    def run(self, idle_func = None):
+        """Starts sampling, and runs the event loop in the calling thread.
+        
+        Ticks keep to deadlines set by self.scheduler (see TickScheduler),
+        once every 15ms in step with the robot's stream. Each tick handles
+        every sample which has arrived (waiting for one if none has, unless
+        the tick is catching up), then calls idle_func and any other idle
+        functions registered with the scheduler in the slack before the
+        deadline. Handlers which overrun a tick delay the samples behind
+        them but never lose any: a loop which falls behind handles
+        everything waiting on its next tick. Bad frames are skipped and
+        counted, as for process_events()."""
         assert not self.running
-        self.start_sampling()
-        while self.running:
-            self.process_events()
+        robot = self._robot
+        scheduler = self.scheduler
+        if idle_func:
+            scheduler.add_idle(idle_func)
+        try:
+            self.start_sampling()
+            scheduler.start()
+            while self.running:
+                if scheduler.slack() > 0:
+                    # Wait for the robot's next sample; the robot keeps its
+                    # own time, so the tick's deadline follows the sample's
+                    # arrival
+                    try:
+                        packet = robot.next_frame()
+                    except FrameError:
+                        packet = None
+                        self.bad_frames += 1
+                    scheduler.align()
+                    if packet is not None and self.decoding():
+                        self._process_frame(packet)
+                # else this tick is catching up, so takes only what's waiting
+                parser = robot._parser
+                errors = parser.checksum_errors
+                frames = robot.read_frames()
+                self.bad_frames += parser.checksum_errors - errors
+                if self.decoding():
+                    for packet in frames:
+                        self._process_frame(packet)
+                robot.flush_commands()
+                scheduler.idle()
+                scheduler.wait()
+        finally:
+            if idle_func:
+                scheduler.remove_idle(idle_func)
     
     def stop(self):
         """Stops sampling and halts the event loop."""
@@ -105,6 +519,8 @@ class EventLoop(object):
         if self._thread:
             self._thread.join()
         self._robot.pause_stream()
+        if self.pool is not None:
+            self.pool.join() # Let queued handlers finish
     
     def start(self):
         """Spawns off a background thread running the event loop."""
@@ -0,0 +1,169 @@
+import select
+from threading import Thread
+
+from events import EventLoop
+
+__all__ = ['Fleet']
+
+class _Poller(object):
+    """The best readiness notification mechanism the platform offers: epoll, poll or select"""
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._epoll = select.epoll()
+            self._poll = None
+        elif hasattr(select, 'poll'):
+            self._epoll = None
+            self._poll = select.poll()
+        else:
+            self._epoll = self._poll = None
+        self._fds = set()
+
+    def register(self, fd):
+        self._fds.add(fd)
+        if self._epoll is not None:
+            self._epoll.register(fd, select.EPOLLIN)
+        elif self._poll is not None:
+            self._poll.register(fd, select.POLLIN)
+
+    def unregister(self, fd):
+        self._fds.discard(fd)
+        if self._epoll is not None:
+            self._epoll.unregister(fd)
+        elif self._poll is not None:
+            self._poll.unregister(fd)
+
+    def wait(self, timeout):
+        """Returns the registered file descriptors which become readable within timeout seconds"""
+        if self._epoll is not None:
+            return [ fd for fd, events in self._epoll.poll(timeout) ]
+        if self._poll is not None:
+            return [ fd for fd, events in self._poll.poll(timeout * 1000) ]
+        if not self._fds:
+            return []
+        readable, writable, exceptional = select.select(list(self._fds), [], [], timeout)
+        return readable
+
+    def close(self):
+        if self._epoll is not None:
+            self._epoll.close()
+
+class Fleet(object):
+    """Runs the event loops of many robots from a single thread.
+
+    Rather than dedicating a thread to each robot, blocked reading its serial
+    port, a Fleet waits on all of their ports at once (using epoll where
+    available) and only reads from the ones with data waiting. Each robot
+    still gets its own EventLoop, with its own sensors and handlers:
+
+        fleet = Fleet()
+        for device in devices:
+            robot = Roomba(device)
+            robot.start()
+            robot.safe()
+            loop = fleet.add(robot)
+            loop.set_sensors(sensors.BUMP_WHEEL_DROPS)
+            loop.on_change('bump_wheel_drops', bumped)
+        fleet.run()
+
+    Robots' serial ports must have a fileno(), as pyserial's ports do on
+    POSIX systems. Handlers for all the robots run on the fleet's thread, so
+    consider EventLoop.use_workers() if any of them are slow.
+
+    Like EventLoop, Fleet is written to be driven from one thread; add and
+    remove robots before starting it or from its own handlers."""
+    def __init__(self):
+        self._loops = {} # File descriptor -> EventLoop
+        self._poller = _Poller()
+        self.running = False
+        self._thread = None
+
+    def add(self, robot, loop = None):
+        """Adds a robot to the fleet, returning its event loop.
+
+        If no EventLoop is given a new one is created. If the fleet is
+        already running the robot starts sampling immediately."""
+        if loop is None:
+            loop = EventLoop(robot)
+        fd = robot.port.fileno()
+        self._loops[fd] = loop
+        self._poller.register(fd)
+        if self.running:
+            loop.start_sampling()
+        return loop
+
+    def remove(self, robot):
+        """Removes a robot from the fleet, stopping its sample stream"""
+        fd = robot.port.fileno()
+        loop = self._loops.pop(fd)
+        self._poller.unregister(fd)
+        if loop.running:
+            loop.running = False
+            robot.pause_stream()
+
+    def loops(self):
+        """Returns the event loops of every robot in the fleet"""
+        return self._loops.values()
+
+    def process_events(self, timeout = 0.015):
+        """Waits up to timeout seconds for data from any robot, and runs handlers for every sample received.
+
+        Returns the number of samples processed. As with EventLoop, frames
+        with bad checksums, or which can't be decoded, are counted in the
+        robot's loop's bad_frames and otherwise ignored."""
+        count = 0
+        loops = self._loops
+        for fd in self._poller.wait(timeout):
+            loop = loops.get(fd)
+            if loop is None:
+                continue
+            robot = loop.robot
+            parser = robot._parser
+            errors = parser.checksum_errors
+            frames = robot.read_frames()
+            loop.bad_frames += parser.checksum_errors - errors
+            count += len(frames)
+            if not loop.decoding():
+                continue
+            bad_frames = loop.bad_frames
+            for frame in frames:
+                loop.process_frame(frame)
+            count -= loop.bad_frames - bad_frames
+        return count
+
+    def run(self):
+        """Starts sampling on every robot, and runs the fleet in the calling thread until stop() is called."""
+        assert not self.running
+        self.running = True
+        for loop in self._loops.values():
+            loop.start_sampling()
+        while self.running:
+            self.process_events()
+
+    def start(self):
+        """Spawns off a single background thread running the whole fleet."""
+        assert not self.running
+        self._thread = Thread(target = self.run)
+        self._thread.start()
+
+    def stop(self):
+        """Stops sampling on every robot and halts the fleet.
+
+        Every robot is asked to pause at once, and their streams are then
+        drained together, so this takes one quiet period however many
+        robots there are."""
+        self.running = False
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        pending = []
+        for loop in self._loops.values():
+            loop.running = False
+            pending.append(loop.robot.pause_stream(block = False))
+        while pending:
+            pending = [ handshake for handshake in pending if not handshake.ready() ]
+            if pending:
+                self._poller.wait(0.002)
+
+    def close(self):
+        """Releases the fleet's poller; the robots are left open"""
+        self._poller.close()
@@ -0,0 +1,411 @@
+from struct import Struct
+
+__all__ = ['DecodePlan', 'Sample', 'FrameParser', 'FrameError', 'ChecksumError', 'MalformedFrameError', 'bytes_waiting']
+
+def bytes_waiting(port):
+    """Returns the number of bytes a port has ready to read, or 0 if it can't tell us"""
+    try:
+        return port.in_waiting
+    except AttributeError:
+        pass
+    try:
+        return port.inWaiting() # pyserial < 3.0
+    except AttributeError:
+        return 0
+
+def _picker(indexes):
+    """Returns a function selecting the given indexes from a tuple, always as a tuple"""
+    if len(indexes) == 1:
+        index = indexes[0]
+        return lambda values: (values[index],)
+    return lambda values: tuple([ values[i] for i in indexes ])
+
+class DecodePlan(object):
+    """A precompiled decoder for stream frames carrying a fixed packet list.
+
+    Each frame streamed by the Roomba is a series of packet IDs, each
+    followed by that packet's data. When the packet list is known in advance
+    (as it is after stream_samples()) the layout of every frame is fixed, so
+    we can describe the whole frame body with a single struct.Struct and
+    decode it in one pass instead of walking it packet by packet.
+
+    Plans are cached by packet-ID tuple, so requesting the same stream twice
+    reuses the same plan. Use DecodePlan.for_sensors() rather than
+    constructing plans directly."""
+
+    _cache = {}
+
+    def __init__(self, sensors):
+        """Compiles a plan for the given list of (id, format, name) sensors."""
+        layout = []
+        id_layout = [] # Just the IDs, with the data skipped as padding
+        names = []
+        id_index = []
+        value_index = []
+        fields = {}
+        position = 0
+        for packet, format, name in sensors:
+            layout.append('B')
+            id_layout.append('B')
+            id_index.append(position)
+            position += 1
+            if isinstance(format, list):
+                # Group packets (e.g., ALL_SCI) carry their members' data
+                # back to back with no IDs of their own
+                members = format
+            else:
+                members = [(packet, format, name)]
+            for sub_packet, sub_format, sub_name in members:
+                codec = Struct('>' + sub_format)
+                fields[sub_name] = (codec, Struct('>' + ''.join(layout)).size)
+                layout.append(sub_format)
+                id_layout.append('%dx' % codec.size)
+                names.append(sub_name)
+                value_index.append(position)
+                position += 1
+        self.ids = tuple(packet for packet, format, name in sensors)
+        self.names = tuple(names)
+        self.fields = fields # Name -> (struct, offset in the frame body)
+        self.struct = Struct('>' + ''.join(layout))
+        self.size = self.struct.size
+        self._id_struct = Struct('>' + ''.join(id_layout))
+        self._ids_of = _picker(id_index)
+        self._values_of = _picker(value_index)
+
+    @classmethod
+    def for_sensors(cls, sensors):
+        """Returns the (possibly cached) plan for a list of sensors."""
+        key = tuple(packet for packet, format, name in sensors)
+        plan = cls._cache.get(key)
+        if plan is None:
+            plan = cls._cache[key] = cls(sensors)
+        return plan
+
+    def matches(self, values):
+        """Checks that the packet IDs in an unpacked frame are the ones this plan expects"""
+        return self._ids_of(values) == self.ids
+
+    def lays_out(self, packet):
+        """Checks that a frame body (without checksum) has exactly the layout described by this plan"""
+        return len(packet) == self.size and self._id_struct.unpack_from(packet) == self.ids
+
+    def decode(self, packet, offset = 0):
+        """Decodes a frame body (without checksum) into a dictionary of readings.
+
+        Returns None if the body does not have the layout described by this
+        plan, in which case the caller should fall back to a generic decode."""
+        if len(packet) - offset < self.size:
+            return None
+        values = self.struct.unpack_from(packet, offset)
+        if not self.matches(values):
+            return None
+        return dict(zip(self.names, self._values_of(values)))
+
+    def sample(self, packet):
+        """Wraps a frame body (without checksum) in a lazily decoded Sample.
+
+        Returns None if the body does not have the layout described by this
+        plan. Only the packet IDs are checked here; values are decoded as
+        they are asked for."""
+        if not self.lays_out(packet):
+            return None
+        return Sample(self, packet.tobytes())
+
+class Sample(object):
+    """A sample from a stream frame, decoding each reading only when it's asked for.
+
+    Decoding a frame into a dictionary allocates the dictionary and every
+    value in it, which is wasted when a consumer only looks at one or two
+    sensors. A Sample instead keeps a copy of the frame body and the
+    DecodePlan describing it, and unpacks a reading on each access, by key
+    or as an attribute:
+
+        sample = robot.poll()
+        sample['voltage'] == sample.voltage
+
+    Samples support the read-only dictionary methods the rest of the
+    library uses (get(), iteritems(), len(), in and so on), and to_dict()
+    decodes every reading at once. Roomba.poll() returns them when
+    lazy_samples is set."""
+
+    __slots__ = ('_plan', '_data')
+
+    def __init__(self, plan, data):
+        self._plan = plan
+        self._data = data
+
+    def __getitem__(self, name):
+        codec, offset = self._plan.fields[name]
+        return codec.unpack_from(self._data, offset)[0]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def get(self, name, default = None):
+        field = self._plan.fields.get(name)
+        if field is None:
+            return default
+        return field[0].unpack_from(self._data, field[1])[0]
+
+    def __contains__(self, name):
+        return name in self._plan.fields
+
+    has_key = __contains__
+
+    def __len__(self):
+        return len(self._plan.names)
+
+    def __iter__(self):
+        return iter(self._plan.names)
+
+    def keys(self):
+        return list(self._plan.names)
+
+    iterkeys = __iter__
+
+    def values(self):
+        return list(self._plan._values_of(self._plan.struct.unpack(self._data)))
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def items(self):
+        return zip(self._plan.names, self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def to_dict(self):
+        """Decodes every reading, returning them as a dictionary"""
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, Sample):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None # Like a dictionary
+
+    def __repr__(self):
+        return 'Sample(%r)' % self.to_dict()
+
+class FrameError(Exception):
+    """Raised when sensor data from the Roomba can't be made sense of.
+
+    skipped is the number of bytes thrown away before good data was found
+    again."""
+    def __init__(self, message, skipped = 0):
+        super(FrameError, self).__init__(message)
+        self.skipped = skipped
+
+class ChecksumError(FrameError):
+    """Raised when a sensor frame arrives with a bad checksum"""
+    pass
+
+class MalformedFrameError(FrameError):
+    """Raised when a frame passes its checksum but can't be decoded (e.g., it names an unknown packet)"""
+    pass
+
+class FrameParser(object):
+    """Splits the byte stream coming from a Roomba into sensor frames.
+
+    Rather than reading the magic byte, the length and the body of each frame
+    with separate calls to port.read(), the parser drains everything the port
+    has waiting into a preallocated buffer in a single read and then carves
+    as many complete frames out of it as it can. At 115200 baud a single read
+    will frequently pick up more than one frame, so most calls to
+    next_frame() never touch the port at all.
+
+    Frames are returned as memoryviews into the parser's buffer, so they are
+    only valid until the next call to fill(). Copy them (e.g., with
+    tobytes()) if you need to hold on to them."""
+
+    MAGIC = b'\x13' # Every stream frame starts with a 19 (decimal)
+
+    def __init__(self, port, size = 4096):
+        """Create a parser reading from a pyserial compliant port.
+
+        The buffer size should comfortably exceed the largest frame (258
+        bytes) times the number of frames you expect to pile up while the
+        host is busy."""
+        self.port = port
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0 # First byte not yet consumed
+        self._end = 0 # One past the last byte read
+        self.frames = 0 # Good frames returned
+        self.skipped = 0 # Bytes skipped looking for the start of a frame
+        self.checksum_errors = 0
+        self._skipping = None # Bytes skipped since a bad checksum, while resynchronizing
+        self._frame_size = 0 # Size of the last good frame, magic to checksum
+
+    def _compact(self):
+        """Shuffles any partial frame back to the front of the buffer once it passes the halfway mark"""
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._end > len(self._buffer) // 2:
+            count = self._end - self._start
+            self._buffer[0:count] = self._buffer[self._start:self._end]
+            self._start, self._end = 0, count
+
+    def fill(self, block = True):
+        """Reads everything waiting on the port into the buffer.
+
+        Unless block is False this also blocks (subject to the port's
+        timeout) until the frame at the front of the buffer is complete, so
+        a reader which has caught up with the stream makes one read per
+        frame rather than one for its first byte and another for the rest.
+        With nothing buffered it waits for a frame the size of the last
+        one, as streamed frames all have the same layout. Returns the
+        number of bytes read, which is zero if the read timed out."""
+        self._compact()
+        size = len(self._buffer)
+        waiting = bytes_waiting(self.port)
+        if not (waiting or block):
+            return 0
+        if block:
+            waiting = max(waiting, self._needed())
+        wanted = min(waiting, size - self._end)
+        if wanted <= 0:
+            # The buffer is full of garbage that never formed a frame
+            self.clear()
+            wanted = min(max(bytes_waiting(self.port), 1), size)
+        data = self.port.read(wanted)
+        count = len(data)
+        self._buffer[self._end:self._end + count] = data
+        self._end += count
+        return count
+
+    def _needed(self):
+        """Returns the number of bytes still to come of the frame at the front of the buffer"""
+        start, end = self._start, self._end
+        if self._skipping is not None:
+            return 1 # Lengths can't be trusted until resynchronized
+        if start == end:
+            return self._frame_size or 1
+        if self._buffer[start] != 19:
+            return 1 # Still looking for a magic
+        if end - start < 2:
+            return max(self._frame_size - 1, 1)
+        return max(self._buffer[start + 1] + 3 - (end - start), 1)
+
+    def feed(self, data):
+        """Appends bytes received by some other means (e.g., a non-blocking socket) to the buffer.
+
+        Callers should take every complete frame with next_frame() after each
+        call. If the buffer overflows the oldest bytes are discarded."""
+        self._compact()
+        size = len(self._buffer)
+        count = len(data)
+        if count > size - self._end:
+            self.clear()
+            if count > size:
+                data = data[-size:]
+                count = size
+        self._buffer[self._end:self._end + count] = data
+        self._end += count
+
+    def next_frame(self):
+        """Returns the body of the next complete frame in the buffer or None if there isn't one yet.
+
+        The body is the series of packet IDs and values following the length
+        byte, without the checksum. Bytes preceding a frame's magic are
+        skipped.
+
+        A frame failing its checksum may not have been a frame at all: its
+        magic could be a data byte which happens to be 19, following a
+        dropped byte. So rather than throwing the frame away whole, the
+        parser steps one byte past its magic and keeps looking for a frame
+        which both passes its checksum and is followed by another magic (or
+        the end of the data), so that frames buffered behind a corrupt one
+        are never lost. Once resynchronized it raises ChecksumError, whose
+        skipped attribute says how many bytes were discarded; the next call
+        returns the good frame."""
+        frame = self.next_raw_frame()
+        if frame is None:
+            return None
+        return frame[2:-1]
+
+    def next_raw_frame(self):
+        """Returns the next complete frame in the buffer, magic, length and checksum included, or None if there isn't one yet.
+
+        Otherwise behaves exactly as next_frame()."""
+        buffer = self._buffer
+        end = self._end
+        while True:
+            start = buffer.find(self.MAGIC, self._start, end)
+            if start < 0:
+                # Nothing here looks like the start of a frame
+                self._skip(end - self._start)
+                self._start = end
+                return None
+            if start != self._start:
+                self._skip(start - self._start)
+                self._start = start
+            if end - start < 2:
+                return None
+            length = buffer[start + 1]
+            stop = start + length + 3 # Magic, length, body and checksum
+            if stop > end:
+                if self._skipping is not None and self._frame_after(start + 1, end):
+                    # While resynchronizing don't let a false start, waiting
+                    # on data which may never come, hold up real frames
+                    self._start = start + 1
+                    self._skip(1)
+                    continue
+                return None
+            # Roomba OI documentation is wrong, the checksum includes the 19 magic
+            if sum(buffer[start:stop]) & 0xff:
+                if self._skipping is None:
+                    self.checksum_errors += 1
+                    self._skipping = 0
+                self._start = start + 1
+                self._skip(1)
+                continue
+            if self._skipping is not None:
+                # Only trust a frame found while resynchronizing if the next
+                # one starts where it ends
+                if stop < end and buffer[stop] != 19:
+                    self._start = start + 1
+                    self._skip(1)
+                    continue
+                skipped, self._skipping = self._skipping, None
+                raise ChecksumError('Bad checksum while attempting to read sample; skipped %d bytes' % skipped, skipped)
+            self._start = stop
+            self._frame_size = stop - start
+            self.frames += 1
+            return self._view[start:stop]
+
+    def _frame_after(self, position, end):
+        """Checks whether a plausible frame (complete, passing its checksum and followed by another magic) starts after position"""
+        buffer = self._buffer
+        while True:
+            start = buffer.find(self.MAGIC, position, end)
+            if start < 0 or end - start < 2:
+                return False
+            stop = start + buffer[start + 1] + 3
+            if stop <= end and not sum(buffer[start:stop]) & 0xff and (stop == end or buffer[stop] == 19):
+                return True
+            position = start + 1
+
+    def _skip(self, count):
+        self.skipped += count
+        if self._skipping is not None:
+            self._skipping += count
+
+    def buffered(self):
+        """Returns the number of bytes read but not yet consumed"""
+        return self._end - self._start
+
+    def clear(self):
+        """Discards everything in the buffer"""
+        self._start = self._end = 0
+        self._skipping = None
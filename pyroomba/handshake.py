@@ -0,0 +1,207 @@
+from time import sleep
+
+from clock import monotonic
+from frames import bytes_waiting
+from sinks import FrameSink
+
+__all__ = ['Handshake', 'ModeHandshake', 'StreamModeHandshake', 'SilenceHandshake', 'HandshakeTimeout']
+
+class HandshakeTimeout(Exception):
+    """Raised when the robot doesn't confirm a mode change (or falls silent) in time"""
+    pass
+
+class Handshake(object):
+    """Waits for the robot to confirm that a mode change (or the like) has taken effect.
+
+    Roomba.start(), safe(), full(), baud() and pause_stream() used to sleep
+    for a tenth of a second apiece in the hope the robot had caught up. Now
+    they send their command and then wait on a handshake, returning as soon
+    as the robot shows it is ready (usually within a tick or two) or raising
+    HandshakeTimeout if it never does.
+
+    Pass block = False to those methods to get the handshake back instead
+    of waiting on it. ready() then never blocks, so the handshake can be
+    driven from an existing loop:
+
+        handshake = robot.safe(block = False)
+        while not handshake.ready():
+            do_something_else()
+
+    While the robot is streaming, mode changes are confirmed from the
+    stream instead, and those methods don't wait; see StreamModeHandshake.
+
+    Some handshakes become ready without the robot having confirmed
+    anything (e.g., a StreamModeHandshake on a stream without OI_MODE);
+    their confirmed attribute is False.
+
+    Subclasses implement check(blocking), returning True once the condition
+    is met."""
+
+    confirmed = True # Whether ready() means the robot confirmed the change
+
+    def __init__(self, robot, timeout = 1.0):
+        self.robot = robot
+        self.deadline = monotonic() + timeout
+        self.done = False
+
+    def ready(self):
+        """Returns whether the robot is ready yet, without blocking"""
+        return self._step(False)
+
+    def wait(self):
+        """Blocks until the robot is ready"""
+        while not self._step(True):
+            pass
+
+    def _step(self, blocking):
+        if self.done:
+            return True
+        if self.check(blocking):
+            self.done = True
+            return True
+        if monotonic() > self.deadline:
+            raise HandshakeTimeout('%s timed out' % type(self).__name__)
+        return False
+
+    def check(self, blocking):
+        raise NotImplementedError()
+
+class ModeHandshake(Handshake):
+    """Asks the robot for a sensor packet (normally OI_MODE) until its response is acceptable.
+
+    accept is called with each complete response. A query that goes
+    unanswered for retry seconds (e.g., because the robot was still waking
+    up, or changing baud rate) is sent again, as is one answered with an
+    unacceptable mode, once retry seconds have passed since the last.
+
+    Responses are read straight off the port, so this can't be used while
+    the robot is streaming: it would read stream frames as responses and
+    the responses would turn up in the stream. Roomba uses a
+    StreamModeHandshake then instead."""
+
+    RETRY = 0.020 # Comfortably more than the robot's 15ms update period
+
+    def __init__(self, robot, accept, packet = 35, size = 1, timeout = 1.0):
+        super(ModeHandshake, self).__init__(robot, timeout)
+        self.accept = accept
+        self.packet = packet
+        self.size = size
+        self._asked = None # When the outstanding query was sent
+        self._again = 0 # When the next query may be sent
+        self._response = ''
+
+    def check(self, blocking):
+        port = self.robot.port
+        now = monotonic()
+        if self._asked is not None:
+            wanted = self.size - len(self._response)
+            if blocking:
+                self._response += port.read(wanted) # Blocks for at most the port's timeout
+            else:
+                waiting = bytes_waiting(port)
+                if waiting:
+                    self._response += port.read(min(wanted, waiting))
+            if len(self._response) >= self.size:
+                response, self._response = self._response, ''
+                if self.accept(response):
+                    return True
+                # Wrong mode; give the robot time to change before asking again
+                self._again, self._asked = self._asked + self.RETRY, None
+            elif now - self._asked < self.RETRY and not blocking:
+                return False
+            else:
+                # Unanswered; ask again, discarding any partial response so
+                # a late one can't be misread
+                self._response = ''
+                port.flushInput()
+        wait = self._again - monotonic()
+        if wait > 0:
+            if not blocking:
+                return False
+            sleep(wait)
+        self.robot.send('BB', 142, self.packet)
+        self._asked = monotonic()
+        return False
+
+class _ModeSink(FrameSink):
+    """Passes the OI mode in each stream frame to a StreamModeHandshake.
+
+    Callers often ignore the handshake, so rather than wait to be removed
+    by it the sink removes itself, once the mode is seen or the
+    handshake's deadline has passed."""
+
+    passive = True
+
+    def __init__(self, handshake, plan):
+        self.handshake = handshake
+        self.plan = plan
+
+    def write_frame(self, frame, timestamp):
+        handshake = self.handshake
+        readings = self.plan.decode(frame[2:-1])
+        if readings is not None and handshake.accept(readings['oi_mode']):
+            handshake.seen = True
+        elif timestamp <= handshake.deadline:
+            return
+        handshake.robot.remove_sink(self)
+
+class StreamModeHandshake(Handshake):
+    """Confirms a mode change from the sensor stream, for use while the robot is streaming.
+
+    While a stream is running, whatever reads it (poll(), an EventLoop and
+    so on) owns the port. Querying the robot then would mean reading its
+    frames as the response, and the response would turn up in the stream
+    as garbage, so this never touches the port. Instead it watches the
+    frames as they are read, through a sink, and is ready once one reports
+    a mode accept (called with the mode number) is happy with.
+
+    That only works if the stream includes OI_MODE; if it doesn't, the
+    change can't be confirmed without pausing the stream, and the
+    handshake is ready straight away but unconfirmed (its confirmed
+    attribute is False). Since it relies on the stream being
+    read, Roomba never waits on it (block is ignored while streaming), as
+    waiting on the thread which reads the stream could never succeed."""
+
+    def __init__(self, robot, accept, timeout = 1.0):
+        super(StreamModeHandshake, self).__init__(robot, timeout)
+        self.accept = accept
+        self.seen = False
+        plans = robot._plans
+        if plans and 'oi_mode' in plans[0].fields:
+            robot.add_sink(_ModeSink(self, plans[0]))
+        else:
+            self.seen = True # Nothing in the stream to confirm it with
+            self.confirmed = False
+
+    def check(self, blocking):
+        if not self.seen and blocking:
+            sleep(0.001) # Another thread is reading the stream
+        return self.seen
+
+class SilenceHandshake(Handshake):
+    """Waits for the robot to stop sending data, discarding whatever arrives in the meantime.
+
+    Used by pause_stream(): once quiet seconds pass without a byte, the
+    stream has evidently stopped, and on_quiet is called. What arrives is
+    read through the robot's frame parser rather than straight off the
+    port, so sinks still get every complete frame sent before the pause."""
+
+    def __init__(self, robot, quiet = 0.020, timeout = 1.0, on_quiet = None):
+        super(SilenceHandshake, self).__init__(robot, timeout)
+        self.quiet = quiet
+        self.on_quiet = on_quiet
+        self._heard = monotonic()
+
+    def check(self, blocking):
+        robot = self.robot
+        parser = robot._parser
+        robot._flush_sinks() # Sinks may hold views of the buffer the fill reuses
+        if parser.fill(False) or (blocking and parser.fill(True)):
+            # A blocking fill waits up to the port's timeout
+            self._heard = robot._read_at = monotonic()
+        robot.read_frames() # Hands complete frames to the sinks, and discards them
+        if monotonic() - self._heard < self.quiet:
+            return False
+        if self.on_quiet is not None:
+            self.on_quiet()
+        return True
@@ -0,0 +1,294 @@
+import socket
+from bisect import bisect_left
+from threading import Lock
+from threading import Thread
+
+from clock import monotonic
+from sinks import FrameSink
+
+__all__ = ['Histogram', 'Metrics', 'MeteredSerial', 'MetricsExporter']
+
+class Histogram(object):
+    """A histogram of durations with fixed, logarithmically spaced buckets.
+
+    In the manner of HDR histograms, each power of two between lowest and
+    highest seconds is split into sub_buckets equal buckets, so every value
+    is recorded to within 1/sub_buckets of its true value (12.5% by default)
+    however large or small it is. Recording a value is a bisect and an
+    increment, with no allocation, so histograms can sit on hot paths."""
+
+    def __init__(self, lowest = 1e-6, highest = 10.0, sub_buckets = 8):
+        bounds = []
+        base = lowest
+        while base < highest:
+            step = base / sub_buckets
+            for i in range(1, sub_buckets + 1):
+                bounds.append(base + step * i)
+            base *= 2
+        self._bounds = bounds # Upper bound of each bucket
+        self._counts = [0] * (len(bounds) + 1) # The last bucket takes anything larger
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        self._counts[bisect_left(self._bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Returns the upper bound of the bucket holding the given percentile, or None if nothing was recorded"""
+        if not self.count:
+            return None
+        wanted = self.count * percent / 100.0
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= wanted and count:
+                if index == len(self._bounds):
+                    return self.max
+                return min(self._bounds[index], self.max)
+        return self.max
+
+    def summary(self):
+        """Returns the count, mean, extremes and common percentiles as a dictionary"""
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'p999': self.percentile(99.9),
+        }
+
+    def reset(self):
+        self._counts = [0] * len(self._counts)
+        self.count = 0
+        self.total = 0.0
+        self.min = self.max = None
+
+class MeteredSerial(object):
+    """Wraps a pyserial compliant port, timing every read and write. Set up by Roomba.instrument()."""
+    def __init__(self, port, metrics):
+        self.port = port
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+    def read(self, size = 1):
+        metrics = self._metrics
+        start = monotonic()
+        data = self.port.read(size)
+        metrics.read_latency.record(monotonic() - start)
+        metrics.bytes_read += len(data)
+        return data
+
+    def write(self, data):
+        metrics = self._metrics
+        start = monotonic()
+        result = self.port.write(data)
+        metrics.write_latency.record(monotonic() - start)
+        metrics.bytes_written += len(data)
+        return result
+
+class _FrameTimer(FrameSink):
+    """Records the spacing of frames as they are read, and counts them by the second"""
+    passive = True
+
+    def __init__(self, metrics):
+        self._metrics = metrics
+        self._last = None
+        # (second, frames read in it, frames read in the second before),
+        # replaced as a whole so readers on other threads see one or the
+        # other
+        self.window = (None, 0, 0)
+
+    def write_frame(self, frame, timestamp):
+        last = self._last
+        if timestamp != last:
+            # Only the first frame of each read counts: the rest share its
+            # timestamp, so their spacing would measure how reads are
+            # batched rather than the robot
+            self._last = timestamp
+            if last is not None:
+                self._metrics.jitter.record(abs(timestamp - last - self._metrics.cadence))
+        second, count, previous = self.window
+        now = int(timestamp)
+        if now == second:
+            self.window = (second, count + 1, previous)
+        else:
+            self.window = (now, 1, second == now - 1 and count or 0)
+
+    def rate(self, now):
+        """Frames per second over the last whole second before now"""
+        second, count, previous = self.window
+        now = int(now)
+        if second == now - 1:
+            return float(count)
+        if second == now:
+            return float(previous)
+        return 0.0
+
+class Metrics(object):
+    """Health and latency measurements for a robot's serial link and event loop.
+
+    Set up with Roomba.instrument() or EventLoop.instrument(), which hook the
+    metrics into the robot's port, frame sinks and handler dispatch; nothing
+    is measured (and nothing costs anything) until then. Measurements
+    include:
+     frames, frames_per_second: Frames received, and their rate over the
+        last whole second (so the same for every reader).
+     resync_bytes: Bytes skipped while looking for the start of a frame.
+     checksum_errors: Frames discarded for bad checksums.
+     bytes_read, bytes_written: Traffic over the serial port.
+     jitter: Histogram of how far the spacing of frames strays from the
+        robot's 15ms cadence, measured between reads: only the first frame
+        of each read is timed.
+     read_latency, write_latency: Histograms of port.read() and
+        port.write() times.
+     handlers: A histogram of execution times for each event handler.
+     gauges: Anything registered with gauge(), e.g., queue depths.
+    All durations are in seconds. snapshot() returns everything as nested
+    dictionaries; MetricsExporter serves them as plain text."""
+
+    def __init__(self, cadence = 0.015):
+        self.cadence = cadence
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.jitter = Histogram()
+        self.read_latency = Histogram()
+        self.write_latency = Histogram()
+        self.handlers = {} # Handler name -> Histogram
+        self._gauges = {} # Name -> function returning the current value
+        self._parser = None
+        self.frame_timer = _FrameTimer(self)
+        self._lock = Lock() # Guards handlers, which worker threads time
+
+    def watch(self, parser):
+        """Takes frame, resync and checksum counts from a FrameParser"""
+        self._parser = parser
+
+    def gauge(self, name, function):
+        """Registers a function whose value (e.g., a queue depth) is included in every snapshot"""
+        gauges = dict(self._gauges)
+        gauges[name] = function
+        self._gauges = gauges
+
+    def time_handler(self, action, seconds):
+        """Records one execution time of an event handler"""
+        name = getattr(action, '__name__', None) or repr(action)
+        with self._lock:
+            histogram = self.handlers.get(name)
+            if histogram is None:
+                histogram = self.handlers[name] = Histogram()
+            histogram.record(seconds)
+
+    def snapshot(self):
+        """Returns every measurement as a dictionary"""
+        parser = self._parser
+        with self._lock:
+            handlers = dict((name, histogram.summary()) for name, histogram in self.handlers.items())
+        return {
+            'frames': parser and parser.frames or 0,
+            'frames_per_second': self.frame_timer.rate(monotonic()),
+            'resync_bytes': parser and parser.skipped or 0,
+            'checksum_errors': parser and parser.checksum_errors or 0,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'jitter': self.jitter.summary(),
+            'read_latency': self.read_latency.summary(),
+            'write_latency': self.write_latency.summary(),
+            'handlers': handlers,
+            'gauges': dict((name, function()) for name, function in self._gauges.items()),
+        }
+
+    def reset(self):
+        """Clears the histograms and traffic counts (the parser's counts are left alone)"""
+        self.bytes_read = self.bytes_written = 0
+        with self._lock:
+            for histogram in [self.jitter, self.read_latency, self.write_latency] + self.handlers.values():
+                histogram.reset()
+
+def format_snapshot(snapshot, prefix = 'pyroomba'):
+    """Flattens a snapshot into "name value" lines"""
+    lines = []
+    for key in sorted(snapshot):
+        value = snapshot[key]
+        name = '%s_%s' % (prefix, key)
+        if isinstance(value, dict):
+            lines.append(format_snapshot(value, name))
+        elif value is not None:
+            lines.append('%s %s\n' % (name, value))
+    return ''.join(lines)
+
+class MetricsExporter(object):
+    """Serves snapshots of a Metrics as plain text on a local TCP port.
+
+    Each connection receives one snapshot, as "name value" lines, and is
+    then closed, so the metrics can be scraped with netcat or anything
+    similar:
+
+        exporter = MetricsExporter(loop.instrument())
+        exporter.start()
+
+        $ nc localhost 7421
+        pyroomba_checksum_errors 0
+        pyroomba_frames 5231
+        ...
+
+    The exporter only listens on the loopback interface by default."""
+
+    def __init__(self, metrics, address = ('127.0.0.1', 7421)):
+        self.metrics = metrics
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(address)
+        self._socket.listen(5)
+        self._socket.settimeout(0.1) # So stop() is noticed
+        self.address = self._socket.getsockname()
+        self.running = False
+        self._thread = None
+
+    def serve_one(self):
+        """Waits briefly for a connection and sends it a snapshot"""
+        try:
+            client, address = self._socket.accept()
+        except socket.timeout:
+            return
+        try:
+            client.sendall(format_snapshot(self.metrics.snapshot()))
+        finally:
+            client.close()
+
+    def run(self):
+        """Serves snapshots in the calling thread until stop() is called"""
+        self.running = True
+        while self.running:
+            self.serve_one()
+
+    def start(self):
+        """Spawns off a background thread serving snapshots"""
+        assert not self.running
+        self.running = True
+        self._thread = Thread(target = self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.running = False
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        """Stops serving and closes the listening socket"""
+        self.stop()
+        self._socket.close()
@@ -0,0 +1,144 @@
+from collections import deque
+from time import sleep
+
+from clock import monotonic
+from frames import bytes_waiting
+
+__all__ = ['QueryPipeline']
+
+class QueryPipeline(object):
+    """Keeps sensor queries in flight, so reading sensors isn't bound by the round trip to the robot.
+
+    Roomba.sensors() and query_list() write a request and then wait for the
+    whole response before returning, so the link sits idle while the
+    request travels to the robot and the robot gets round to answering it.
+    SCI robots (see RoombaClassic) can't stream, so that round trip is
+    what limits how often they can be sampled.
+
+    A pipeline instead queues requests and writes everything queued in a
+    single write, and hands back responses in the order they were
+    requested, so the next request can already be on its way while the
+    last response is being decoded:
+
+        pipeline = QueryPipeline(robot)
+        pipeline.sensors(ALL_SCI)
+        while True:
+            pipeline.sensors(ALL_SCI) # Asked for before the last one's read
+            readings = pipeline.read()
+            ...
+
+    Responses carry nothing to identify them, so they can only be matched
+    to requests by counting bytes. If a response doesn't arrive in time the
+    robot must have missed a request (or bytes were lost), so every
+    request still in flight is abandoned (and counted in self.lost), late
+    bytes are drained from the port, and read() returns None; queue more
+    requests and carry on. A request for a packet the robot doesn't have
+    goes unanswered without any such delay, throwing the count off, so
+    only ask for packets the robot supports.
+
+    The robot's tracers (see Roomba.add_tracer()) see each request as a
+    query: before_query() when it is written and after_query() when its
+    response is read, or with however much of it had arrived when it is
+    abandoned.
+
+    Like the robot, a pipeline shouldn't be used from more than one thread
+    at a time."""
+
+    DRAIN = 0.015 # Seconds spent discarding late bytes after abandoning requests
+
+    def __init__(self, robot):
+        self.robot = robot
+        self.lost = 0 # Requests abandoned without a response
+        self._unsent = [] # Request bytes waiting for flush()
+        self._expected = deque() # (sensors, response size) of each request written, oldest first
+        self._queued = [] # (sensors, response size) of each request not yet written
+        self._response = ''
+
+    @property
+    def in_flight(self):
+        """The number of requests waiting for a response, including those not yet written"""
+        return len(self._expected) + len(self._queued)
+
+    def sensors(self, sensor):
+        """Queues a request for a single sensor packet (opcode 142), the only kind SCI robots understand"""
+        self._unsent += [142, sensor.id]
+        self._queued.append(([sensor], sensor.size))
+
+    def query_list(self, *sensors):
+        """Queues a request for a list of sensors (opcode 149)"""
+        self._unsent += [149, len(sensors)] + [ sensor.id for sensor in sensors ]
+        self._queued.append((sensors, sum(sensor.size for sensor in sensors)))
+
+    def flush(self):
+        """Writes every queued request to the robot in one go. read() calls this for you."""
+        if not self._unsent:
+            return
+        data, self._unsent = self._unsent, []
+        queued, self._queued = self._queued, []
+        self._expected.extend(queued)
+        tracers = self.robot._tracers
+        if tracers:
+            now = monotonic()
+            for sensors, size in queued:
+                ids = tuple(sensor.id for sensor in sensors)
+                for tracer in tracers:
+                    tracer.before_query(self.robot, ids, now)
+        self.robot.send('B' * len(data), *data)
+
+    def read(self, block = True):
+        """Returns the readings in the response to the oldest request, as a dictionary.
+
+        Returns None if there are no requests in flight, or if block is
+        False and the response hasn't fully arrived yet; a partial response
+        is kept for the next call. With block set, waits for up to the
+        port's timeout."""
+        self.flush()
+        if not self._expected:
+            return None
+        sensors, size = self._expected[0]
+        port = self.robot.port
+        wanted = size - len(self._response)
+        if block:
+            self._response += port.read(wanted)
+        else:
+            waiting = bytes_waiting(port)
+            if waiting:
+                self._response += port.read(min(wanted, waiting))
+        if len(self._response) < size:
+            if block:
+                self._abandon()
+            return None
+        response, self._response = self._response, ''
+        self._expected.popleft()
+        self._traced(sensors, size)
+        return self.robot._unpack_sensor_list(sensors, response)
+
+    def _traced(self, sensors, size):
+        """Tells the robot's tracers a request is finished with, having read size bytes of response"""
+        tracers = self.robot._tracers
+        if tracers:
+            ids = tuple(sensor.id for sensor in sensors)
+            now = monotonic()
+            for tracer in tracers:
+                tracer.after_query(self.robot, ids, size, now)
+
+    def _abandon(self):
+        """Gives up on every written request, discarding anything that turns up for them"""
+        self.lost += len(self._expected)
+        received = len(self._response) # Only the oldest request can have had any of its response
+        for sensors, size in self._expected:
+            self._traced(sensors, received)
+            received = 0
+        self._expected.clear()
+        self._response = ''
+        port = self.robot.port
+        port.flushInput()
+        # Stragglers still on their way are due within a tick. Don't wait on
+        # the port for them: if it's streaming it never goes quiet.
+        deadline = monotonic() + self.DRAIN
+        while monotonic() < deadline:
+            waiting = bytes_waiting(port)
+            if waiting:
+                port.read(waiting)
+            else:
+                sleep(0.001)
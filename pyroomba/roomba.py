@@ -5,12 +5,27 @@ except ImportError:
     print "Unable to import serial library -- unless you are running tests this will not work"
 from struct import pack
 from struct import unpack
-from struct import calcsize
-from time import sleep
-from time import time
+from struct import error as struct_error
 from math import *
 
 import sensors as sensor_list
+from frames import DecodePlan
+from frames import FrameParser
+from frames import ChecksumError
+from frames import MalformedFrameError
+from capture import CaptureSerial
+from commands import CommandShadow
+from clock import monotonic
+from metrics import Metrics
+from metrics import MeteredSerial
+from tracing import TraceSink
+from tracing import frame_ids
+from tracing import response_size
+from handshake import ModeHandshake
+from handshake import StreamModeHandshake
+from handshake import SilenceHandshake
+from pipeline import QueryPipeline
+from scheduler import TickScheduler
 
 __all__ = [ 'Roomba', 'RoombaClassic' ]
 
@@ -22,34 +37,13 @@ def sign(x):
         return -1
     return 0
 
-class Roomba(object):
-    """A Roomba robot instance.
-    
-    A convenient wrapper around the Roomba 500 Open Interface protocol giving
-    names to all of the Roomba's various commands. Most of the function names
-    map directly to the command names provided in the protocol docs. Where
-    names in the documentation were ambiguous some effort has been made to
-    clarify. Most importantly, the methods in this class are defined in the
-    order they are presented in the documentation. Thus if you find a command
-    you know the Roomba supports missing you can, in the worst case, locate it
-    by its position in the class definition.
+class RoombaBase(object):
+    """The commands, sensor decoding and instrumentation shared by Roomba and AsyncRoomba.
     
-    Taking control of an attached Roomba should look something like the
-    following:
-    
-        from pyroomba import Roomba
-        roomba = Roomba('/dev/tty.roomba')
-        roomba.start()
-        roomba.safe()
-    
-    At this point you have full control over the robot, subject to safety
-    considerations (e.g., the robot will not drive itself off a cliff). Unless
-    you have a good reason to do otherwise, this is the recommended mode of
-    operation.
-    
-    Once you are done with the robot is is recommended (although not strictly
-    necessary) that you call close() to free up the serial port.
-    """
+    Everything here either writes to the robot or handles data already
+    read from it; reading the robot (poll(), run() and the like) is left to
+    the subclasses, since Roomba does it with blocking reads and AsyncRoomba
+    from an asyncore channel. See Roomba for the details."""
     
     BAUD_RATES = {
         300: 0,
@@ -66,6 +60,9 @@ class Roomba(object):
         115200: 11
     }
     
+    # OI_MODE values
+    OFF, PASSIVE, SAFE, FULL = MODES = (0, 1, 2, 3)
+    
     def __init__(self, port, baud = 115200, timeout = 0.030, serial_port = None):
         """Instantiate a new Roomba on a given port at a given speed.
         
@@ -76,6 +73,22 @@ class Roomba(object):
             This defaults to 115200 which should be correct for 500 series
             robots. Ealier models communicated at 57600."""
         self._running = False
+        self._plans = () # Decode plans for the current sample stream and the one before it, if any
+        self.streaming = False # Whether the robot has been asked to stream (and not to pause)
+        self._commands = None # CommandShadow, if commands are being buffered
+        self.frame_errors = 'raise' # Or 'drop'; see poll()
+        self.lazy_samples = False # Whether poll() returns Samples rather than dictionaries
+        self._sinks = () # Raw frame sinks, see add_sink()
+        self.forwarding = False # Whether any sink wants the raw stream, rather than just observing it
+        self.metrics = None
+        self._tracers = () # See add_tracer()
+        self._trace_sink = None
+        self._capture = None # The CaptureSerial set up by capture(), somewhere in the chain of ports
+        self._frame_traced = False # Whether tracers have been told a frame's decoding began, and not yet that it ended
+        self.deferred_frame_end = False # Set by an EventLoop tracing the robot, which ends frame traces once handlers have run
+        self._read_at = 0 # When the bytes in the parser's buffer were read, if there are sinks
+        self.scheduler = TickScheduler() # Paces run()
+        self.latest = {} # The last readings taken by run()
         if not serial_port:
             self.port = Serial(port, baudrate = baud, timeout = timeout) # Anything we ask the robot to do it should reply within 0.015 seconds. We give it a buffer of twice that.
         else:
@@ -83,51 +96,163 @@ class Roomba(object):
             # you have a pyserial compliant class for communicating over some
             # other medium. Mostly it needs to support blocking reads and
             # writes, as well as .flushInput()
+        self._parser = FrameParser(self.port)
     
     # Action commands (i.e., commands that make the Roomba do things)
     def send(self, format, *args):
         """Send a command to the robot. 
         
-        This is basically a wrapper around self.port.write and struct.pack"""
-        self.port.write(pack(format, *args))
+        This is basically a wrapper around self.port.write and struct.pack.
+        If buffer_commands() has been called state-setting commands are held
+        until the next flush_commands() instead."""
+        data = pack(format, *args)
+        if self._tracers:
+            self._traced_send(data)
+            return
+        commands = self._commands
+        if commands is not None:
+            data = commands.queue(data)
+            if not data:
+                return
+        self._write(data)
+    
+    def _write(self, data):
+        """Writes packed commands to the robot, once any buffering and tracing is done"""
+        self.port.write(data)
+    
+    def _traced_send(self, data, flushing = False):
+        """send() (or a flush of held commands), with tracers called around it"""
+        opcode = ord(data[0])
+        tracers = self._tracers
+        now = monotonic()
+        for tracer in tracers:
+            tracer.before_send(self, opcode, len(data), now)
+        commands = self._commands
+        if commands is not None and not flushing:
+            data = commands.queue(data)
+        if data:
+            self._write(data)
+        now = monotonic()
+        for tracer in tracers:
+            tracer.after_send(self, opcode, len(data), now)
+    
+    def add_tracer(self, tracer):
+        """Registers a Tracer to be called around every command sent, every stream frame received and every sensor query.
+        
+        See Tracer (and TraceRecorder) for the details."""
+        self._tracers += (tracer,)
+        if self._trace_sink is None:
+            self._trace_sink = TraceSink(self)
+            self.add_sink(self._trace_sink)
+    
+    def remove_tracer(self, tracer):
+        """Unregisters a Tracer"""
+        self._tracers = tuple(t for t in self._tracers if t is not tracer)
+        if not self._tracers and self._trace_sink is not None:
+            self.remove_sink(self._trace_sink)
+            self._trace_sink = None
+    
+    def buffer_commands(self, enabled = True):
+        """Turns coalescing of state-setting commands on or off.
+        
+        When enabled, commands such as drive(), drive_direct(), motors() and
+        leds() are held until flush_commands() is called, keeping only the
+        latest of each kind, and are dropped entirely if they would not
+        change what the robot was last told. This keeps controllers which
+        issue commands faster than the robot's 15ms update rate from
+        starving the sensor stream, particularly on 57600 baud robots.
+        EventLoop and run() flush once per tick; use send_now() (or call
+        flush_commands() yourself) when a command, such as stopping, must go
+        out immediately. See CommandShadow for details."""
+        self.flush_commands()
+        self._commands = enabled and CommandShadow() or None
+    
+    def send_now(self, format, *args):
+        """Sends a command to the robot straight away, even if buffer_commands() would hold it.
+        
+        Anything already held goes out first, in the same write, so the
+        robot sees commands in the order they were issued:
+        
+            robot.send_now('>Bhh', 145, 0, 0) # Stop, now"""
+        data = pack(format, *args)
+        commands = self._commands
+        if commands is not None:
+            data = commands.immediate(data)
+        if self._tracers:
+            self._traced_send(data, True)
+        else:
+            self._write(data)
+    
+    def flush_commands(self):
+        """Writes any commands held by buffer_commands() in a single write"""
+        commands = self._commands
+        if commands is not None:
+            data = commands.flush()
+            if data:
+                if self._tracers:
+                    self._traced_send(data, True)
+                else:
+                    self._write(data)
     
     def cmd(self, byte):
         """Convenience method to send a single byte command to the robot."""
         self.send('B', byte)
         
-    def baud(self, baud_rate):
-        """Changes the baudrate at which the Roomba communicates"""
+    def _handshake(self, modes, block, timeout):
+        """Waits (if block is set) for the robot to report one of the given OI modes, returning the handshake.
+        
+        While the robot is streaming the mode can only be confirmed from
+        the stream, and only by whatever is reading it, so the handshake is
+        returned without waiting; see StreamModeHandshake."""
+        if self.streaming:
+            return StreamModeHandshake(self, lambda mode: mode in modes, timeout = timeout)
+        handshake = ModeHandshake(self, lambda response: ord(response) in modes, timeout = timeout)
+        if block:
+            handshake.wait()
+        return handshake
+    
+    def baud(self, baud_rate, block = True, timeout = 1.0):
+        """Changes the baudrate at which the Roomba communicates.
+        
+        Returns once the robot answers at the new rate. See Handshake for
+        block and timeout."""
         if not baud_rate in self.BAUD_RATES:
-            raise 'Invalid baud rate specified'
-        self.send('BB', 128, self.BAUD_RATES[baud_rate])
-        sleep(0.1)
+            raise ValueError('Invalid baud rate specified')
+        self.send('BB', 129, self.BAUD_RATES[baud_rate])
+        flush = getattr(self.port, 'flush', None)
+        if flush is not None:
+            flush() # The command must go out at the old rate
         self.port.setBaudrate(baud_rate)
-        sleep(0.1)
+        self.port.flushInput() # Anything received mid-change is garbage
+        self._parser.clear()
+        return self._handshake(self.MODES, block, timeout)
     
-    def start(self):
-        """Start controlling the robot; wait for a tenth of a second to allow the Roomba to change modes"""
+    def start(self, block = True, timeout = 1.0):
+        """Start controlling the robot, returning once the Roomba has changed modes.
+        
+        See Handshake for block and timeout."""
         self.cmd(128)
-        sleep(0.1)  
         self.cmd(130) # Necessary for SCI robots (no harm on OI?)
-        sleep(0.1)
+        return self._handshake(self.MODES[1:], block, timeout)
     
-    def safe(self):
-        """Put the robot into safe mode; wait for a tenth of a second to allow the Roomba to change modes. 
+    def safe(self, block = True, timeout = 1.0):
+        """Put the robot into safe mode, returning once the Roomba has changed modes.
         
         Safe mode allows full control of the robot but leaves cliff-detection
         sensors and the like enabled. This is intended to prevent most forms
-        of unintentional or intentional robot doom."""
+        of unintentional or intentional robot doom. See Handshake for block
+        and timeout."""
         self.cmd(131)
-        sleep(0.1)
+        return self._handshake((self.SAFE,), block, timeout)
     
-    def full(self):
-        """Take full control of the robot; wait for a tenth of a second to allow the Roomba to change modes.
+    def full(self, block = True, timeout = 1.0):
+        """Take full control of the robot, returning once the Roomba has changed modes.
         
         Full control mode disables all of the Roomba's self-preservation
         features. In full mode the robot will be perfectly happy to burn out
-        its motors or run off a cliff."""
+        its motors or run off a cliff. See Handshake for block and timeout."""
         self.cmd(132)
-        sleep(0.1)
+        return self._handshake((self.FULL,), block, timeout)
     
     def clean(self):
         """Start a standard cleaning cycle"""
@@ -294,40 +419,56 @@ class Roomba(object):
         """Plays one of the already stored Roomba songs"""
         self.send('BB', 141, number)
     
+    def _sensor_list_format(self, sensors):
+        """Returns the struct format of the response to a request for a list of sensors"""
+        return '>' + ''.join([ sensor.struct.format[1:] for sensor in sensors ])
+    
     def _read_sensor_list(self, sensors):
         """Reads a list of sensor values and returns the associated dictionary"""
-        #packet_list = [ packet for packet, format, name in sensors ]
-        formats = [ format for packet, format, name in sensors ]
-        names = [ name for packet, format, name in sensors ]
-        
-        response_format = '>' + ''.join(formats)
-        response = self.port.read(calcsize(response_format))
-        values = unpack(response_format, response)
+        response = self.port.read(sum(sensor.size for sensor in sensors))
+        return self._unpack_sensor_list(sensors, response)
+    
+    def _unpack_sensor_list(self, sensors, response):
+        """Unpacks the response to a request for a list of sensors into the associated dictionary"""
+        names = [ name for sensor in sensors for name in sensor.names ]
+        values = unpack(self._sensor_list_format(sensors), response)
         return dict(zip(names, values))
     
     # Data commands (i.e., getting information out of the Roomba)
     def sensors(self, sensor):
         """Request a single sensor packet"""
         sensor_id, format, name = sensor
-        self.send('BB', 142, sensor_id)
-        # It's ugly to check for things like this
-        if isinstance(format, str):
-            format = '>' + format
-            return self.port.read(calcsize(format))
-        elif isinstance(format, list):
+        response = self._query((sensor,), 'BB', 142, sensor_id)
+        if isinstance(format, list):
             # Some packets return a list of results (particularly on SCI robots)
-            return self._read_sensor_list(format)
-        else:
-            raise 'Unknown sensor format type'
+            return self._unpack_sensor_list(format, response)
+        return response
     
     def query_list(self, *sensors):
         """Takes a blocking sample of a collection of Roomba's sensors, specified using the constants defined in this module"""
         packet_list = [ packet for packet, format, name in sensors ]
         count = len(packet_list)
         format = 'BB' + 'B' * count
-        self.send(format, 149, count, *packet_list)
-        
-        return self._read_sensor_list(sensors)
+        response = self._query(sensors, format, 149, count, *packet_list)
+        return self._unpack_sensor_list(sensors, response)
+    
+    def _query(self, sensors, format, *args):
+        """Sends a query and reads its response, with tracers (if any) called around it"""
+        size = response_size(sensors)
+        tracers = self._tracers
+        if not tracers:
+            self.send(format, *args)
+            return self.port.read(size)
+        ids = tuple(packet for packet, format, name in sensors)
+        now = monotonic()
+        for tracer in tracers:
+            tracer.before_query(self, ids, now)
+        self.send(format, *args)
+        response = self.port.read(size)
+        now = monotonic()
+        for tracer in tracers:
+            tracer.after_query(self, ids, len(response), now) # Short if the port timed out
+        return response
     
     def stream_samples(self, *sensors):
         """Starts streaming sensor data from the Roomba at a rate of one reading every 15ms (the Roomba's internal update rate).
@@ -335,50 +476,298 @@ class Roomba(object):
         After this method has executed you should call poll() at least once
         every 15ms to access the returned sensor data. To halt the stream call
         stream_pause(). To result the stream with the same packet list call
-        stream_resume()."""
+        stream_resume().
+        
+        To change which sensors are streamed just call this again; there's
+        no need to pause the stream first, and no frames are lost. Frames
+        of the old layout still in flight decode as before: the previous
+        decode plan is kept alongside the new one, the pair being swapped in
+        a single assignment so a poll() on another thread sees one or the
+        other, never a mixture."""
         packet_list = [ packet for packet, format, name in sensors ]
         count = len(packet_list)
         format = 'BB' + ('B' * count)
+        plan = DecodePlan.for_sensors(sensors)
+        plans = self._plans
+        if plans and plans[0] is not plan:
+            self._plans = (plan, plans[0])
+        elif not plans:
+            self._plans = (plan,)
         self.send(format, 148, count, *packet_list)
+        self.streaming = True
     
-    def pause_stream(self):
-        """Pauses the sample stream (if any) coming from the Roomba"""
-        self.send('BB', 150, 0)
-        sleep(0.1)
-        self.port.flushInput()
+    def pause_stream(self, block = True, timeout = 1.0):
+        """Pauses the sample stream (if any) coming from the Roomba.
         
+        Returns once the robot has stopped sending data, discarding anything
+        received in the meantime. See Handshake for block and timeout."""
+        self.send('BB', 150, 0)
+        self.streaming = False
+        handshake = SilenceHandshake(self, timeout = timeout, on_quiet = self._stream_paused)
+        if block:
+            handshake.wait()
+        return handshake
+    
+    def _stream_paused(self):
+        self._flush_sinks()
+        self._parser.clear()
     
     def resume_stream(self):
         """Resumes the sample stream with the previously requested set of sensors"""
         self.send('BB', 150, 1)
+        self.streaming = bool(self._plans)
     
-    def poll(self):
-        """Reads a single sample from the current sample stream."""
-        # Samples always start with a 19 (decimal) followed by a byte indicating the length of the message
-        magic = ord(self.port.read())
-        while magic <> 19:
-            # We're out of sync. Read until we get our magic (which might
-            # occur mid-packet, so we may not resync, but in that case the
-            # checksum should be bad and we'll ditch everything, we hope.)
-            magic = ord(self.port.read())
-        length = ord(self.port.read()) + 1 # Bytes left to read (plus checksum)
-        packet = self.port.read(length)
-        # Roomba OI documentaiton is wrong, Checksum includes 19 magic (-1 for extra length byte)
-        if (sum(unpack('B' * length, packet), length + 18) & 0xff) <> 0:
-            # Bad checksum. Ditch everything in the input buffer
-            self.port.flushInput()
-            raise (-1, 'Bad checksum while attempting to read sample') # Should maybe add autoretry option?
-        packet = packet[0:-1] # Strip off checksum
+    def add_sink(self, sink):
+        """Passes every valid frame received from the robot to a FrameSink, before any decoding.
+        
+        Sinks see the raw frames as memoryviews into the receive buffer, so
+        forwarding or logging the stream costs no copies and no decoding.
+        Sinks are flushed before each read of the serial port, so batching
+        sinks (e.g., SocketSink) write everything from one read at once. Use
+        next_frame() or read_frames() rather than poll() if nothing else
+        needs the decoded values."""
+        self._sinks += (sink,) # Replaced, not modified, as with EventLoop handlers
+        self.forwarding = self.forwarding or not sink.passive
+    
+    def remove_sink(self, sink):
+        """Stops passing frames to a sink, flushing it"""
+        self._sinks = tuple(s for s in self._sinks if s is not sink)
+        self.forwarding = any(not s.passive for s in self._sinks)
+        sink.flush()
+    
+    def _flush_sinks(self):
+        for sink in self._sinks:
+            sink.flush()
+    
+    def _decode_frame(self, packet):
+        """Decodes the body of a stream frame into a dictionary of readings (or a Sample; see poll())"""
+        for plan in self._plans:
+            if len(packet) == plan.size:
+                if self.lazy_samples:
+                    sample = plan.sample(packet)
+                    if sample is not None:
+                        return sample
+                    continue
+                # Fast path: the frame is the size we asked for (now or
+                # before the last stream_samples()), so decode it in one go.
+                # If the packet IDs don't line up we fall through to the
+                # generic walk below.
+                readings = plan.decode(packet)
+                if readings is not None:
+                    return readings
+        packet = packet.tobytes()
+        by_id = sensor_list.SENSOR_BY_ID
         readings = {}
-        while len(packet) <> 0:
-            sensor_id = ord(packet[0])
-            id, format, name = sensor_list.SENSOR_ID_MAP[sensor_id]
-            size = calcsize(format)
-            value = unpack(format, packet[1:1+size])
-            readings[name] = value[0]
-            packet = packet[1+size:]
+        offset = 0
+        try:
+            while offset < len(packet):
+                sensor = by_id[ord(packet[offset])]
+                if sensor is None:
+                    raise MalformedFrameError('Sensor frame with unknown packet %d' % ord(packet[offset]))
+                offset = sensor.unpack_into(readings, packet, offset + 1)
+        except (IndexError, struct_error):
+            raise MalformedFrameError('Sensor frame with unknown packets or truncated data')
         return readings
         
+    def _traced_decode(self, packet):
+        """_decode_frame(), with tracers called around it.
+        
+        While deferred_frame_end is set, tracers are only told the frame is
+        done here if it fails to decode; otherwise whoever dispatches the
+        readings calls _end_frame() once they have."""
+        self._end_frame() # In case the last frame's readings were never dispatched
+        now = monotonic()
+        ids = frame_ids(self, packet)
+        for tracer in self._tracers:
+            tracer.before_frame(self, ids, len(packet) + 3, now)
+        self._frame_traced = True
+        try:
+            readings = self._decode_frame(packet)
+        except MalformedFrameError:
+            self._end_frame()
+            raise
+        if not self.deferred_frame_end:
+            self._end_frame()
+        return readings
+    
+    def _end_frame(self):
+        """Tells tracers the frame whose decoding was last traced is done with, if they haven't been told already"""
+        if not self._frame_traced:
+            return
+        self._frame_traced = False
+        now = monotonic()
+        for tracer in self._tracers:
+            tracer.after_frame(self, now)
+    
+    def instrument(self, metrics = None):
+        """Starts measuring the health of the serial link, returning the Metrics (see Metrics).
+        
+        Reads and writes are timed by wrapping the port, and frame spacing
+        is measured by a passive sink; until this is called none of it costs
+        anything."""
+        if self.metrics is not None:
+            return self.metrics
+        self.metrics = metrics = metrics or Metrics()
+        self.port = MeteredSerial(self.port, metrics)
+        self._parser.port = self.port
+        metrics.watch(self._parser)
+        metrics.gauge('receive_buffer', self._parser.buffered)
+        metrics.gauge('run_overruns', lambda: self.scheduler.overruns)
+        self.add_sink(metrics.frame_timer)
+        return metrics
+    
+    def capture(self, path):
+        """Starts logging every byte received from the robot to a capture file.
+        
+        The capture can later be played back by passing a ReplaySerial as the
+        serial_port of a new Roomba."""
+        self.stop_capture()
+        self.port = self._capture = CaptureSerial(self.port, path)
+        self._parser.port = self.port
+    
+    def stop_capture(self):
+        """Stops logging received bytes, if capture() was called.
+        
+        The capture is taken out of the chain of ports even if something
+        (e.g., instrument()) has wrapped it since."""
+        capture = self._capture
+        if capture is None:
+            return
+        self._capture = None
+        capture.close_capture()
+        if self.port is capture:
+            self.port = self._parser.port = capture.port
+            return
+        wrapper = self.port
+        while wrapper.port is not capture:
+            wrapper = wrapper.port
+        wrapper.port = capture.port
+
+class Roomba(RoombaBase):
+    """A Roomba robot instance.
+    
+    A convenient wrapper around the Roomba 500 Open Interface protocol giving
+    names to all of the Roomba's various commands. Most of the function names
+    map directly to the command names provided in the protocol docs. Where
+    names in the documentation were ambiguous some effort has been made to
+    clarify. Most importantly, the commands (defined in RoombaBase, which
+    this shares with AsyncRoomba) are defined in the order they are
+    presented in the documentation. Thus if you find a command you know the
+    Roomba supports missing you can, in the worst case, locate it by its
+    position in the class definition.
+    
+    Taking control of an attached Roomba should look something like the
+    following:
+    
+        from pyroomba import Roomba
+        roomba = Roomba('/dev/tty.roomba')
+        roomba.start()
+        roomba.safe()
+    
+    At this point you have full control over the robot, subject to safety
+    considerations (e.g., the robot will not drive itself off a cliff). Unless
+    you have a good reason to do otherwise, this is the recommended mode of
+    operation.
+    
+    Once you are done with the robot is is recommended (although not strictly
+    necessary) that you call close() to free up the serial port.
+    """
+    
+    # Reading the sample stream
+    def poll(self):
+        """Reads a single sample from the current sample stream.
+        
+        Everything waiting on the serial port is read in one go, so samples
+        which arrived together are buffered and returned by subsequent calls
+        without touching the port again. Returns None if no complete sample
+        arrived before the port timed out.
+        
+        Frames which fail their checksum or can't be decoded are dealt with
+        according to self.frame_errors. With 'raise' (the default) a
+        ChecksumError or MalformedFrameError is raised; with 'drop' the
+        frame is skipped silently, though still counted by the parser. Either
+        way the stream is resynchronized without losing any good frames
+        received since, so calling poll() again simply carries on.
+        
+        With self.lazy_samples set, samples laid out as requested by
+        stream_samples() are returned as Sample objects, which only decode
+        the readings actually looked at; any other frame is still decoded
+        into a dictionary."""
+        while True:
+            packet = self.next_frame()
+            if packet is None:
+                return None
+            try:
+                if self._tracers:
+                    return self._traced_decode(packet)
+                return self._decode_frame(packet)
+            except MalformedFrameError:
+                if self.frame_errors != 'drop':
+                    raise
+    
+    def next_frame(self):
+        """Reads a single frame from the current sample stream without decoding it.
+        
+        Returns the frame body (packet IDs and values) as a memoryview, only
+        valid until the next read, or None if the port timed out. The frame
+        is passed to every sink (see add_sink()) on the way. Bad checksums
+        are dealt with as for poll()."""
+        parser = self._parser
+        while True:
+            try:
+                frame = parser.next_raw_frame()
+            except ChecksumError:
+                if self.frame_errors != 'drop':
+                    raise
+                continue # The parser has already resynchronized
+            if frame is not None:
+                break
+            if self._sinks:
+                self._flush_sinks()
+            if not parser.fill():
+                return None
+            if self._sinks:
+                self._read_at = monotonic()
+        for sink in self._sinks:
+            sink.write_frame(frame, self._read_at)
+        return frame[2:-1]
+    
+    def read_samples(self):
+        """Reads everything waiting on the serial port and returns a list of every complete sample, without blocking.
+        
+        This is intended for callers multiplexing many robots with select()
+        or similar, once the port has been reported readable. Samples with
+        bad checksums, or which can't be decoded, are skipped."""
+        samples = []
+        decode = self._tracers and self._traced_decode or self._decode_frame
+        for packet in self.read_frames():
+            try:
+                samples.append(decode(packet))
+            except MalformedFrameError:
+                pass
+        return samples
+    
+    def read_frames(self):
+        """As read_samples(), but returns the frame bodies undecoded.
+        
+        The frames are memoryviews, only valid until the next read."""
+        parser = self._parser
+        sinks = self._sinks
+        self._flush_sinks()
+        if parser.fill(False) and sinks:
+            self._read_at = monotonic()
+        frames = []
+        while True:
+            try:
+                frame = parser.next_raw_frame()
+            except ChecksumError:
+                continue # The parser has already resynchronized; carry on
+            if frame is None:
+                return frames
+            for sink in sinks:
+                sink.write_frame(frame, self._read_at)
+            frames.append(frame[2:-1])
+    
     # Cleaup and shut down
     def close(self):
         """Closes the serial port used to control the Roomba"""
@@ -386,20 +775,41 @@ class Roomba(object):
         self.port.close()
     
     # The simplest of polling run-loops, perfect for SCI robots
-    def run(self, sensors = sensor_list.ALL_SCI, idle_func = None):
-        """Polls the robot at most once every 15ms, updating stored sensor data and optionally calling an idle function"""
+    def run(self, sensors = sensor_list.ALL_SCI, idle_func = None, depth = 1):
+        """Polls the robot once every 15ms, updating stored sensor data and optionally calling an idle function.
+        
+        By default every query waits out its own round trip. Pass depth > 1
+        to pipeline them instead (see QueryPipeline): depth requests are
+        then kept in flight, so each response is read while the next
+        request is already on its way, which is worth doing on SCI robots
+        that can't stream.
+        
+        Ticks keep to deadlines set by self.scheduler (see TickScheduler),
+        whatever the work in each one takes, with idle_func and any other
+        idle functions registered with the scheduler run in the slack."""
         if self._running:
             return
         self._running = True
-        while self._running:
-            start = time()
-            self.latest = self.sensors(sensors)
+        pipeline = QueryPipeline(self)
+        scheduler = self.scheduler
+        if idle_func:
+            scheduler.add_idle(idle_func)
+        try:
+            scheduler.start()
+            while self._running:
+                while pipeline.in_flight < depth:
+                    pipeline.sensors(sensors)
+                readings = pipeline.read()
+                if readings is not None:
+                    self.latest = readings
+                scheduler.idle()
+                self.flush_commands()
+                scheduler.wait()
+        finally:
             if idle_func:
-                idle_func()
-            stop = time()
-            remaining = 0.015 - (start - stop)
-            if remaining > 0:
-                sleep(remaining)
+                scheduler.remove_idle(idle_func)
+            while pipeline.in_flight:
+                pipeline.read() # Leaves no responses on the port for later queries
     
     def stop(self):
         """Signals the built-in polling run-loop to stop if it is running"""
@@ -414,9 +824,16 @@ class RoombaClassic(Roomba):
     methods to be used with older models.
     """
     def __init__(self, port, baud = 57600, serial_port = None):
-        super(RoombaClassic, self).__init__(port, baud, serial_port)
+        super(RoombaClassic, self).__init__(port, baud, serial_port = serial_port)
         self._radius = 258.0 / 2
     
+    def _handshake(self, modes, block, timeout):
+        """SCI robots can't report their mode, so settle for any answer to a query for all sensors"""
+        handshake = ModeHandshake(self, lambda response: True, packet = sensor_list.ALL_SCI.id, size = sensor_list.ALL_SCI.size, timeout = timeout)
+        if block:
+            handshake.wait()
+        return handshake
+    
     def drive_direct(self, right, left):
         """Converts direct motor drive commands into radius/speed commands"""
         if left == right:
@@ -1,6 +1,11 @@
 from math import *
 
-__all__ = ['RoombaDynamics']
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ['RoombaDynamics', 'PoseIntegrator']
 
 class RoombaDynamics(object):
     """Model of the dynamics of the Roomba's motion using direct encoder values.
@@ -28,18 +33,14 @@ class RoombaDynamics(object):
         self.reset()
     
     def normalize(self, encoders):
-        """Normalizes encoder values to deltas"""
+        """Normalizes encoder values to deltas.
+        
+        Counts are taken to have moved by less than half the 16-bit range
+        since the last reading, in either direction, so rollover is handled
+        when driving backwards as well as forwards."""
         priors = self.prior_values
         self.prior_values = encoders
-        # Now some code to handle rollover
-        left, right = encoders
-        o_left, o_right = priors
-        if o_left > left:
-            o_left -= 65536
-        if o_right > right:
-            o_right -= 65536
-        priors = (o_left, o_right)
-        return tuple(self.encoder_ratio * (a - b) for a, b in zip(encoders, priors))
+        return tuple(self.encoder_ratio * ((a - b + 0x8000) % 0x10000 - 0x8000) for a, b in zip(encoders, priors))
     
     def initialize_priors(self, encoders):
         """Initialize the prior encoder values -- identical to normalizing once and discarding the result"""
@@ -67,7 +68,12 @@ class RoombaDynamics(object):
         left, right = encoders
         v_left, v_right = left / time, right / time
         if left == right:
-            return (left / time, 0.0)
+            # No pivot; the robot moves straight ahead (which, with the angle
+            # measured from the axle, is clockwise of it)
+            t = self.angle()
+            dx, dy = left * sin(t), -left * cos(t)
+            self.wheels = tuple((x + dx, y + dy) for x, y in self.wheels)
+            return
         pivot = self.find_pivot((v_left, v_right))
         x_int, zero = pivot
         right_off, left_off = x_int - self.radius, x_int + self.radius
@@ -84,6 +90,55 @@ class RoombaDynamics(object):
         offset_pivot = tuple(a + b for a, b in zip(rotated_pivot, pos))
         self.wheels = tuple(self.rotate(w, offset_pivot, d_theta) for w in self.wheels)        
         
+    def integrate(self, left, right):
+        """Runs the model over whole arrays of raw encoder counts at once, returning arrays of x, y and theta.
+        
+        This is the batch equivalent of calling normalize() and update() for
+        each pair of encoder readings in turn, and is intended for
+        reconstructing trajectories from logs. Counts continue on from the
+        prior values. Element i of each returned array is the pose after the
+        ith reading: x and y are as returned by position() and theta is the
+        angle() measure, but unwrapped rather than confined to (0, 2pi].
+        When done the model is left at the final pose, so calls to
+        integrate() and update() can be mixed.
+        
+        Requires numpy."""
+        if numpy is None:
+            raise RuntimeError('integrate() requires numpy')
+        counts = numpy.empty((2, len(left) + 1))
+        counts[:, 0] = self.prior_values
+        counts[0, 1:] = left
+        counts[1, 1:] = right
+        deltas = numpy.diff(counts, axis = 1)
+        deltas = (deltas + 0x8000) % 0x10000 - 0x8000
+        d_left, d_right = deltas * self.encoder_ratio
+        if len(left):
+            self.prior_values = (left[-1], right[-1])
+        
+        # Each step rotates the robot about a pivot on its axle, which works
+        # out to an arc of length s through an angle d_theta
+        d_theta = (d_left - d_right) / (2 * self.radius)
+        s = (d_left + d_right) / 2
+        theta0 = self.angle()
+        theta = theta0 + numpy.cumsum(d_theta)
+        before = numpy.concatenate(([theta0], theta[:-1]))
+        turning = d_theta != 0
+        scale = numpy.where(turning, s / numpy.where(turning, d_theta, 1), 0)
+        dx = numpy.where(turning, scale * (numpy.cos(before) - numpy.cos(theta)), s * numpy.sin(before))
+        dy = numpy.where(turning, scale * (numpy.sin(before) - numpy.sin(theta)), -s * numpy.cos(before))
+        x0, y0 = self.position()
+        x = x0 + numpy.cumsum(dx)
+        y = y0 + numpy.cumsum(dy)
+        
+        if len(left):
+            self._set_pose(x[-1], y[-1], theta[-1])
+        return x, y, theta
+    
+    def _set_pose(self, x, y, theta):
+        """Places the wheels for a center position and angle"""
+        dx, dy = self.radius * cos(theta), self.radius * sin(theta)
+        self.wheels = ((x - dx, y - dy), (x + dx, y + dy))
+    
     def angle(self):
         """Determines a the angle of the rotation of the robot from the origin"""
         left, right = self.wheels
@@ -91,11 +146,13 @@ class RoombaDynamics(object):
         # use the right wheel, since this will give us rotation above the x
         x, y = right
         x0, y0 = pos
-        t = acos((x - x0) / self.radius)
-        if (y - y0) > 0:
+        # atan2 rather than acos of x alone, which fails once rounding puts
+        # the wheels slightly more than a radius apart
+        t = atan2(y - y0, x - x0)
+        if t > 0:
             return t
         else:
-            return (pi - t) + pi
+            return t + 2 * pi
     
     def position(self):
         """Calculates the position of the center of the robot based on wheel positions"""
@@ -108,3 +165,76 @@ class RoombaDynamics(object):
         """Reset the robots position"""
         self.wheels = ((-self.radius, 0), (self.radius, 0))
 
+class PoseIntegrator(object):
+    """A lightweight dead-reckoning integrator working directly on the robot's pose.
+    
+    Where RoombaDynamics tracks the positions of both wheels and derives the
+    pose from them, PoseIntegrator keeps x, y and theta themselves and
+    advances them with the closed-form solution for a differential-drive
+    step: the robot travels along an arc of length (left + right) / 2
+    through an angle of (right - left) / wheelbase. Straight-line steps and
+    turns on the spot are handled exactly. Nothing is allocated per update
+    beyond the floats themselves, so it is cheap enough to run for many
+    robots from inside the 15ms event loop:
+    
+        pose = PoseIntegrator()
+        pose.initialize_priors(readings['left_encoder'], readings['right_encoder'])
+        ...
+        pose.update(readings['left_encoder'], readings['right_encoder'])
+        print pose.x, pose.y, pose.theta
+    
+    Positions are in mm and theta is the heading in radians, counter-clockwise
+    from the x axis (so the robot starts at the origin facing along x).
+    Theta is not wrapped."""
+    
+    __slots__ = ('x', 'y', 'theta', 'radius', 'encoder_ratio', 'prior_left', 'prior_right')
+    
+    def __init__(self, radius = 115.490625, encoder_ratio = 0.55287243514):
+        """Create an integrator at the origin.
+        
+        Arguments are half the wheelbase in mm and the mm travelled per
+        encoder count, defaulting to the values RoombaDynamics uses."""
+        self.radius = radius
+        self.encoder_ratio = encoder_ratio
+        self.prior_left = self.prior_right = 0
+        self.reset()
+    
+    def initialize_priors(self, left, right):
+        """Sets the encoder counts which the next update() is measured from"""
+        self.prior_left = left
+        self.prior_right = right
+    
+    def update(self, left, right):
+        """Advances the pose given new raw encoder counts.
+        
+        Counts are taken to have moved by less than half the 16-bit range
+        since the last update, in either direction, so rollover is handled
+        when driving backwards as well as forwards."""
+        d_left = (left - self.prior_left) & 0xffff
+        if d_left >= 0x8000:
+            d_left -= 0x10000
+        d_right = (right - self.prior_right) & 0xffff
+        if d_right >= 0x8000:
+            d_right -= 0x10000
+        self.prior_left = left
+        self.prior_right = right
+        ratio = self.encoder_ratio
+        self.step(d_left * ratio, d_right * ratio)
+    
+    def step(self, left, right):
+        """Advances the pose given the distance in mm travelled by each wheel"""
+        theta = self.theta
+        if left == right:
+            self.x += left * cos(theta)
+            self.y += left * sin(theta)
+            return
+        d_theta = (right - left) / (2.0 * self.radius)
+        r = (left + right) / (2.0 * d_theta) # Radius of the arc; zero when turning on the spot
+        after = theta + d_theta
+        self.x += r * (sin(after) - sin(theta))
+        self.y -= r * (cos(after) - cos(theta))
+        self.theta = after
+    
+    def reset(self):
+        """Reset the robot's position to the origin"""
+        self.x = self.y = self.theta = 0.0
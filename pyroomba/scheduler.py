@@ -0,0 +1,109 @@
+from time import sleep
+
+from clock import monotonic
+
+__all__ = ['TickScheduler']
+
+class TickScheduler(object):
+    """Keeps a control loop on a fixed cadence of absolute deadlines.
+
+    Each pass through a loop is a tick, which should end by its deadline.
+    Deadlines are period seconds apart on the monotonic clock, counted from
+    start() rather than from the end of the previous tick, so time spent
+    working comes out of the tick's slack instead of stretching the period,
+    and the loop doesn't drift:
+
+        scheduler.start()
+        while running:
+            do_work()
+            scheduler.idle() # Idle functions run in the slack
+            scheduler.wait() # Sleeps until the deadline
+
+    A tick which finishes after its deadline is an overrun: it is counted,
+    and every function registered with on_overrun() is called as
+    function(late, missed), with how many seconds late the tick was and how
+    many whole ticks went by meanwhile. What happens next depends on the
+    policy:
+     'skip': The missed ticks are dropped, and the next tick starts on the
+        next deadline still to come, keeping to the original schedule.
+     'catch_up': The next tick starts straight away, and ticks run back to
+        back until the schedule is caught up, so none are lost.
+
+    Roomba.run() and EventLoop.run() each keep a scheduler in their
+    scheduler attribute; set its policy or register functions with it
+    before calling run()."""
+
+    def __init__(self, period = 0.015, policy = 'skip'):
+        if policy not in ('skip', 'catch_up'):
+            raise ValueError('Unknown scheduling policy %r' % policy)
+        self.period = period
+        self.policy = policy
+        self.deadline = None
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0 # Ticks dropped by the 'skip' policy
+        self.worst = 0.0 # Latest any tick has finished, in seconds
+        self._idle = () # Replaced, not modified, as with EventLoop handlers
+        self._overrun = ()
+
+    def add_idle(self, function):
+        """Registers a function to be called once every tick, in the slack before the deadline"""
+        self._idle += (function,)
+
+    def remove_idle(self, function):
+        self._idle = tuple(f for f in self._idle if f is not function)
+
+    def on_overrun(self, function):
+        """Registers a function to be called as function(late, missed) whenever a tick overruns"""
+        self._overrun += (function,)
+
+    def start(self):
+        """Starts the schedule, with the first deadline a period from now"""
+        self.deadline = monotonic() + self.period
+
+    def align(self):
+        """Pushes the current deadline back to a period from now, if it's any sooner.
+
+        For loops paced by data arriving on another clock (e.g., the robot's
+        stream): call this once the data for a tick has arrived, so the
+        schedule follows the data rather than drifting away from it."""
+        self.deadline = max(self.deadline, monotonic() + self.period)
+
+    def slack(self):
+        """Returns the seconds left before the current deadline (negative once it has passed)"""
+        return self.deadline - monotonic()
+
+    def idle(self):
+        """Calls every idle function"""
+        for function in self._idle:
+            function()
+
+    def wait(self, block = True):
+        """Ends the current tick, sleeping until its deadline unless block is False.
+
+        Returns the number of whole ticks missed, which is zero unless the
+        tick overran by more than a period."""
+        period = self.period
+        deadline = self.deadline
+        now = monotonic()
+        self.ticks += 1
+        if now <= deadline:
+            if block:
+                sleep(deadline - now)
+            self.deadline = deadline + period
+            return 0
+        late = now - deadline
+        missed = int(late // period)
+        self.overruns += 1
+        self.worst = max(self.worst, late)
+        for function in self._overrun:
+            function(late, missed)
+        if self.policy == 'skip':
+            self.skipped += missed
+            deadline += (missed + 1) * period
+            if block:
+                sleep(max(deadline - monotonic(), 0))
+            self.deadline = deadline + period
+        else:
+            self.deadline = deadline + period
+        return missed
@@ -1,74 +1,147 @@
+from collections import namedtuple
+from math import pi
+from struct import Struct
+
+class Sensor(namedtuple('Sensor', 'id format name')):
+    """The description of one sensor packet the Roomba can report.
+
+    A sensor is still the (id, format, name) triple it always was, so it can
+    be unpacked and compared like one, but it also carries everything
+    needed to decode it, worked out once at import time:
+     struct: A precompiled big-endian struct.Struct for the packet's data.
+     size: The size of the packet's data in bytes.
+     names: The names of the values the packet decodes to; just the
+        sensor's name, except for group packets such as ALL_SCI.
+     units: The units of the raw value, if it has any (e.g., 'mV').
+     scale: The factor converting a raw value to SI units (e.g., 0.001
+        for mV to V).
+     bits: For bit-field packets, a dictionary of the name of each bit
+        to its mask.
+    Group packets (e.g., ALL_SCI) have a list of member sensors as their
+    format.
+
+    Look sensors up by packet ID with SENSOR_BY_ID, a list indexed by ID."""
+
+    def __new__(cls, id, format, name, units = None, scale = 1, bits = None):
+        self = super(Sensor, cls).__new__(cls, id, format, name)
+        if isinstance(format, list):
+            self.struct = Struct('>' + ''.join([ member[1] for member in format ]))
+            self.names = tuple(member[2] for member in format)
+        else:
+            self.struct = Struct('>' + format)
+            self.names = (name,)
+        self.size = self.struct.size
+        self.units = units
+        self.scale = scale
+        self.bits = bits or {}
+        return self
+
+    def __hash__(self):
+        return hash(self.id) # Group packets' member lists aren't hashable
+
+    def unpack_into(self, readings, buffer, offset = 0):
+        """Decodes the packet's data at offset in buffer into the readings dictionary, returning the offset following it"""
+        values = self.struct.unpack_from(buffer, offset)
+        if len(values) == 1:
+            readings[self.name] = values[0]
+        else:
+            readings.update(zip(self.names, values))
+        return offset + self.size
+
+    def si(self, value):
+        """Converts a raw value to SI units (e.g., millivolts to volts)"""
+        return value * self.scale
+
+    def flags(self, value):
+        """Breaks a bit-field value down into a dictionary of bit name to whether it is set"""
+        return dict((bit, bool(value & mask)) for bit, mask in self.bits.iteritems())
+
 # Sensor definitions
-BUMP_WHEEL_DROPS = (7, 'B', 'bump_wheel_drops')
-WALL = (8, 'B', 'wall')
+BUMP_WHEEL_DROPS = Sensor(7, 'B', 'bump_wheel_drops', bits = {
+    'bump_right': 0x01, 'bump_left': 0x02, 'wheel_drop_right': 0x04, 'wheel_drop_left': 0x08,
+    'wheel_drop_caster': 0x10, # SCI robots only
+})
+WALL = Sensor(8, 'B', 'wall')
 
-CLIFF_LEFT = (9, 'B', 'cliff_left')
-CLIFF_FRONT_LEFT = (10, 'B', 'cliff_front_left')
-CLIFF_FRONT_RIGHT = (11, 'B', 'cliff_front_right')
-CLIFF_RIGHT = (12, 'B', 'cliff_right')
+CLIFF_LEFT = Sensor(9, 'B', 'cliff_left')
+CLIFF_FRONT_LEFT = Sensor(10, 'B', 'cliff_front_left')
+CLIFF_FRONT_RIGHT = Sensor(11, 'B', 'cliff_front_right')
+CLIFF_RIGHT = Sensor(12, 'B', 'cliff_right')
 
-VIRTUAL_WALL = (13, 'B', 'virtual_wall')
+VIRTUAL_WALL = Sensor(13, 'B', 'virtual_wall')
 
-WHEEL_OVERCURRENT = (14, 'B', 'wheel_overcurrent')
+WHEEL_OVERCURRENT = Sensor(14, 'B', 'wheel_overcurrent', bits = {
+    'side_brush': 0x01, 'vacuum': 0x02, 'main_brush': 0x04, 'right_wheel': 0x08, 'left_wheel': 0x10,
+})
 
-DIRT_DETECT = (15, 'B', 'dirt_detect')
+DIRT_DETECT = Sensor(15, 'B', 'dirt_detect')
+DIRT_DETECT_RIGHT = Sensor(16, 'B', 'dirt_detect_right') # SCI robots; unused on OI robots
 
-IR_CHARACTER_OMNI = (17, 'B', 'ir_character_omni')
-IR_CHARACTER_LEFT = (52, 'B', 'ir_character_left')
-IR_CHARACTER_RIGHT = (53, 'B', 'ir_character_left')
+IR_CHARACTER_OMNI = Sensor(17, 'B', 'ir_character_omni')
+IR_CHARACTER_LEFT = Sensor(52, 'B', 'ir_character_left')
+IR_CHARACTER_RIGHT = Sensor(53, 'B', 'ir_character_right')
 
-BUTTONS = (18, 'B', 'buttons')
+BUTTONS = Sensor(18, 'B', 'buttons', bits = {
+    'clean': 0x01, 'spot': 0x02, 'dock': 0x04, 'minute': 0x08,
+    'hour': 0x10, 'day': 0x20, 'schedule': 0x40, 'clock': 0x80,
+})
 
-DISTANCE = (19, 'h', 'distance')
-ANGLE = (20, 'h', 'angle')
-CHARGING_STATE = (21, 'B', 'charging_state')
+DISTANCE = Sensor(19, 'h', 'distance', 'mm', 0.001)
+ANGLE = Sensor(20, 'h', 'angle', 'degrees', pi / 180)
+CHARGING_STATE = Sensor(21, 'B', 'charging_state')
 
-VOLTAGE = (22, 'H', 'voltage')
-CURRENT = (23, 'h', 'current')
-TEMPERATURE = (24, 'b', 'temperature')
-BATTERY_CHARGE = (25, 'H', 'battery_charge')
-BATTERY_CAPACITY = (26, 'H', 'battery_capacity')
+VOLTAGE = Sensor(22, 'H', 'voltage', 'mV', 0.001)
+CURRENT = Sensor(23, 'h', 'current', 'mA', 0.001)
+TEMPERATURE = Sensor(24, 'b', 'temperature', 'C')
+BATTERY_CHARGE = Sensor(25, 'H', 'battery_charge', 'mAh', 3.6) # To coulombs
+BATTERY_CAPACITY = Sensor(26, 'H', 'battery_capacity', 'mAh', 3.6)
 
-WALL_SIGNAL = (27, 'H', 'wall_signal')
+WALL_SIGNAL = Sensor(27, 'H', 'wall_signal')
 
-CLIFF_LEFT_SIGNAL = (28, 'H', 'cliff_left_signal')
-CLIFF_FRONT_LEFT_SIGNAL = (29, 'H', 'cliff_front_left_signal')
-CLIFF_FRONT_RIGHT_SIGNAL = (30, 'H', 'cliff_front_right_signal')
-CLIFF_RIGHT_SIGNAL = (31, 'H', 'cliff_right_signal')
+CLIFF_LEFT_SIGNAL = Sensor(28, 'H', 'cliff_left_signal')
+CLIFF_FRONT_LEFT_SIGNAL = Sensor(29, 'H', 'cliff_front_left_signal')
+CLIFF_FRONT_RIGHT_SIGNAL = Sensor(30, 'H', 'cliff_front_right_signal')
+CLIFF_RIGHT_SIGNAL = Sensor(31, 'H', 'cliff_right_signal')
 
-CHARGING_SOURCES_AVAILABLE = (34, 'B', 'charging_sources_available')
+CHARGING_SOURCES_AVAILABLE = Sensor(34, 'B', 'charging_sources_available', bits = {
+    'internal_charger': 0x01, 'home_base': 0x02,
+})
 
-OI_MODE = (35, 'B', 'oi_mode')
+OI_MODE = Sensor(35, 'B', 'oi_mode')
 
-SONG_NUMBER = (36, 'B', 'song_number')
-SONG_PLAYING = (37, 'B', 'song_playing')
+SONG_NUMBER = Sensor(36, 'B', 'song_number')
+SONG_PLAYING = Sensor(37, 'B', 'song_playing')
 
-STREAM_PACKETS = (38, 'B', 'stream_packets')
+STREAM_PACKETS = Sensor(38, 'B', 'stream_packets')
 
-REQUESTED_VELOCITY = (39, 'h', 'requested_velocity')
-REQUESTED_RADIUS = (40, 'h', 'requested_radius')
-REQUESTED_RIGHT_VELOCITY = (41, 'h', 'requested_right_velocity')
-REQUESTED_LEFT_VELOCITY = (42, 'h', 'requested_left_velocity')
+REQUESTED_VELOCITY = Sensor(39, 'h', 'requested_velocity', 'mm/s', 0.001)
+REQUESTED_RADIUS = Sensor(40, 'h', 'requested_radius', 'mm', 0.001)
+REQUESTED_RIGHT_VELOCITY = Sensor(41, 'h', 'requested_right_velocity', 'mm/s', 0.001)
+REQUESTED_LEFT_VELOCITY = Sensor(42, 'h', 'requested_left_velocity', 'mm/s', 0.001)
 
-RIGHT_ENCODER = (43, 'H', 'right_encoder')
-LEFT_ENCODER = (44, 'H', 'left_encoder')
+RIGHT_ENCODER = Sensor(43, 'H', 'right_encoder')
+LEFT_ENCODER = Sensor(44, 'H', 'left_encoder')
 
-LIGHT_BUMPER = (45, 'B', 'light_bumper')
-LIGHT_BUMP_LEFT = (46, 'H', 'light_bump_left')
-LIGHT_BUMP_FRONT_LEFT = (47, 'H', 'light_bump_front_left')
-LIGHT_BUMP_CENTER_LEFT = (48, 'H', 'light_bump_center_left')
-LIGHT_BUMP_CENTER_RIGHT = (49, 'H', 'light_bump_center_right')
-LIGHT_BUMP_FRONT_RIGHT = (50, 'H', 'light_bump_front_right')
+LIGHT_BUMPER = Sensor(45, 'B', 'light_bumper', bits = {
+    'left': 0x01, 'front_left': 0x02, 'center_left': 0x04,
+    'center_right': 0x08, 'front_right': 0x10, 'right': 0x20,
+})
+LIGHT_BUMP_LEFT = Sensor(46, 'H', 'light_bump_left')
+LIGHT_BUMP_FRONT_LEFT = Sensor(47, 'H', 'light_bump_front_left')
+LIGHT_BUMP_CENTER_LEFT = Sensor(48, 'H', 'light_bump_center_left')
+LIGHT_BUMP_CENTER_RIGHT = Sensor(49, 'H', 'light_bump_center_right')
+LIGHT_BUMP_FRONT_RIGHT = Sensor(50, 'H', 'light_bump_front_right')
+LIGHT_BUMP_RIGHT = Sensor(51, 'H', 'light_bump_right')
 
-LEFT_MOTOR_CURRENT = (54, 'h', 'left_motor_current')
-RIGHT_MOTOR_CURRENT = (55, 'h', 'right_motor_Current')
-MAIN_BRUSH_MOTOR_CURRENT = (56, 'h', 'main_brush_motor_current')
-SIDE_BRUSH_MOTOR_CURRENT = (57, 'h', 'side_brush_motor_current')
+LEFT_MOTOR_CURRENT = Sensor(54, 'h', 'left_motor_current', 'mA', 0.001)
+RIGHT_MOTOR_CURRENT = Sensor(55, 'h', 'right_motor_current', 'mA', 0.001)
+MAIN_BRUSH_MOTOR_CURRENT = Sensor(56, 'h', 'main_brush_motor_current', 'mA', 0.001)
+SIDE_BRUSH_MOTOR_CURRENT = Sensor(57, 'h', 'side_brush_motor_current', 'mA', 0.001)
 
-STASIS = (58, 'B', 'stasis')
+STASIS = Sensor(58, 'B', 'stasis', bits = {'toggling': 0x01})
 
 # Bulk packet definitions
-ALL_SCI = (0, [
+ALL_SCI = Sensor(0, [
     BUMP_WHEEL_DROPS,
     WALL,
     CLIFF_LEFT,
@@ -78,7 +151,7 @@ ALL_SCI = (0, [
     VIRTUAL_WALL,
     WHEEL_OVERCURRENT,
     DIRT_DETECT,
-    DIRT_DETECT,
+    DIRT_DETECT_RIGHT,
     IR_CHARACTER_OMNI,
     BUTTONS,
     DISTANCE,
@@ -92,7 +165,7 @@ ALL_SCI = (0, [
 ], 'all_sci')
 
 SENSORS = [
-   BUMP_WHEEL_DROPS,
+    BUMP_WHEEL_DROPS,
     WALL,
     CLIFF_LEFT,
     CLIFF_FRONT_LEFT,
@@ -101,6 +174,7 @@ SENSORS = [
     VIRTUAL_WALL,
     WHEEL_OVERCURRENT,
     DIRT_DETECT,
+    DIRT_DETECT_RIGHT,
     IR_CHARACTER_OMNI,
     IR_CHARACTER_LEFT,
     IR_CHARACTER_RIGHT,
@@ -114,10 +188,6 @@ SENSORS = [
     BATTERY_CHARGE,
     BATTERY_CAPACITY,
     WALL_SIGNAL,
-    CLIFF_LEFT,
-    CLIFF_FRONT_LEFT,
-    CLIFF_FRONT_RIGHT,
-    CLIFF_RIGHT,
     CLIFF_LEFT_SIGNAL,
     CLIFF_FRONT_LEFT_SIGNAL,
     CLIFF_FRONT_RIGHT_SIGNAL,
@@ -139,6 +209,7 @@ SENSORS = [
     LIGHT_BUMP_CENTER_LEFT,
     LIGHT_BUMP_CENTER_RIGHT,
     LIGHT_BUMP_FRONT_RIGHT,
+    LIGHT_BUMP_RIGHT,
     LEFT_MOTOR_CURRENT,
     RIGHT_MOTOR_CURRENT,
     MAIN_BRUSH_MOTOR_CURRENT,
@@ -148,3 +219,10 @@ SENSORS = [
 
 SENSOR_ID_MAP = dict([ (sensor[0], sensor) for sensor in SENSORS ])
 SENSOR_NAME_MAP = dict([ (sensor[2], sensor) for sensor in SENSORS])
+
+# Every sensor (including groups) indexed by packet ID, for lookups in the
+# decode path without hashing; IDs with no sensor are None
+SENSOR_BY_ID = [None] * (max(sensor[0] for sensor in SENSORS) + 1)
+for sensor in SENSORS + [ALL_SCI]:
+    SENSOR_BY_ID[sensor[0]] = sensor
+del sensor
@@ -0,0 +1,294 @@
+import asyncore
+import socket
+from collections import deque
+from threading import Lock
+from threading import Thread
+
+from clock import monotonic
+from wire import DeltaEncoder
+from wire import message
+
+__all__ = ['TelemetryServer']
+
+class _Client(asyncore.dispatcher):
+    """One connection to a TelemetryServer, with its own subscriptions and send queues.
+
+    Samples and the switch to binary are handled on the robot's thread
+    (see TelemetryServer.execute()), everything else on the server's."""
+    def __init__(self, server, sock, map):
+        asyncore.dispatcher.__init__(self, sock, map)
+        self._server = server
+        self._incoming = ''
+        self._queue = deque(maxlen = server.queue_size) # Oldest samples fall off the end
+        self._replies = deque() # Never dropped; see readable()
+        self._lock = Lock() # Keeps replies, samples and the switch to binary in order
+        self.closed = False
+        self._pending = '' # Partially sent data
+        self.monitors = set()
+        self.interval = 0 # Minimum seconds between samples
+        self._last = 0
+        self.encoder = None # A DeltaEncoder once the client switches to binary
+
+    def readable(self):
+        # Stop taking commands while the client isn't reading their replies
+        return len(self._replies) < self._server.queue_size
+
+    def writable(self):
+        return bool(self._pending or self._replies or self._queue)
+
+    def handle_read(self):
+        data = self.recv(4096)
+        if not data:
+            return
+        lines = (self._incoming + data).split('\n')
+        self._incoming = lines[-1] # Incomplete command
+        for line in lines[:-1]:
+            if self.closed:
+                break # Quit; the rest are for nobody
+            line = line.strip()
+            if line:
+                self._server._handle_command(self, line)
+
+    def handle_write(self):
+        data = self._pending
+        with self._lock:
+            replies = self._replies
+            while replies and len(data) < 4096:
+                data += replies.popleft()
+            queue = self._queue
+            while queue and len(data) < 4096:
+                data += queue.popleft()
+        sent = self.send(data)
+        self._pending = data[sent:]
+
+    def handle_close(self):
+        self.closed = True
+        self._server._disconnected(self)
+        self.close()
+
+    def handle_error(self):
+        self._server._disconnected(self)
+        asyncore.dispatcher.handle_error(self)
+
+    def reply(self, text):
+        """Queues a response to a command"""
+        with self._lock:
+            if self.encoder is not None:
+                text = message('T', text)
+            self._replies.append(text)
+
+    def binary(self, keyframe_interval):
+        """Switches the client to the binary protocol, sending it the schema. Called on the robot's thread."""
+        encoder = DeltaEncoder(keyframe_interval)
+        with self._lock:
+            self._queue.clear() # Text samples mustn't follow the schema
+            self._replies.append(encoder.schema())
+            self.encoder = encoder
+
+    def _enqueue(self, data):
+        # Called with self._lock held
+        queue = self._queue
+        if len(queue) == queue.maxlen and self.encoder is not None:
+            self.encoder.keyframe() # A delta is about to be lost; resynchronize the client
+        queue.append(data)
+
+    def offer(self, now, readings):
+        """Queues a sample if the client wants it"""
+        if not self.monitors or now - self._last < self.interval:
+            return
+        self._last = now
+        with self._lock:
+            encoder = self.encoder
+            if encoder is None:
+                self._enqueue(''.join([ '%s: %s\n' % (name, readings[name]) for name in self.monitors if name in readings ]))
+                return
+            data = encoder.encode(readings, self.monitors)
+            if data is not None:
+                self._enqueue(data)
+
+class _Listener(asyncore.dispatcher):
+    def __init__(self, server, address, map):
+        asyncore.dispatcher.__init__(self, map = map)
+        self._server = server
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(5)
+
+    def handle_accept(self):
+        accepted = self.accept()
+        if accepted is not None:
+            sock, address = accepted
+            self._server._connected(sock, address)
+
+class TelemetryServer(object):
+    """A network server publishing a robot's sensor data to any number of clients, and taking commands from them.
+
+    Clients connect over TCP and send newline-terminated commands:
+     sensor NAME: Replies with the latest value of a sensor.
+     monitor NAME...: Starts sending the named sensors with every sample.
+     unmonitor NAME...: Stops sending the named sensors.
+     rate HZ: Limits samples sent to this client to HZ per second (0 for
+        no limit).
+     stop: Stops the robot's wheels, straight away even if the robot is
+        buffering commands (see Roomba.send_now()).
+     binary [KEYFRAME_INTERVAL]: Switches to the binary protocol (see
+        below).
+     quit: Closes the connection.
+    Anything else is taken as the name of a Roomba method to call, with
+    integer arguments (e.g., "drive_direct 100 100"). Commands acting on the
+    robot (stop, and method calls) are run by publish() on the robot's
+    thread, never the server's; see execute().
+
+    Samples are sent in the same "name: value" lines the old teleoperation
+    sample used. Each client has its own bounded send queue; a client which
+    can't keep up loses its oldest samples rather than holding up the robot
+    or other clients. Replies to commands are never dropped: once a client
+    has queue_size replies waiting to be sent, the server stops reading its
+    commands until it catches up.
+
+    Clients monitoring many sensors, or over a slow link, should switch to
+    the binary protocol implemented by wire.DeltaEncoder. The server replies
+    with a schema of every sensor's packet ID and type, then sends each
+    sample as a few bytes per sensor, including only sensors which changed
+    since the last sample sent to that client. Every KEYFRAME_INTERVAL
+    samples (default 66, about a second) a keyframe with every monitored
+    sensor is sent instead; one is also forced whenever the client's queue
+    overflows. The switch happens on the robot's thread, like robot
+    commands. Replies to later commands arrive as text messages.
+    wire.DeltaDecoder decodes the stream on the client side.
+
+    The server runs its own asyncore loop, either in a thread of its own
+    (start()) or the calling thread (run()). Feed it samples by attaching it
+    to an EventLoop, or by calling publish() yourself:
+
+        server = TelemetryServer(robot, ('', 7420))
+        server.attach(loop)
+        server.start()
+    """
+
+    def __init__(self, robot, address = ('', 7420), queue_size = 64):
+        """Create a server for a robot, listening on address (a (host, port) pair)."""
+        self.robot = robot
+        self.queue_size = queue_size
+        self.latest = {}
+        self.running = False
+        self._map = {}
+        self._clients = []
+        self._commands = deque() # (client, function, args) waiting for execute()
+        self._thread = None
+        self._listener = _Listener(self, address, self._map)
+        self.address = self._listener.socket.getsockname()
+
+    def attach(self, loop):
+        """Publishes every sample processed by an EventLoop"""
+        loop.on_sample(lambda robot, readings: self.publish(readings))
+
+    def publish(self, readings):
+        """Offers a sample to every client, then runs any robot commands they've sent (see execute()).
+
+        Call this from the thread driving the robot (e.g., an event loop's,
+        or a run() idle function), not the server's."""
+        self.latest = readings
+        now = monotonic()
+        for client in list(self._clients):
+            client.offer(now, readings)
+        self.execute()
+
+    def execute(self):
+        """Runs the robot commands (stop, and Roomba methods) and binary switches clients have sent since the last call.
+
+        The server's own thread only queues these: a Roomba isn't
+        thread-safe, and a method such as sensors() or safe() run while
+        another thread is reading the port would steal its bytes. publish()
+        calls this, so commands run on whichever thread publishes samples;
+        call it yourself from that thread if you don't publish."""
+        commands = self._commands
+        while commands:
+            client, function, args = commands.popleft()
+            try:
+                function(*args)
+            except Exception as e:
+                client.reply('error: %s\n' % e)
+
+    def clients(self):
+        """Returns the number of connected clients"""
+        return len(self._clients)
+
+    def _connected(self, sock, address):
+        self._clients.append(_Client(self, sock, self._map))
+
+    def _disconnected(self, client):
+        if client in self._clients:
+            self._clients.remove(client)
+
+    def _handle_command(self, client, command):
+        parts = command.split()
+        name, args = parts[0], parts[1:]
+        if name == 'sensor':
+            for sensor in args:
+                if sensor in self.latest:
+                    client.reply('%s: %s\n' % (sensor, self.latest[sensor]))
+        elif name == 'monitor':
+            client.monitors = client.monitors | set(args) # Replaced, not updated, as publish() may be iterating it
+        elif name == 'unmonitor':
+            client.monitors = client.monitors - set(args)
+        elif name == 'rate':
+            try:
+                rate = float(args[0])
+            except IndexError:
+                client.reply('error: rate needs a number of samples per second\n')
+            except ValueError as e:
+                client.reply('error: %s\n' % e)
+            else:
+                client.interval = rate and 1.0 / rate or 0
+        elif name == 'stop':
+            # drive() rather than drive_direct(), which SCI robots lack
+            self._commands.append((client, self.robot.send_now, ('>BhH', 137, 0, 0x8000)))
+        elif name == 'binary':
+            try:
+                interval = args and int(args[0]) or 66
+            except ValueError as e:
+                client.reply('error: %s\n' % e)
+            else:
+                self._commands.append((client, client.binary, (interval,)))
+        elif name == 'quit':
+            client.handle_close()
+        elif not name.startswith('_') and hasattr(self.robot, name):
+            try:
+                args = tuple(int(a) for a in args) # Try all integers, most args are!
+            except ValueError as e:
+                client.reply('error: %s\n' % e)
+            else:
+                self._commands.append((client, getattr(self.robot, name), args))
+        else:
+            client.reply('error: unknown command %s\n' % name)
+
+    def run(self, timeout = 0.005):
+        """Serves clients in the calling thread until stop() is called"""
+        self.running = True
+        while self.running:
+            asyncore.loop(timeout, map = self._map, count = 1)
+
+    def start(self):
+        """Spawns off a background thread serving clients"""
+        assert not self.running
+        self.running = True
+        self._thread = Thread(target = self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops serving, and disconnects every client"""
+        self.running = False
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        for client in list(self._clients):
+            client.close()
+        del self._clients[:]
+
+    def close(self):
+        """Stops serving and closes the listening socket"""
+        self.stop()
+        self._listener.close()
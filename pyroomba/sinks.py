@@ -0,0 +1,147 @@
+import os
+from time import time
+
+from capture import HEADER
+from capture import MAGIC
+from capture import RECORD
+
+__all__ = ['FrameSink', 'BatchSink', 'SocketSink', 'FileSink', 'CaptureSink', 'QueueSink']
+
+class FrameSink(object):
+    """Receives raw sensor frames from a robot, without decoding them.
+
+    Add sinks to a robot with Roomba.add_sink(). Every frame which passes its
+    checksum is handed to write_frame() as a memoryview of the whole frame
+    (magic, length, body and checksum) straight out of the robot's receive
+    buffer, along with the monotonic time at which it was read. The view is
+    only valid until flush() is next called, which happens before the robot
+    reads its port again; sinks which hold on to frames any longer must copy
+    them (e.g., with tobytes()).
+
+    Subclasses override write_frame(), and flush() if they batch. Sinks which
+    only observe the stream (e.g., to measure it) should set passive, so an
+    EventLoop with nothing else to do still decodes samples."""
+
+    passive = False
+
+    def write_frame(self, frame, timestamp):
+        raise NotImplementedError()
+
+    def flush(self):
+        pass
+
+class BatchSink(FrameSink):
+    """A sink collecting the frames of each read and writing them in one go.
+
+    Subclasses override write_batch(), which is called from flush() with a
+    list of frames and a list of their timestamps."""
+
+    def __init__(self):
+        self._frames = []
+        self._timestamps = []
+
+    def write_frame(self, frame, timestamp):
+        self._frames.append(frame)
+        self._timestamps.append(timestamp)
+
+    def flush(self):
+        if self._frames:
+            try:
+                self.write_batch(self._frames, self._timestamps)
+            finally:
+                del self._frames[:]
+                del self._timestamps[:]
+
+    def write_batch(self, frames, timestamps):
+        raise NotImplementedError()
+
+def _join(frames):
+    """Copies a batch of frames into one buffer, for platforms without gathered writes"""
+    if len(frames) == 1:
+        return frames[0]
+    data = bytearray()
+    for frame in frames:
+        data += frame
+    return data
+
+class SocketSink(BatchSink):
+    """Forwards the raw stream to a connected (blocking) socket.
+
+    Each batch goes out with a single sendmsg() call where the platform
+    provides one, gathering the frames straight from the robot's buffer.
+    Elsewhere the batch is copied into one buffer and sent with sendall()."""
+
+    def __init__(self, sock):
+        super(SocketSink, self).__init__()
+        self.sock = sock
+
+    def write_batch(self, frames, timestamps):
+        sock = self.sock
+        if not hasattr(sock, 'sendmsg'):
+            sock.sendall(_join(frames))
+            return
+        frames = list(frames)
+        while frames:
+            sent = sock.sendmsg(frames)
+            while frames and sent >= len(frames[0]):
+                sent -= len(frames.pop(0))
+            if sent:
+                frames[0] = frames[0][sent:]
+
+class FileSink(BatchSink):
+    """Appends the raw stream to a file (or anything else with a file descriptor, such as a pipe).
+
+    The bytes written are exactly those the robot sent, minus any garbage
+    between frames, so the file can be parsed with FrameParser. Batches are
+    written with os.writev() where available."""
+
+    def __init__(self, file):
+        super(FileSink, self).__init__()
+        self.file = file
+
+    def write_batch(self, frames, timestamps):
+        if not hasattr(os, 'writev'):
+            self.file.write(_join(frames))
+            return
+        self.file.flush() # Nothing buffered may come after what we write directly
+        fd = self.file.fileno()
+        frames = list(frames)
+        while frames:
+            written = os.writev(fd, frames)
+            while frames and written >= len(frames[0]):
+                written -= len(frames.pop(0))
+            if written:
+                frames[0] = frames[0][written:]
+
+class CaptureSink(FrameSink):
+    """Records frames to a capture file, which ReplaySerial can play back.
+
+    Unlike Roomba.capture(), which records every byte read, this records
+    only frames which passed their checksum, each with the time it was
+    received."""
+
+    def __init__(self, path):
+        self._log = open(path, 'wb')
+        self._origin = None
+        self._log.write(HEADER.pack(MAGIC, time()))
+
+    def write_frame(self, frame, timestamp):
+        if self._origin is None:
+            self._origin = timestamp
+        self._log.write(RECORD.pack(timestamp - self._origin, len(frame)))
+        self._log.write(frame)
+
+    def flush(self):
+        self._log.flush()
+
+    def close(self):
+        self._log.close()
+
+class QueueSink(FrameSink):
+    """Puts a copy of each frame on a queue (e.g., a Queue.Queue) as a (bytes, timestamp) pair, for another thread to consume."""
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def write_frame(self, frame, timestamp):
+        self.queue.put((frame.tobytes(), timestamp))
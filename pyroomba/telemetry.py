@@ -0,0 +1,141 @@
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from clock import monotonic
+import sensors as sensor_list
+
+__all__ = ['Telemetry']
+
+class Telemetry(object):
+    """A fixed-size history of sensor readings, stored by column.
+
+    Each sensor gets its own typed array (using the format declared for it
+    in the sensors module, so a bump sensor costs one byte per sample and an
+    encoder two) and all of them share a single column of float timestamps.
+    The arrays are allocated up front and used as a ring, so once full the
+    oldest samples are overwritten. At 66 samples a second an hour is
+    roughly 240,000 samples, which for twenty sensors is on the order of ten
+    megabytes.
+
+    If numpy is installed window() and timestamps() return numpy arrays
+    which share memory with the ring, so no copying takes place (unless the
+    window wraps around the end of the ring). Note that this means the
+    values in a window will change as the ring is overwritten; copy them if
+    you need to keep them. Without numpy windows are returned as copied
+    array.array instances.
+
+    Sensors appearing for the first time partway through recording read as
+    zero for the samples before they appeared. Sensors missing from a
+    sample repeat their previous value.
+
+    Timestamps come from the monotonic clock (see clock.py), like those of
+    sinks, metrics and the tick scheduler, so windows aren't upset by
+    adjustments to the system clock; they aren't times of day."""
+
+    def __init__(self, capacity = 240000):
+        """Create an empty history holding at most capacity samples."""
+        self.capacity = capacity
+        self._times = array('d', [0.0]) * capacity
+        self._columns = {}
+        self._index = 0 # Where the next sample goes
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _column(self, name):
+        """Creates the ring for a newly seen sensor"""
+        sensor = sensor_list.SENSOR_NAME_MAP.get(name)
+        if sensor is None or not isinstance(sensor[1], str):
+            typecode = 'd'
+        else:
+            typecode = sensor[1]
+        column = self._columns[name] = array(typecode, [0]) * self.capacity
+        return column
+
+    def append(self, readings, timestamp = None):
+        """Records a dictionary of sensor readings, taken at timestamp (defaulting to now, on the monotonic clock)."""
+        if timestamp is None:
+            timestamp = monotonic()
+        index = self._index
+        columns = self._columns
+        self._times[index] = timestamp
+        for name, value in readings.iteritems():
+            column = columns.get(name)
+            if column is None:
+                column = self._column(name)
+            column[index] = value
+        if len(readings) < len(columns):
+            for name, column in columns.iteritems():
+                if name not in readings:
+                    column[index] = column[index - 1]
+        index += 1
+        if index == self.capacity:
+            index = 0
+        self._index = index
+        if self._count < self.capacity:
+            self._count += 1
+
+    def latest(self, name):
+        """Returns the most recently recorded value of a sensor, or None if none has been recorded"""
+        column = self._columns.get(name)
+        if column is None or not self._count:
+            return None
+        return column[self._index - 1]
+
+    def _start(self, seconds):
+        """Finds how many samples back from the newest fall within some number of seconds of it"""
+        times = self._times
+        capacity = self.capacity
+        newest = self._index - 1
+        cutoff = times[newest] - seconds
+        # Binary search over samples ordered oldest (0) to newest (count - 1)
+        low, high = 0, self._count
+        oldest = newest - self._count + 1
+        while low < high:
+            middle = (low + high) // 2
+            if times[(oldest + middle) % capacity] < cutoff:
+                low = middle + 1
+            else:
+                high = middle
+        return self._count - low
+
+    def _slice(self, column, count):
+        """Returns the newest count entries of a ring, oldest first"""
+        stop = self._index
+        start = stop - count
+        if start >= 0:
+            return self._view(column, start, stop)
+        # The window wraps around the end of the ring
+        head = self._view(column, self.capacity + start, self.capacity)
+        tail = self._view(column, 0, stop)
+        if numpy is not None:
+            return numpy.concatenate((head, tail))
+        return head + tail
+
+    def _view(self, column, start, stop):
+        if numpy is not None:
+            return numpy.frombuffer(column, column.typecode, stop - start, start * column.itemsize)
+        return column[start:stop]
+
+    def window(self, name, seconds):
+        """Returns the values of a sensor recorded within some number of seconds of the newest sample, oldest first"""
+        count = self._start(seconds) if self._count else 0
+        column = self._columns.get(name)
+        if column is None:
+            raise KeyError(name)
+        return self._slice(column, count)
+
+    def timestamps(self, seconds):
+        """Returns the timestamps of the samples returned by window() for the same number of seconds"""
+        count = self._start(seconds) if self._count else 0
+        return self._slice(self._times, count)
+
+    def clear(self):
+        """Discards all recorded samples"""
+        self._index = 0
+        self._count = 0
@@ -0,0 +1,152 @@
+import json
+from collections import deque
+from thread import get_ident
+
+from sinks import FrameSink
+import sensors as sensor_list
+
+__all__ = ['Tracer', 'TraceRecorder']
+
+class Tracer(object):
+    """Receives calls at the hot points of a robot's control loop.
+
+    Register tracers with Roomba.add_tracer() (or EventLoop.add_tracer() to
+    trace event handlers as well) and override whichever of these methods
+    you're interested in. Timestamps come from the monotonic clock. While no
+    tracers are registered none of this costs anything beyond a check.
+
+    Tracers are called on whichever thread does the work, which for handlers
+    run by a worker pool is the worker's, so they must be thread-safe."""
+
+    def before_send(self, robot, opcode, size, timestamp):
+        """Called before a command of size bytes is sent"""
+        pass
+
+    def after_send(self, robot, opcode, size, timestamp):
+        """Called once a command is sent, with the number of bytes actually written (0 if buffer_commands() held it back)"""
+        pass
+
+    def frame(self, robot, packet_ids, size, timestamp):
+        """Called for every valid stream frame, with the time it was read"""
+        pass
+
+    def before_frame(self, robot, packet_ids, size, timestamp):
+        """Called before a stream frame is decoded (by poll(), read_samples() and the like)"""
+        pass
+
+    def after_frame(self, robot, timestamp):
+        """Called once a frame is decoded (or fails to decode) or, when an EventLoop is tracing the robot, once its handlers have been dispatched"""
+        pass
+
+    def before_query(self, robot, packet_ids, timestamp):
+        """Called before a sensor query (query_list(), sensors() or a QueryPipeline request) is sent"""
+        pass
+
+    def after_query(self, robot, packet_ids, size, timestamp):
+        """Called once the response to a query has been read, with the number of bytes received (short, or zero, if it never fully came)"""
+        pass
+
+    def before_handler(self, handler, sensor_name, timestamp):
+        """Called before an EventLoop handler runs"""
+        pass
+
+    def after_handler(self, handler, sensor_name, timestamp):
+        """Called after an EventLoop handler returns (or raises)"""
+        pass
+
+def response_size(sensors):
+    """Returns the number of bytes in the response to a query for a list of sensors"""
+    return sum(sensor.size for sensor in sensors)
+
+def frame_ids(robot, body):
+    """Returns the packet IDs in a frame body"""
+    for plan in robot._plans:
+        if len(body) == plan.size and plan.matches(plan.struct.unpack_from(body)):
+            return plan.ids
+    by_id = sensor_list.SENSOR_BY_ID
+    ids = []
+    offset = 0
+    while offset < len(body):
+        packet = body[offset]
+        if isinstance(packet, str):
+            packet = ord(packet) # memoryviews index as strings in Python 2
+        sensor = packet < len(by_id) and by_id[packet] or None
+        if sensor is None:
+            break
+        ids.append(packet)
+        offset += 1 + sensor.size
+    return tuple(ids)
+
+class TraceSink(FrameSink):
+    """Passes frames on to a robot's tracers; installed by Roomba.add_tracer()"""
+    passive = True
+
+    def __init__(self, robot):
+        self._robot = robot
+
+    def write_frame(self, frame, timestamp):
+        robot = self._robot
+        body = frame[2:-1]
+        ids = frame_ids(robot, body)
+        for tracer in robot._tracers:
+            tracer.frame(robot, ids, len(frame), timestamp)
+
+class TraceRecorder(Tracer):
+    """A tracer keeping the most recent events, which can be saved for viewing as a timeline or flame graph.
+
+    Events are kept in a ring of at most capacity entries. write_chrome_trace()
+    saves them in the Trace Event format read by chrome://tracing, Perfetto
+    and speedscope, with commands, queries and handlers as spans (one track
+    per thread) and frames as instants when they are received and as spans
+    while they are decoded and dispatched:
+
+        recorder = TraceRecorder()
+        loop.add_tracer(recorder)
+        loop.run()
+        ...
+        recorder.write_chrome_trace('loop.json')
+    """
+
+    def __init__(self, capacity = 100000):
+        self.events = deque(maxlen = capacity) # (phase, name, timestamp, thread, details)
+
+    def _span(self, phase, name, timestamp, details):
+        self.events.append((phase, name, timestamp, get_ident(), details))
+
+    def before_send(self, robot, opcode, size, timestamp):
+        self._span('B', 'send %d' % opcode, timestamp, {'size': size})
+
+    def after_send(self, robot, opcode, size, timestamp):
+        self._span('E', 'send %d' % opcode, timestamp, {'written': size})
+
+    def frame(self, robot, packet_ids, size, timestamp):
+        self._span('i', 'received', timestamp, {'packets': list(packet_ids), 'size': size})
+
+    def before_frame(self, robot, packet_ids, size, timestamp):
+        self._span('B', 'frame', timestamp, {'packets': list(packet_ids), 'size': size})
+
+    def after_frame(self, robot, timestamp):
+        self._span('E', 'frame', timestamp, {})
+
+    def before_query(self, robot, packet_ids, timestamp):
+        self._span('B', 'query', timestamp, {'packets': list(packet_ids)})
+
+    def after_query(self, robot, packet_ids, size, timestamp):
+        self._span('E', 'query', timestamp, {'size': size})
+
+    def before_handler(self, handler, sensor_name, timestamp):
+        self._span('B', getattr(handler, '__name__', None) or repr(handler), timestamp, {'sensor': sensor_name})
+
+    def after_handler(self, handler, sensor_name, timestamp):
+        self._span('E', getattr(handler, '__name__', None) or repr(handler), timestamp, {})
+
+    def write_chrome_trace(self, path):
+        """Saves the recorded events in Trace Event (JSON) format"""
+        events = []
+        for phase, name, timestamp, thread, details in list(self.events):
+            event = {'name': name, 'ph': phase, 'ts': timestamp * 1e6, 'pid': 1, 'tid': thread, 'args': details}
+            if phase == 'i':
+                event['s'] = 't'
+            events.append(event)
+        with open(path, 'w') as output:
+            json.dump({'traceEvents': events}, output)
@@ -0,0 +1,146 @@
+from struct import Struct
+
+import sensors as sensor_list
+
+__all__ = ['DeltaEncoder', 'DeltaDecoder']
+
+# Every message is a type byte and a payload length followed by the payload.
+#  'S' (schema): For each sensor its packet ID, struct format character and
+#     name (length prefixed). Sent once, before any samples.
+#  'K' (keyframe) and 'D' (delta): A 16-bit sequence number followed by
+#     packet ID/value pairs, values packed big-endian in the sensor's format.
+#     Keyframes carry every monitored sensor; deltas only those which changed
+#     since the last message.
+#  'T' (text): A text reply to a command.
+HEADER = Struct('>cH')
+SEQUENCE = Struct('>H')
+
+def message(kind, payload):
+    """Frames a payload as a message of the given kind"""
+    return HEADER.pack(kind, len(payload)) + payload
+
+class DeltaEncoder(object):
+    """Encodes samples for one client as compact binary messages, sending only what changed.
+
+    A sample of a dozen sensors which formats to a couple of hundred bytes of
+    text costs a few bytes here, and most samples (where only the encoders
+    and maybe distance changed) even less. Samples where nothing monitored
+    changed aren't sent at all. Every keyframe_interval messages a keyframe
+    carrying every monitored sensor is sent instead, so a client joining late
+    or missing a message recovers quickly; call keyframe() to force one
+    (e.g., after messages had to be dropped)."""
+
+    def __init__(self, keyframe_interval = 66):
+        self.keyframe_interval = keyframe_interval
+        self._codecs = {} # Name -> (packet ID byte, Struct)
+        for packet, format, name in sensor_list.SENSORS:
+            self._codecs[name] = (chr(packet), Struct('>' + format))
+        self._sent = {} # Name -> value last sent
+        self._sequence = 0
+        self._countdown = 0 # Messages until the next keyframe
+
+    def schema(self):
+        """Returns the schema message describing every sensor's ID, type and name"""
+        parts = []
+        for packet, format, name in sensor_list.SENSORS:
+            parts.append(chr(packet) + format + chr(len(name)) + name)
+        return message('S', ''.join(parts))
+
+    def keyframe(self):
+        """Makes the next message a keyframe"""
+        self._countdown = 0
+
+    def encode(self, readings, names):
+        """Returns the message for a sample, including only the named sensors, or None if nothing needs sending"""
+        codecs = self._codecs
+        sent = self._sent
+        key = self._countdown <= 0
+        parts = []
+        for name in names:
+            value = readings.get(name)
+            codec = codecs.get(name)
+            if value is None or codec is None:
+                continue
+            if key or sent.get(name) != value:
+                sent[name] = value
+                packet, codec = codec
+                parts.append(packet + codec.pack(value))
+        if not parts:
+            return None
+        if key:
+            self._countdown = self.keyframe_interval
+        self._countdown -= 1
+        self._sequence = (self._sequence + 1) & 0xffff
+        return message(key and 'K' or 'D', SEQUENCE.pack(self._sequence) + ''.join(parts))
+
+class DeltaDecoder(object):
+    """Decodes the messages produced by DeltaEncoder, reassembling complete samples.
+
+    Feed it bytes as they arrive from the server; it returns the messages
+    completed by them. self.values always holds the latest value of every
+    sensor received so far:
+
+        sock.sendall('binary\\nmonitor left_encoder right_encoder\\n')
+        decoder = DeltaDecoder()
+        while True:
+            for kind, body in decoder.feed(sock.recv(4096)):
+                if kind == 'sample':
+                    print decoder.values
+
+    Messages are returned as (kind, body) pairs: ('schema', {id: (format,
+    name)}), ('sample', dict of the sensors in the message) or ('text',
+    reply). self.gaps counts messages which were evidently lost, detected
+    from their sequence numbers."""
+
+    def __init__(self):
+        self._buffer = ''
+        self._codecs = {} # Packet ID -> (name, Struct)
+        self.schema = {}
+        self.values = {}
+        self.sequence = None
+        self.gaps = 0
+
+    def feed(self, data):
+        buffer = self._buffer + data
+        messages = []
+        offset = 0
+        while len(buffer) - offset >= HEADER.size:
+            kind, length = HEADER.unpack_from(buffer, offset)
+            start = offset + HEADER.size
+            if len(buffer) - start < length:
+                break
+            payload = buffer[start:start + length]
+            offset = start + length
+            if kind == 'S':
+                messages.append(('schema', self._read_schema(payload)))
+            elif kind in 'KD':
+                messages.append(('sample', self._read_sample(payload)))
+            elif kind == 'T':
+                messages.append(('text', payload))
+        self._buffer = buffer[offset:]
+        return messages
+
+    def _read_schema(self, payload):
+        offset = 0
+        while offset < len(payload):
+            packet, format, size = ord(payload[offset]), payload[offset + 1], ord(payload[offset + 2])
+            name = payload[offset + 3:offset + 3 + size]
+            offset += 3 + size
+            self.schema[packet] = (format, name)
+            self._codecs[packet] = (name, Struct('>' + format))
+        return self.schema
+
+    def _read_sample(self, payload):
+        sequence, = SEQUENCE.unpack_from(payload, 0)
+        if self.sequence is not None and sequence != (self.sequence + 1) & 0xffff:
+            self.gaps += 1
+        self.sequence = sequence
+        sample = {}
+        offset = SEQUENCE.size
+        codecs = self._codecs
+        while offset < len(payload):
+            name, codec = codecs[ord(payload[offset])]
+            sample[name], = codec.unpack_from(payload, offset + 1)
+            offset += 1 + codec.size
+        self.values.update(sample)
+        return sample
@@ -0,0 +1,176 @@
+import sys
+import traceback
+from collections import deque
+from threading import Condition
+from threading import Thread
+
+from clock import monotonic
+
+__all__ = ['HandlerPool']
+
+class HandlerPool(object):
+    """A bounded pool of worker threads for running event handlers.
+
+    Handlers submitted to the pool are run on one of its worker threads
+    rather than the thread that submitted them, so a slow handler can't hold
+    up the serial read loop. Each handler has its own queue of pending
+    calls: calls to the same handler are always made in the order they were
+    submitted and never overlap, while different handlers run in parallel.
+
+    When a handler falls behind and its queue fills up, the pool's policy
+    decides what happens:
+     'drop-oldest': The oldest pending call is discarded to make room.
+     'coalesce': Pending calls are discarded in favor of the new one, so
+        the handler catches up with the latest value.
+     'block': The submitting thread waits for room. Use with care; this lets
+        handlers hold up the read loop again.
+    A handler subscribed to several sensors shares one queue between them,
+    but neither dropping nor coalescing ever discards the latest pending
+    value of a sensor: only calls superseded by a newer one for the same
+    sensor go (the oldest call overall only if every sensor queued is
+    different, which takes more sensors than queue_size).
+    The counts of dropped and coalesced calls are available from stats().
+
+    Exceptions raised by handlers are printed to stderr and counted; they
+    don't stop the worker."""
+
+    POLICIES = ('drop-oldest', 'coalesce', 'block')
+
+    def __init__(self, workers = 4, queue_size = 64, policy = 'coalesce'):
+        """Starts a pool of worker threads, each handler queueing at most queue_size calls."""
+        if policy not in self.POLICIES:
+            raise ValueError('Unknown overflow policy %r' % policy)
+        self.queue_size = queue_size
+        self.policy = policy
+        self._condition = Condition()
+        self._pending = {} # Handler -> deque of argument tuples
+        self._ready = deque() # Handlers with pending calls and no worker
+        self._scheduled = set() # Handlers either ready or being run
+        self._closed = False
+        self.metrics = None # Handler execution times are recorded here, if set
+        self.tracers = () # Called around every handler, see Tracer
+        self.submitted = self.completed = self.dropped = self.coalesced = self.errors = 0
+        self._threads = []
+        for i in range(workers):
+            thread = Thread(target = self._work, name = 'HandlerPool-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, handler, args):
+        """Queues a call of handler(*args)"""
+        with self._condition:
+            pending = self._pending.get(handler)
+            if pending is None:
+                pending = self._pending[handler] = deque()
+            if len(pending) >= self.queue_size:
+                if self.policy == 'drop-oldest':
+                    self._drop_oldest(pending, args[1])
+                    self.dropped += 1
+                elif self.policy == 'coalesce':
+                    self.coalesced += self._coalesce(pending, args[1])
+                else:
+                    while len(pending) >= self.queue_size and not self._closed:
+                        self._condition.wait()
+            pending.append(args)
+            self.submitted += 1
+            if handler not in self._scheduled:
+                self._scheduled.add(handler)
+                self._ready.append(handler)
+                self._condition.notify_all()
+
+    def _drop_oldest(self, pending, name):
+        """Discards the oldest call superseded by a later one for the same sensor (counting the one being submitted for name)"""
+        seen = set([name])
+        oldest = 0 # If nothing is superseded
+        for i in range(len(pending) - 1, -1, -1):
+            sensor = pending[i][1]
+            if sensor in seen:
+                oldest = i
+            seen.add(sensor)
+        del pending[oldest]
+
+    def _coalesce(self, pending, name):
+        """Discards every call superseded by a later one for the same sensor (counting the one being submitted for name), returning how many"""
+        seen = set([name])
+        kept = []
+        for args in reversed(pending):
+            if args[1] not in seen:
+                seen.add(args[1])
+                kept.append(args)
+        removed = len(pending) - len(kept)
+        pending.clear()
+        pending.extend(reversed(kept))
+        if len(pending) >= self.queue_size:
+            pending.popleft() # More sensors than room
+            removed += 1
+        return removed
+
+    def _work(self):
+        condition = self._condition
+        while True:
+            with condition:
+                while not self._ready and not self._closed:
+                    condition.wait()
+                if self._closed and not self._ready:
+                    return
+                handler = self._ready.popleft()
+                args = self._pending[handler].popleft()
+                condition.notify_all() # Room for a blocked submit()
+            failed = False
+            metrics = self.metrics
+            tracers = self.tracers
+            if metrics is not None or tracers:
+                start = monotonic()
+                for tracer in tracers:
+                    tracer.before_handler(handler, args[1], start)
+            try:
+                handler(*args)
+            except Exception:
+                failed = True
+                traceback.print_exc(file = sys.stderr)
+            if metrics is not None or tracers:
+                end = monotonic()
+                if metrics is not None:
+                    metrics.time_handler(handler, end - start)
+                for tracer in tracers:
+                    tracer.after_handler(handler, args[1], end)
+            with condition:
+                self.completed += 1
+                self.errors += failed
+                if self._pending[handler]:
+                    self._ready.append(handler)
+                else:
+                    self._scheduled.discard(handler)
+                condition.notify_all()
+
+    def depth(self):
+        """Returns the total number of calls waiting to run"""
+        with self._condition:
+            return sum(len(pending) for pending in self._pending.values())
+
+    def stats(self):
+        """Returns a dictionary of counters describing the pool's activity"""
+        with self._condition:
+            return {
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'dropped': self.dropped,
+                'coalesced': self.coalesced,
+                'errors': self.errors,
+                'queued': sum(len(pending) for pending in self._pending.values()),
+            }
+
+    def join(self):
+        """Waits for every pending call to finish"""
+        with self._condition:
+            while self._scheduled:
+                self._condition.wait()
+
+    def close(self):
+        """Runs any pending calls, then stops the worker threads"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
@@ -6,6 +6,9 @@ setup(
     packages = find_packages(),
     
     install_requires = ['pyserial>=2.0'],
+    extras_require = {
+        'dynamics': ['numpy'], # RoombaDynamics.integrate()
+    },
     
     author = "Jon Olson",
     author_email = "jon@damogran.com",
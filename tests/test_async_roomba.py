@@ -0,0 +1,108 @@
+"""Tests for AsyncRoomba and AsyncEventLoop, over a socket pair:
+
+    python -m unittest discover tests
+"""
+
+import asyncore
+import os
+import socket
+import sys
+import unittest
+from struct import pack
+from threading import Timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyroomba import AsyncEventLoop
+from pyroomba import AsyncRoomba
+from pyroomba import Tracer
+from pyroomba import sensors
+
+def frame(value):
+    """A stream frame carrying a single WALL reading"""
+    data = '\x13' + pack('>BBB', 2, sensors.WALL.id, value)
+    return data + chr(-sum(map(ord, data)) & 0xff)
+
+class SendTracer(Tracer):
+
+    def __init__(self):
+        self.sent = []
+
+    def after_send(self, robot, opcode, size, timestamp):
+        self.sent.append((opcode, size))
+
+class AsyncRoombaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ours, self.theirs = socket.socketpair()
+        self.channels = {}
+        self.robot = AsyncRoomba(sock = self.ours, map = self.channels)
+
+    def tearDown(self):
+        self.robot.close()
+        self.theirs.close()
+
+    def written(self):
+        return ''.join(data for data in self.robot._outgoing if isinstance(data, str))
+
+    def test_buffered_and_traced(self):
+        robot = self.robot
+        tracer = SendTracer()
+        robot.add_tracer(tracer)
+        robot.buffer_commands()
+        robot.drive_direct(100, 100)
+        robot.drive_direct(200, 200)
+        self.assertEqual(self.written(), '')
+        robot.flush_commands()
+        self.assertEqual(self.written(), pack('>Bhh', 145, 200, 200))
+        self.assertEqual(tracer.sent, [(145, 0), (145, 0), (145, 5)])
+
+    def test_handshakes(self):
+        robot = self.robot
+        handshakes = [robot.start(block = True, timeout = 1.0), robot.safe(timeout = 1.0), robot.full(block = False)]
+        self.assertFalse(any(handshake.ready() for handshake in handshakes))
+        while not handshakes[-1].ready():
+            asyncore.loop(0.01, map = self.channels, count = 1)
+        self.assertTrue(all(handshake.ready() for handshake in handshakes))
+
+    def test_wait_on_loop_thread(self):
+        robot = self.robot
+        asyncore.loop(0.01, map = self.channels, count = 1)
+        handshake = robot.safe(block = False)
+        self.assertFalse(handshake.confirmed)
+        self.assertRaises(RuntimeError, handshake.wait)
+
+    def test_pause_stream(self):
+        robot = self.robot
+        robot.stream_samples(sensors.WALL)
+        self.assertTrue(robot.streaming)
+        self.assertFalse(robot.pause_stream(block = False).ready())
+        self.assertFalse(robot.streaming)
+
+    def test_no_blocking_reads(self):
+        for name in ('poll', 'next_frame', 'read_samples', 'run'):
+            self.assertFalse(hasattr(self.robot, name), name)
+
+class AsyncEventLoopTest(unittest.TestCase):
+
+    def test_stop_pauses_stream(self):
+        ours, theirs = socket.socketpair()
+        channels = {}
+        robot = AsyncRoomba(sock = ours, map = channels)
+        loop = AsyncEventLoop(robot)
+        loop.set_sensors(sensors.WALL)
+        loop.on('wall', lambda robot, name, value: loop.stop())
+        Timer(0.1, theirs.sendall, [frame(1)]).start() # Once the stream command is out
+        try:
+            loop.run(map = channels)
+            theirs.settimeout(1.0)
+            received = ''
+            while not received.endswith('\x96\x00'):
+                received += theirs.recv(64)
+            self.assertEqual(received, pack('>BBB', 148, 1, sensors.WALL.id) + '\x96\x00')
+        finally:
+            robot.close()
+            theirs.close()
+
+if __name__ == '__main__':
+    unittest.main()
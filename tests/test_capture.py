@@ -0,0 +1,94 @@
+"""Tests for CaptureSerial and ReplaySerial:
+
+    python -m unittest discover tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyroomba import CaptureSerial
+from pyroomba import ReplaySerial
+from pyroomba import Roomba
+from pyroomba import VirtualRoomba
+from pyroomba import sensors
+from pyroomba.capture import HEADER
+from pyroomba.capture import MAGIC
+from pyroomba.capture import RECORD
+from pyroomba.clock import monotonic
+
+class BulkPort(object):
+    """A port handing over everything asked for at once"""
+
+    def read(self, size = 1):
+        return ''.join(chr(i & 0xff) for i in xrange(size))
+
+class CaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.cap')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        robot = Roomba(None, serial_port = VirtualRoomba(seed = 1, realtime = False))
+        robot.start()
+        robot.safe()
+        robot.capture(self.path)
+        robot.drive_direct(200, 100)
+        robot.stream_samples(sensors.LEFT_ENCODER, sensors.RIGHT_ENCODER, sensors.VOLTAGE)
+        live = [ robot.poll() for i in range(50) ]
+        robot.stop_capture()
+
+        replay = ReplaySerial(self.path, speed = None)
+        robot = Roomba(None, serial_port = replay)
+        robot.stream_samples(sensors.LEFT_ENCODER, sensors.RIGHT_ENCODER, sensors.VOLTAGE)
+        replayed = [ robot.poll() for i in range(50) ]
+        self.assertEqual(replayed, live)
+        self.assertEqual(robot.poll(), None)
+        replay.close()
+
+    def test_stop_after_instrument(self):
+        robot = Roomba(None, serial_port = VirtualRoomba(seed = 1, realtime = False))
+        port = robot.port
+        robot.capture(self.path)
+        capture = robot.port
+        robot.instrument() # Wraps the capture
+        robot.stop_capture()
+        self.assertTrue(capture._log.closed)
+        self.assertTrue(robot.port.port is port)
+        self.assertTrue(robot._parser.port is robot.port)
+        robot.start()
+        robot.stream_samples(sensors.WALL)
+        self.assertNotEqual(robot.poll(), None)
+        self.assertTrue(robot.metrics.bytes_read > 0) # Still instrumented
+
+    def test_large_read(self):
+        port = CaptureSerial(BulkPort(), self.path)
+        data = port.read(70000)
+        port.close_capture()
+        replay = ReplaySerial(self.path, speed = None)
+        self.assertEqual(replay.in_waiting, 70000)
+        self.assertEqual(replay.read(70000), data)
+        replay.close()
+
+    def test_timeout(self):
+        with open(self.path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, 0))
+            f.write(RECORD.pack(0.0, 1) + 'a')
+            f.write(RECORD.pack(10.0, 1) + 'b') # Ten seconds later
+        replay = ReplaySerial(self.path, timeout = 0.05)
+        start = monotonic()
+        self.assertEqual(replay.read(2), 'a')
+        self.assertEqual(replay.read(1), '')
+        self.assertTrue(monotonic() - start < 1.0)
+        replay.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+"""Tests for CommandShadow and Roomba's command buffering:
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+from struct import pack
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyroomba import CommandShadow
+from pyroomba import Roomba
+
+def drive(right, left):
+    return pack('>Bhh', 145, right, left)
+
+def leds(color):
+    return pack('BBBB', 139, 0, color, 255)
+
+SAFE = pack('B', 131)
+SONG = pack('BB', 141, 0)
+
+class CommandShadowTest(unittest.TestCase):
+
+    def setUp(self):
+        self.shadow = CommandShadow()
+
+    def test_coalesces_slots(self):
+        shadow = self.shadow
+        for command in (drive(100, 100), drive(200, 200), pack('>Bhh', 146, 50, 50)):
+            self.assertEqual(shadow.queue(command), '')
+        self.assertEqual(shadow.flush(), pack('>Bhh', 146, 50, 50)) # drive_pwm shares drive_direct's slot
+        self.assertEqual(shadow.coalesced, 2)
+        self.assertEqual(shadow.flush(), '')
+
+    def test_drops_redundant(self):
+        shadow = self.shadow
+        shadow.queue(drive(100, 100))
+        shadow.flush()
+        shadow.queue(drive(100, 100))
+        self.assertEqual(shadow.flush(), '')
+        self.assertEqual(shadow.redundant, 1)
+
+    def test_flush_order(self):
+        shadow = self.shadow
+        shadow.queue(leds(10))
+        shadow.queue(drive(100, 100))
+        shadow.queue(leds(20)) # Replaces the first, but keeps its place
+        self.assertEqual(shadow.flush(), leds(20) + drive(100, 100))
+
+    def test_others_go_after_held(self):
+        shadow = self.shadow
+        shadow.queue(drive(100, 100))
+        self.assertEqual(shadow.queue(SONG), drive(100, 100) + SONG)
+        self.assertEqual(shadow.flush(), '')
+
+    def test_reset_forgets_sent(self):
+        shadow = self.shadow
+        shadow.queue(drive(100, 100))
+        shadow.queue(leds(10))
+        shadow.flush()
+        shadow.queue(drive(0, 0))
+        self.assertEqual(shadow.queue(SAFE), drive(0, 0) + SAFE) # Held state goes out before the mode change
+        # The robot may have reset its motors and LEDs, so the state sent
+        # before the mode change can't be assumed any more
+        shadow.queue(drive(0, 0))
+        shadow.queue(leds(10))
+        self.assertEqual(shadow.flush(), drive(0, 0) + leds(10))
+        self.assertEqual(shadow.redundant, 0)
+
+    def test_non_reset_keeps_sent(self):
+        shadow = self.shadow
+        shadow.queue(drive(100, 100))
+        shadow.flush()
+        shadow.queue(SONG)
+        shadow.queue(drive(100, 100))
+        self.assertEqual(shadow.flush(), '')
+
+    def test_immediate(self):
+        shadow = self.shadow
+        shadow.queue(leds(10))
+        shadow.queue(drive(100, 100))
+        self.assertEqual(shadow.immediate(drive(0, 0)), leds(10) + drive(0, 0)) # The held drive is superseded
+        self.assertEqual(shadow.flush(), '')
+        self.assertEqual(shadow.immediate(drive(0, 0)), drive(0, 0)) # Sent even though identical
+        shadow.queue(drive(0, 0))
+        self.assertEqual(shadow.flush(), '')
+
+class RecordingPort(object):
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+class BufferedRoombaTest(unittest.TestCase):
+
+    def test_send_now(self):
+        port = RecordingPort()
+        robot = Roomba(None, serial_port = port)
+        robot.buffer_commands()
+        robot.leds(10, 255)
+        robot.drive_direct(100, 100)
+        self.assertEqual(port.writes, [])
+        robot.send_now('>Bhh', 145, 0, 0)
+        self.assertEqual(port.writes, [leds(10) + drive(0, 0)])
+        robot.flush_commands()
+        self.assertEqual(len(port.writes), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+"""Tests for RoombaDynamics and PoseIntegrator:
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+from math import pi
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyroomba import PoseIntegrator
+from pyroomba import RoombaDynamics
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def counts(steps):
+    """Raw 16-bit encoder readings for a list of per-step (left, right) count deltas"""
+    left, right = [], []
+    l = r = 0
+    for d_left, d_right in steps:
+        l, r = (l + d_left) & 0xffff, (r + d_right) & 0xffff
+        left.append(l)
+        right.append(r)
+    return left, right
+
+def angle_between(a, b):
+    """The smallest angle between two headings"""
+    difference = (a - b) % (2 * pi)
+    return min(difference, 2 * pi - difference)
+
+@unittest.skipIf(numpy is None, 'integrate() requires numpy')
+class IntegrationAgreementTest(unittest.TestCase):
+    """Batch and incremental integration must trace out the same path.
+
+    RoombaDynamics measures its angle from the axle (the vector to the
+    right wheel, starting at 2pi) and positive turns are clockwise, so its
+    pose (x, y, theta) corresponds to PoseIntegrator's (-y, -x, 2pi - theta)."""
+
+    def check(self, steps):
+        left, right = counts(steps)
+        dynamics = RoombaDynamics()
+        dynamics.initialize_priors((0, 0))
+        x, y, theta = dynamics.integrate(numpy.array(left), numpy.array(right))
+        pose = PoseIntegrator()
+        incremental = RoombaDynamics()
+        incremental.initialize_priors((0, 0))
+        for i, (l, r) in enumerate(zip(left, right)):
+            pose.update(l, r)
+            self.assertAlmostEqual(x[i], -pose.y, 6)
+            self.assertAlmostEqual(y[i], -pose.x, 6)
+            self.assertAlmostEqual(theta[i], 2 * pi - pose.theta, 9)
+            incremental.update(incremental.normalize((l, r)), 0.015)
+            position = incremental.position()
+            self.assertAlmostEqual(x[i], position[0], 6)
+            self.assertAlmostEqual(y[i], position[1], 6)
+            self.assertAlmostEqual(angle_between(theta[i], incremental.angle()), 0.0, 9)
+        self.assertAlmostEqual(dynamics.position()[0], incremental.position()[0], 6)
+        return pose
+
+    def test_straight(self):
+        pose = self.check([(100, 100)] * 20)
+        # The straight-line special case: straight along the heading
+        self.assertAlmostEqual(pose.x, 2000 * pose.encoder_ratio, 6)
+        self.assertEqual(pose.y, 0.0)
+        self.assertEqual(pose.theta, 0.0)
+
+    def test_arc(self):
+        self.check([(100, 60)] * 20 + [(30, 90)] * 20)
+
+    def test_turn_in_place(self):
+        pose = self.check([(50, -50)] * 20 + [(-40, 40)] * 20)
+        self.assertAlmostEqual(pose.x, 0.0, 9)
+        self.assertAlmostEqual(pose.y, 0.0, 9)
+
+    def test_mixed_with_rollover(self):
+        self.check([(700, 700)] * 100 + [(-300, 300)] * 10 + [(500, 200)] * 50 + [(-600, -600)] * 100)
+
+class PoseIntegratorTest(unittest.TestCase):
+    """PoseIntegrator must follow the same path as RoombaDynamics.update() (see IntegrationAgreementTest)"""
+
+    def check(self, steps):
+        pose = PoseIntegrator()
+        dynamics = RoombaDynamics()
+        dynamics.initialize_priors((0, 0))
+        for l, r in zip(*counts(steps)):
+            pose.update(l, r)
+            dynamics.update(dynamics.normalize((l, r)), 0.015)
+            x, y = dynamics.position()
+            self.assertAlmostEqual(x, -pose.y, 6)
+            self.assertAlmostEqual(y, -pose.x, 6)
+            self.assertAlmostEqual(angle_between(dynamics.angle(), 2 * pi - pose.theta), 0.0, 9)
+        return pose
+
+    def test_straight(self):
+        pose = self.check([(100, 100)] * 20)
+        self.assertAlmostEqual(pose.x, 2000 * pose.encoder_ratio, 9)
+        self.assertEqual(pose.y, 0.0)
+        self.assertEqual(pose.theta, 0.0)
+
+    def test_turn_in_place(self):
+        pose = self.check([(50, -50)] * 20)
+        self.assertAlmostEqual(pose.x, 0.0, 9)
+        self.assertAlmostEqual(pose.y, 0.0, 9)
+        self.assertAlmostEqual(pose.theta, -1000 * pose.encoder_ratio / pose.radius, 9)
+
+    def test_arc(self):
+        pose = self.check([(100, 60)] * 20 + [(30, 90)] * 20)
+        self.assertTrue(pose.y != 0.0)
+
+    def test_rollover(self):
+        # Several times round the 16-bit range, forwards then backwards
+        self.check([(700, 700)] * 200 + [(300, 500)] * 100 + [(-600, -600)] * 200)
+
+    def test_reversing(self):
+        pose = self.check([(-100, -100)] * 20 + [(-100, -60)] * 20)
+        self.assertTrue(pose.x < 0)
+
+    def test_step(self):
+        # The closed form against many small steps along the same arc
+        exact = PoseIntegrator()
+        exact.step(300.0, 100.0)
+        stepped = PoseIntegrator()
+        for i in range(10000):
+            stepped.step(0.03, 0.01)
+        self.assertAlmostEqual(exact.x, stepped.x, 6)
+        self.assertAlmostEqual(exact.y, stepped.y, 6)
+        self.assertAlmostEqual(exact.theta, stepped.theta, 9)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+"""Tests for VirtualRoomba:
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+from math import pi
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyroomba import Roomba
+from pyroomba import VirtualRoomba
+from pyroomba import sensors
+
+class EmulatorTest(unittest.TestCase):
+
+    def robot(self, theta = 0.0):
+        port = VirtualRoomba(realtime = False)
+        port.theta = theta
+        robot = Roomba(None, serial_port = port)
+        robot.start()
+        robot.safe()
+        return robot, port
+
+    def test_bumps(self):
+        # Head-on into each wall, facing +x, +y, -x and -y in turn
+        for theta in (0.0, pi / 2, pi, -pi / 2):
+            robot, port = self.robot(theta)
+            robot.drive_direct(500, 500)
+            robot.stream_samples(sensors.BUMP_WHEEL_DROPS)
+            for i in range(200):
+                bumps = robot.poll()['bump_wheel_drops']
+                if bumps:
+                    break
+            self.assertEqual(bumps, 3, 'facing %.2f' % theta)
+
+    def test_glancing_bump(self):
+        robot, port = self.robot(0.5) # The +x wall is off to the right
+        robot.drive_direct(500, 500)
+        robot.stream_samples(sensors.BUMP_WHEEL_DROPS)
+        for i in range(200):
+            bumps = robot.poll()['bump_wheel_drops']
+            if bumps:
+                break
+        self.assertEqual(bumps, 1)
+
+    def test_encoders(self):
+        robot, port = self.robot()
+        robot.stream_samples(sensors.LEFT_ENCODER, sensors.RIGHT_ENCODER)
+        start = robot.poll()
+        robot.drive_direct(200, 100) # Right wheel 200mm/s, left 100mm/s
+        for i in range(100):
+            sample = robot.poll()
+        # The drive takes effect from the tick after it was sent, so at
+        # least 99 of those frames' ticks were spent driving
+        for name, speed in (('left_encoder', 100), ('right_encoder', 200)):
+            counts = sample[name] - start[name]
+            expected = speed * VirtualRoomba.TICK * VirtualRoomba.COUNTS_PER_MM
+            self.assertTrue(99 * expected - 1 <= counts <= 100 * expected + 1, '%s: %d' % (name, counts))
+
+    def test_play_song(self):
+        robot, port = self.robot()
+        robot.define_song(1, [60, 62], [32, 32])
+        self.assertEqual(robot.query_list(sensors.SONG_PLAYING)['song_playing'], 0)
+        robot.play_song(1)
+        readings = robot.query_list(sensors.SONG_NUMBER, sensors.SONG_PLAYING)
+        self.assertEqual(readings, {'song_number': 1, 'song_playing': 1})
+        for i in range(40): # A second's worth of 30ms timeouts
+            robot.port.read(1)
+        self.assertEqual(robot.query_list(sensors.SONG_PLAYING)['song_playing'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+"""Regression tests for EventLoop, run against the emulator:
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+from threading import Thread
+from struct import pack
+from time import sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyroomba import EventLoop
+from pyroomba import Roomba
+from pyroomba import VirtualRoomba
+from pyroomba import sensors
+
+class CorruptStreamTest(unittest.TestCase):
+    """A loop must survive frames damaged in transit (e.g., by EMI bursts)"""
+
+    def loop(self, realtime):
+        port = VirtualRoomba(seed = 3, realtime = realtime, corrupt_rate = 0.05, drop_rate = 0.05)
+        robot = Roomba(None, serial_port = port)
+        robot.start()
+        loop = EventLoop(robot)
+        loop.set_sensors(sensors.WALL, sensors.VOLTAGE)
+        self.samples = []
+        loop.on('voltage', lambda robot, name, value: self.samples.append(value))
+        return loop
+
+    def test_process_events(self):
+        loop = self.loop(realtime = False)
+        loop.start_sampling()
+        for i in range(400):
+            loop.process_events()
+        self.assertTrue(loop.bad_frames > 0)
+        self.assertTrue(len(self.samples) > 300)
+        self.assertEqual(set(self.samples), set([16000]))
+
+    def test_run(self):
+        loop = self.loop(realtime = True)
+        thread = Thread(target = loop.run)
+        thread.start()
+        try:
+            sleep(1.0)
+            self.assertTrue(thread.is_alive())
+        finally:
+            loop.stop()
+            thread.join()
+        self.assertTrue(len(self.samples) > 40)
+        self.assertTrue(loop.bad_frames + loop.robot._parser.checksum_errors > 0)
+
+def frame(*readings):
+    """A stream frame carrying (sensor, value) pairs"""
+    body = ''.join([ pack('>B' + sensor.format, sensor.id, value) for sensor, value in readings ])
+    data = '\x13' + chr(len(body)) + body
+    return data + chr(-sum(map(ord, data)) & 0xff)
+
+class SwitchingStreamPort(object):
+    """A port streaming WALL and LEFT_ENCODER, whose old layout frames keep coming for a while after the sensors change"""
+
+    def __init__(self):
+        self.data = ''
+        self.streams = 0
+
+    def write(self, data):
+        if not data.startswith('\x94'):
+            return
+        self.streams += 1
+        if self.streams == 1:
+            self.data += frame((sensors.WALL, 0), (sensors.LEFT_ENCODER, 1))
+        else:
+            for value in (2, 3, 4):
+                self.data += frame((sensors.WALL, 0), (sensors.LEFT_ENCODER, value))
+            self.data += frame((sensors.WALL, 0)) * 2
+
+    def read(self, size = 1):
+        data, self.data = self.data[:size], self.data[size:]
+        return data
+
+    @property
+    def in_waiting(self):
+        return len(self.data)
+
+class SetSensorsTest(unittest.TestCase):
+
+    def test_old_layout_frames(self):
+        loop = EventLoop(Roomba(None, serial_port = SwitchingStreamPort()))
+        loop.set_sensors(sensors.WALL, sensors.LEFT_ENCODER)
+        changes = []
+        loop.on_change('left_encoder', lambda robot, name, value: changes.append(value))
+        loop.start_sampling()
+        loop.process_events()
+        loop.set_sensors(sensors.WALL)
+        for i in range(5):
+            loop.process_events()
+        self.assertEqual(changes, [1])
+        self.assertFalse('left_encoder' in loop._previous)
+
+class FramesPort(object):
+    """A port handing over a fixed run of frames, and ignoring commands"""
+
+    def __init__(self, *frames):
+        self.data = ''.join(frames)
+
+    def write(self, data):
+        pass
+
+    def read(self, size = 1):
+        data, self.data = self.data[:size], self.data[size:]
+        return data
+
+    @property
+    def in_waiting(self):
+        return len(self.data)
+
+class EdgeHandlersTest(unittest.TestCase):
+
+    def loop(self, *frames):
+        robot = Roomba(None, serial_port = FramesPort(*frames))
+        loop = EventLoop(robot)
+        loop.set_sensors(sensors.WALL, sensors.VOLTAGE, sensors.LEFT_ENCODER)
+        self.changes = []
+        loop.on_change('wall', lambda robot, name, value: self.changes.append((name, value)))
+        loop.on_threshold('voltage', 15000, lambda robot, name, value: self.changes.append((name, value)))
+        loop.start_sampling()
+        self.decoded = 0
+        decode = robot._decode_frame
+        def counting_decode(packet):
+            self.decoded += 1
+            return decode(packet)
+        robot._decode_frame = counting_decode
+        return loop
+
+    def test_changes(self):
+        values = [(0, 16000, 1), (0, 16000, 1), (1, 16000, 2), (1, 14000, 3), (1, 14000, 3), (0, 16000, 3), (0, 16000, 3)]
+        loop = self.loop(*[ frame((sensors.WALL, wall), (sensors.VOLTAGE, voltage), (sensors.LEFT_ENCODER, encoder)) for wall, voltage, encoder in values ])
+        for i in range(len(values)):
+            loop.process_events()
+        self.assertEqual(self.changes, [('wall', 0), ('wall', 1), ('voltage', 14000), ('wall', 0), ('voltage', 16000)])
+        self.assertEqual(self.decoded, 4) # Identical frames are never decoded
+        self.assertEqual(loop.latest, {'wall': 0, 'voltage': 16000, 'left_encoder': 3})
+
+    def test_identical_frames_with_other_handlers(self):
+        loop = self.loop(*[ frame((sensors.WALL, 1), (sensors.VOLTAGE, 16000), (sensors.LEFT_ENCODER, 7)) ] * 3)
+        samples = []
+        loop.on('left_encoder', lambda robot, name, value: samples.append(value))
+        for i in range(3):
+            loop.process_events()
+        self.assertEqual(samples, [7, 7, 7])
+        self.assertEqual(self.changes, [('wall', 1)])
+
+    def test_new_handler_sees_identical_frame(self):
+        body = frame((sensors.WALL, 1), (sensors.VOLTAGE, 16000), (sensors.LEFT_ENCODER, 7))
+        loop = self.loop(body, body)
+        loop.process_events()
+        loop.on_change('left_encoder', lambda robot, name, value: self.changes.append((name, value)))
+        loop.process_events()
+        self.assertEqual(self.changes, [('wall', 1), ('left_encoder', 7)])
+
+if __name__ == '__main__':
+    unittest.main()
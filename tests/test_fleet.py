@@ -0,0 +1,93 @@
+"""Tests for Fleet, over pipes:
+
+    python -m unittest discover tests
+"""
+
+import fcntl
+import os
+import select
+import sys
+import termios
+import unittest
+from struct import pack
+from struct import unpack
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyroomba import Fleet
+from pyroomba import Roomba
+from pyroomba import sensors
+from pyroomba.clock import monotonic
+
+def frame(body):
+    data = '\x13' + chr(len(body)) + body
+    return data + chr(-sum(map(ord, data)) & 0xff)
+
+class PipePort(object):
+    """A port reading whatever is written to the other end of a pipe, and ignoring commands"""
+
+    timeout = 0.030
+
+    def __init__(self):
+        self._read, self.other = os.pipe()
+
+    def fileno(self):
+        return self._read
+
+    @property
+    def in_waiting(self):
+        return unpack('i', fcntl.ioctl(self._read, termios.FIONREAD, pack('i', 0)))[0]
+
+    def read(self, size = 1):
+        readable, writable, exceptional = select.select([self._read], [], [], self.timeout)
+        if not readable:
+            return ''
+        return os.read(self._read, size)
+
+    def write(self, data):
+        return len(data)
+
+    def flushInput(self):
+        waiting = self.in_waiting
+        if waiting:
+            os.read(self._read, waiting)
+
+    def close(self):
+        os.close(self._read)
+        os.close(self.other)
+
+class FleetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fleet = Fleet()
+        self.ports = [ PipePort() for i in range(4) ]
+        self.loops = []
+        for port in self.ports:
+            loop = self.fleet.add(Roomba(None, serial_port = port))
+            loop.set_sensors(sensors.WALL)
+            loop.start_sampling()
+            self.loops.append(loop)
+
+    def tearDown(self):
+        self.fleet.close()
+        for port in self.ports:
+            port.close()
+
+    def test_bad_frames(self):
+        good = frame(pack('BB', sensors.WALL.id, 1))
+        corrupt = good[:-1] + chr((ord(good[-1]) + 1) & 0xff)
+        unknown = frame(pack('BB', 250, 1)) # No such packet
+        os.write(self.ports[0].other, good + corrupt + good + unknown + good)
+        self.assertEqual(self.fleet.process_events(0.1), 3)
+        self.assertEqual(self.loops[0].bad_frames, 2)
+        self.assertEqual(self.loops[0].latest, {'wall': 1})
+
+    def test_stop_together(self):
+        start = monotonic()
+        self.fleet.stop()
+        # Each robot falls quiet in 20ms; one after the other would take 80
+        self.assertTrue(monotonic() - start < 0.06)
+        self.assertFalse(any(loop.running for loop in self.loops))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+"""Tests for FrameParser:
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+from struct import pack
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyroomba import ChecksumError
+from pyroomba import FrameParser
+
+def frame(value):
+    """A stream frame carrying a single VOLTAGE (packet 22) reading"""
+    data = '\x13' + pack('>BBH', 3, 22, value)
+    return data + chr(-sum(map(ord, data)) & 0xff)
+
+class TrickleSerial(object):
+    """A port which never has anything waiting, as for a reader caught up with the stream, counting reads"""
+
+    def __init__(self, data):
+        self.data = data
+        self.reads = 0
+
+    def read(self, size = 1):
+        self.reads += 1
+        data, self.data = self.data[:size], self.data[size:]
+        return data
+
+    @property
+    def in_waiting(self):
+        return 0
+
+class FillTest(unittest.TestCase):
+
+    def test_one_read_per_frame(self):
+        port = TrickleSerial(''.join(frame(i) for i in range(10)))
+        parser = FrameParser(port)
+        bodies = []
+        while port.data:
+            parser.fill()
+            body = parser.next_frame()
+            if body is not None:
+                bodies.append(body.tobytes())
+        self.assertEqual(bodies, [ frame(i)[2:-1] for i in range(10) ])
+        self.assertEqual(port.reads, 12) # The first frame takes three, to learn its size
+
+class ResyncTest(unittest.TestCase):
+    """Damaged frames must cost no more than their own bytes"""
+
+    good = ''.join(frame(1000 + i) for i in range(5))
+
+    def parse(self, data):
+        """Feeds data to a parser, returning the frame bodies and the skipped counts of ChecksumErrors, in order"""
+        parser = FrameParser(None)
+        parser.feed(data)
+        results = []
+        while True:
+            try:
+                body = parser.next_frame()
+            except ChecksumError as e:
+                results.append(e.skipped)
+                continue
+            if body is None:
+                return results
+            results.append(body.tobytes())
+
+    def expected(self, skipped):
+        return [skipped] + [ frame(1000 + i)[2:-1] for i in range(5) ]
+
+    def test_corrupt_frame(self):
+        corrupt = frame(2000)
+        corrupt = corrupt[:3] + chr(ord(corrupt[3]) ^ 0x40) + corrupt[4:]
+        self.assertEqual(self.parse(corrupt + self.good), self.expected(len(corrupt)))
+
+    def test_dropped_length(self):
+        damaged = frame(2000)
+        damaged = damaged[0] + damaged[2:] # Now the packet ID reads as a length of 22
+        self.assertEqual(self.parse(damaged + self.good), self.expected(len(damaged)))
+
+    def test_false_start(self):
+        corrupt = frame(2000)[:-1] + '\x00'
+        false_start = '\x13\xff' # Would need 258 bytes, which aren't coming
+        self.assertEqual(self.parse(corrupt + false_start + self.good), self.expected(len(corrupt + false_start)))
+
+    def test_false_frame(self):
+        corrupt = frame(2000)[:-1] + '\x00'
+        false_frame = '\x13\x00\xed\x01' # Passes its checksum, but isn't followed by a magic
+        self.assertEqual(self.parse(corrupt + false_frame + self.good), self.expected(len(corrupt + false_frame)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+"""Regression tests for mode handshakes, run against the emulator:
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+from struct import pack
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyroomba import BatchSink
+from pyroomba import Roomba
+from pyroomba import RoombaClassic
+from pyroomba import StreamModeHandshake
+from pyroomba import VirtualRoomba
+from pyroomba import sensors
+
+class TrailingStreamPort(object):
+    """A port streaming LEFT_ENCODER frames, five at once and three more after the pause command"""
+
+    def __init__(self):
+        self.data = ''
+        self.sent = 0
+
+    def frames(self, count):
+        for i in range(count):
+            body = pack('>BBH', 3, sensors.LEFT_ENCODER.id, self.sent)
+            self.sent += 1
+            data = '\x13' + body
+            self.data += data + chr(-sum(map(ord, data)) & 0xff)
+
+    def write(self, data):
+        if data.startswith('\x94'):
+            self.frames(5)
+        elif data == '\x96\x00':
+            self.frames(3)
+
+    def read(self, size = 1):
+        data, self.data = self.data[:size], self.data[size:]
+        return data
+
+    def flushInput(self):
+        self.data = ''
+
+    @property
+    def in_waiting(self):
+        return len(self.data)
+
+class EncoderSink(BatchSink):
+
+    def __init__(self):
+        super(EncoderSink, self).__init__()
+        self.values = []
+
+    def write_batch(self, frames, timestamps):
+        self.values += [ sensors.LEFT_ENCODER.struct.unpack_from(frame, 3)[0] for frame in frames ]
+
+class SilenceHandshakeTest(unittest.TestCase):
+
+    def test_sinks_keep_frames(self):
+        robot = Roomba(None, serial_port = TrailingStreamPort())
+        sink = EncoderSink()
+        robot.add_sink(sink)
+        robot.stream_samples(sensors.LEFT_ENCODER)
+        for i in range(5):
+            self.assertEqual(robot.poll()['left_encoder'], i) # The sink still holds these
+        robot.pause_stream()
+        robot.remove_sink(sink)
+        self.assertEqual(sink.values, range(8))
+
+class ModeHandshakeTest(unittest.TestCase):
+
+    def test_classic_start(self):
+        robot = RoombaClassic(None, serial_port = VirtualRoomba(realtime = False))
+        self.assertTrue(robot.start().done)
+
+    def test_query_once(self):
+        port = VirtualRoomba(realtime = False)
+        robot = Roomba(None, serial_port = port)
+        robot.start()
+        robot.safe()
+        self.assertEqual(port.mode, Roomba.SAFE)
+
+class StreamModeHandshakeTest(unittest.TestCase):
+    """Changing modes mid-stream mustn't read the port from under the stream"""
+
+    def stream(self, *streamed):
+        robot = Roomba(None, serial_port = VirtualRoomba(realtime = False))
+        robot.start()
+        robot.stream_samples(*streamed)
+        return robot
+
+    def samples(self, robot, count):
+        samples = []
+        for i in range(count):
+            sample = robot.poll()
+            if sample is not None:
+                samples.append(sample)
+        return samples
+
+    def test_confirmed_by_stream(self):
+        robot = self.stream(sensors.WALL, sensors.OI_MODE, sensors.VOLTAGE)
+        self.samples(robot, 10)
+        handshake = robot.safe()
+        self.assertTrue(isinstance(handshake, StreamModeHandshake))
+        self.assertFalse(handshake.ready())
+        self.assertTrue(handshake.confirmed)
+        samples = self.samples(robot, 20)
+        self.assertTrue(handshake.ready())
+        self.assertEqual(len(samples), 20)
+        self.assertEqual(set(sample['voltage'] for sample in samples), set([16000]))
+        self.assertEqual(samples[-1]['oi_mode'], Roomba.SAFE)
+        self.assertEqual(robot._parser.checksum_errors, 0)
+        self.assertEqual(len(robot._sinks), 0)
+
+    def test_sinks_removed(self):
+        robot = self.stream(sensors.WALL, sensors.OI_MODE)
+        for i in range(10):
+            robot.safe() # Callers often ignore the handshake
+            robot.poll()
+        StreamModeHandshake(robot, lambda mode: False, timeout = 0)
+        self.samples(robot, 50)
+        self.assertEqual(len(robot._sinks), 0)
+
+    def test_unconfirmed(self):
+        robot = self.stream(sensors.WALL, sensors.VOLTAGE)
+        self.samples(robot, 10)
+        handshake = robot.full()
+        self.assertTrue(handshake.ready())
+        self.assertFalse(handshake.confirmed)
+        samples = self.samples(robot, 20)
+        self.assertEqual(len(samples), 20)
+        self.assertEqual(robot._parser.checksum_errors, 0)
+
+    def test_after_pause(self):
+        robot = self.stream(sensors.WALL, sensors.VOLTAGE)
+        self.samples(robot, 10)
+        robot.pause_stream()
+        handshake = robot.safe()
+        self.assertFalse(isinstance(handshake, StreamModeHandshake))
+        self.assertTrue(handshake.done)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+"""Tests for Metrics:
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+from threading import Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyroomba import Histogram
+from pyroomba import Metrics
+
+class FrameRateTest(unittest.TestCase):
+
+    def test_rate_by_second(self):
+        timer = Metrics().frame_timer
+        for i in range(67): # 15ms apart, from t = 100
+            timer.write_frame(None, 100 + i * 0.015)
+        self.assertEqual(timer.rate(100.5), 0.0) # No whole second yet
+        self.assertEqual(timer.rate(101.0), 67.0)
+        self.assertEqual(timer.rate(101.9), 67.0) # However often it's read
+        self.assertEqual(timer.rate(103.0), 0.0) # The stream stopped
+        timer.write_frame(None, 101.2)
+        self.assertEqual(timer.rate(101.5), 67.0)
+
+    def test_snapshots_agree(self):
+        metrics = Metrics()
+        self.assertEqual(metrics.snapshot()['frames_per_second'], metrics.snapshot()['frames_per_second'])
+
+class JitterTest(unittest.TestCase):
+
+    def test_batched_frames(self):
+        metrics = Metrics()
+        timer = metrics.frame_timer
+        for read in range(10):
+            for i in range(3): # Three frames a read, every 45ms
+                timer.write_frame(None, 100 + read * 0.045)
+        self.assertEqual(metrics.jitter.count, 9)
+        self.assertAlmostEqual(metrics.jitter.max, 0.030, 9)
+
+    def test_zero_mean(self):
+        histogram = Histogram()
+        histogram.record(0.0)
+        self.assertEqual(histogram.summary()['mean'], 0.0)
+
+class HandlerTimingTest(unittest.TestCase):
+
+    def test_threads(self):
+        metrics = Metrics()
+        handlers = [ type('handler_%d' % i, (object,), {})() for i in range(20) ]
+        def work():
+            for i in range(500):
+                metrics.time_handler(handlers[i % len(handlers)], 0.001)
+                metrics.snapshot()
+        threads = [ Thread(target = work) for i in range(4) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sum(summary['count'] for summary in metrics.snapshot()['handlers'].values()), 2000)
+
+if __name__ == '__main__':
+    unittest.main()
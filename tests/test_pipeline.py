@@ -0,0 +1,124 @@
+"""Regression tests for QueryPipeline, run against the emulator:
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+from struct import unpack
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyroomba import QueryPipeline
+from pyroomba import Roomba
+from pyroomba import Tracer
+from pyroomba import VirtualRoomba
+from pyroomba import sensors
+
+class QueryRecorder(Tracer):
+
+    def __init__(self):
+        self.queries = []
+
+    def before_query(self, robot, packet_ids, timestamp):
+        self.queries.append(('before', packet_ids))
+
+    def after_query(self, robot, packet_ids, size, timestamp):
+        self.queries.append(('after', packet_ids, size))
+
+class TracedPipelineTest(unittest.TestCase):
+    """Pipelined queries must show up in traces like blocking ones"""
+
+    def setUp(self):
+        self.robot = Roomba(None, serial_port = VirtualRoomba(realtime = False))
+        self.robot.start()
+        self.tracer = QueryRecorder()
+        self.robot.add_tracer(self.tracer)
+        self.pipeline = QueryPipeline(self.robot)
+
+    def test_answered(self):
+        self.pipeline.sensors(sensors.VOLTAGE)
+        self.pipeline.query_list(sensors.WALL, sensors.TEMPERATURE)
+        self.assertEqual(self.pipeline.read()['voltage'], 16000)
+        self.assertTrue('wall' in self.pipeline.read())
+        self.assertEqual(self.tracer.queries, [
+            ('before', (22,)),
+            ('before', (8, 24)),
+            ('after', (22,), 2),
+            ('after', (8, 24), 2)])
+
+    def test_abandoned(self):
+        self.pipeline.sensors(sensors.Sensor(33, 'B', 'unused')) # Never answered
+        self.assertEqual(self.pipeline.read(), None)
+        self.assertEqual(self.pipeline.lost, 1)
+        self.assertEqual(self.tracer.queries, [
+            ('before', (33,)),
+            ('after', (33,), 0)])
+
+    def test_blocking_query_times_out(self):
+        robot = Roomba(None, serial_port = VirtualRoomba(realtime = False)) # Not started, so never answers
+        robot.add_tracer(self.tracer)
+        self.assertEqual(robot.sensors(sensors.VOLTAGE), '')
+        self.assertEqual(self.tracer.queries, [
+            ('before', (22,)),
+            ('after', (22,), 0)])
+
+class BabblingPort(object):
+    """A port that always has more noise waiting, as a streaming robot's does, but only ever hands over a byte at a time"""
+
+    in_waiting = 8
+
+    def read(self, size = 1):
+        return '\x00'
+
+    def write(self, data):
+        return len(data)
+
+    def flushInput(self):
+        pass
+
+class AbandonTest(unittest.TestCase):
+
+    def test_drain_ends(self):
+        robot = Roomba(None, serial_port = BabblingPort())
+        tracer = QueryRecorder()
+        robot.add_tracer(tracer)
+        pipeline = QueryPipeline(robot)
+        pipeline.sensors(sensors.VOLTAGE)
+        self.assertEqual(pipeline.read(), None)
+        self.assertEqual(pipeline.lost, 1)
+        self.assertEqual(tracer.queries[-1], ('after', (22,), 1))
+
+class RunTest(unittest.TestCase):
+
+    def run_for(self, robot, ticks):
+        seen = []
+        def idle():
+            seen.append(robot.latest)
+            if len(seen) == ticks:
+                robot.stop()
+        robot.run(idle_func = idle)
+        return seen
+
+    def test_settles_pipeline(self):
+        robot = Roomba(None, serial_port = VirtualRoomba(realtime = False))
+        robot.start()
+        seen = self.run_for(robot, 5)
+        self.assertEqual(seen[-1]['voltage'], 16000)
+        self.assertEqual(unpack('>H', robot.sensors(sensors.VOLTAGE))[0], 16000)
+
+    def test_synchronous_by_default(self):
+        robot = Roomba(None, serial_port = VirtualRoomba(realtime = False))
+        robot.start()
+        tracer = QueryRecorder()
+        robot.add_tracer(tracer)
+        self.run_for(robot, 5)
+        self.assertEqual([ query[0] for query in tracer.queries ], ['before', 'after'] * 5)
+
+    def test_latest_before_response(self):
+        robot = Roomba(None, serial_port = VirtualRoomba(realtime = False)) # Not started, so never answers
+        self.assertEqual(self.run_for(robot, 1), [{}])
+
+if __name__ == '__main__':
+    unittest.main()
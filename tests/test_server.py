@@ -0,0 +1,131 @@
+"""Tests for TelemetryServer, over a real socket:
+
+    python -m unittest discover tests
+"""
+
+import os
+import socket
+import sys
+import unittest
+from struct import pack
+from time import sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyroomba import Roomba
+from pyroomba import TelemetryServer
+from pyroomba import DeltaDecoder
+from pyroomba import VirtualRoomba
+
+class WritesPort(object):
+    """A port recording every write, with nothing to read"""
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+        return len(data)
+
+    def read(self, size = 1):
+        return ''
+
+class ServerTestCase(unittest.TestCase):
+
+    queue_size = 64
+
+    def port(self):
+        return VirtualRoomba(realtime = False)
+
+    def setUp(self):
+        self.server = TelemetryServer(Roomba(None, serial_port = self.port()), ('127.0.0.1', 0), self.queue_size)
+        self.server.start()
+        self.client = socket.create_connection(self.server.address)
+        self.client.settimeout(1.0)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def replies(self, commands, count):
+        self.client.sendall(commands)
+        received = ''
+        while received.count('\n') < count:
+            data = self.client.recv(4096)
+            if not data:
+                break
+            received += data
+        return received.splitlines()
+
+class BadArgumentsTest(ServerTestCase):
+    """Commands with bad arguments get an error reply, rather than dropping the client"""
+
+    def test_bad_arguments(self):
+        replies = self.replies('rate abc\nrate\nbinary x\ndrive_direct a\nrate 10\nsensor x\nbogus\n', 5)
+        self.assertEqual(len(replies), 5)
+        for reply in replies:
+            self.assertTrue(reply.startswith('error: '), reply)
+        self.assertEqual(replies[-1], 'error: unknown command bogus')
+        self.assertEqual(self.server.clients(), 1)
+
+class RepliesTest(ServerTestCase):
+
+    queue_size = 4
+
+    def test_replies_kept(self):
+        replies = self.replies('bogus\n' * 50, 50)
+        self.assertEqual(replies, ['error: unknown command bogus'] * 50)
+
+class QuitTest(ServerTestCase):
+
+    def test_quit(self):
+        self.client.sendall('quit\nstop\nbogus\n')
+        self.assertEqual(self.client.recv(4096), '') # No replies after quitting
+        self.assertEqual(len(self.server._commands), 0)
+
+class StopTest(ServerTestCase):
+
+    def port(self):
+        self.writes = WritesPort()
+        return self.writes
+
+    def test_stop_not_buffered(self):
+        robot = self.server.robot
+        robot.buffer_commands()
+        robot.drive_direct(100, 100) # Held until the next flush
+        self.client.sendall('stop\n')
+        for i in range(100):
+            self.server.execute()
+            if self.writes.writes:
+                break
+            sleep(0.01)
+        self.assertEqual(self.writes.writes, [pack('>BhH', 137, 0, 0x8000)])
+        robot.flush_commands()
+        self.assertEqual(len(self.writes.writes), 1) # The held drive was superseded
+
+class BinaryTest(ServerTestCase):
+
+    def receive(self, decoder):
+        """Publishes samples until the client receives a message"""
+        self.client.settimeout(0.01)
+        for i in range(100):
+            self.server.publish({'voltage': 16000}) # Runs the commands the server has read
+            try:
+                messages = decoder.feed(self.client.recv(4096))
+            except socket.timeout:
+                continue
+            if messages:
+                return messages
+        return []
+
+    def test_switch_on_publish(self):
+        decoder = DeltaDecoder()
+        self.client.sendall('binary\n')
+        sleep(0.05)
+        self.assertTrue(all(client.encoder is None for client in self.server._clients)) # Not until the robot's thread publishes
+        self.assertEqual(self.receive(decoder)[0][0], 'schema')
+        self.client.sendall('monitor voltage\n')
+        self.assertEqual(self.receive(decoder), [('sample', {'voltage': 16000})])
+
+if __name__ == '__main__':
+    unittest.main()
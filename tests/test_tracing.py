@@ -0,0 +1,70 @@
+"""Tests for the Tracer hooks, run against the emulator:
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyroomba import EventLoop
+from pyroomba import Roomba
+from pyroomba import Tracer
+from pyroomba import VirtualRoomba
+from pyroomba import sensors
+
+class CallTracer(Tracer):
+    """Records the frame and handler hooks in the order they are called"""
+
+    def __init__(self):
+        self.calls = []
+
+    def before_frame(self, robot, packet_ids, size, timestamp):
+        self.calls.append(('before_frame', packet_ids, size))
+
+    def after_frame(self, robot, timestamp):
+        self.calls.append(('after_frame',))
+
+    def before_handler(self, handler, sensor_name, timestamp):
+        self.calls.append(('before_handler', sensor_name))
+
+    def after_handler(self, handler, sensor_name, timestamp):
+        self.calls.append(('after_handler', sensor_name))
+
+class FrameHooksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.robot = Roomba(None, serial_port = VirtualRoomba(seed = 1, realtime = False))
+        self.robot.start()
+        self.tracer = CallTracer()
+
+    def test_poll(self):
+        self.robot.add_tracer(self.tracer)
+        self.robot.stream_samples(sensors.WALL, sensors.VOLTAGE)
+        for i in range(3):
+            self.assertNotEqual(self.robot.poll(), None)
+        frame = ('before_frame', (sensors.WALL.id, sensors.VOLTAGE.id), 3 + 2 + 1 + 2) # Header, ids, values and checksum
+        self.assertEqual(self.tracer.calls, [frame, ('after_frame',)] * 3)
+
+    def test_event_loop(self):
+        loop = EventLoop(self.robot)
+        loop.set_sensors(sensors.WALL)
+        loop.on('wall', lambda robot, name, value: None)
+        loop.add_tracer(self.tracer)
+        loop.start_sampling()
+        for i in range(3):
+            loop.process_events()
+        # The span covers the handlers as well as decoding
+        calls = [ call[0] for call in self.tracer.calls ]
+        self.assertEqual(calls, ['before_frame', 'before_handler', 'after_handler', 'after_frame'] * 3)
+
+        loop.remove_tracer(self.tracer)
+        self.robot.add_tracer(self.tracer)
+        del self.tracer.calls[:]
+        loop.process_events()
+        self.assertEqual([ call[0] for call in self.tracer.calls ], ['before_frame', 'after_frame'])
+
+if __name__ == '__main__':
+    unittest.main()
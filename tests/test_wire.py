@@ -0,0 +1,61 @@
+"""Tests for DeltaEncoder and DeltaDecoder:
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyroomba import DeltaDecoder
+from pyroomba import DeltaEncoder
+
+NAMES = ['distance', 'angle', 'voltage', 'wall', 'left_encoder']
+
+class RoundTripTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        samples = []
+        for i in range(20):
+            samples.append({
+                'distance': (-1) ** i * (i + 1), # Changes sign every time
+                'angle': i < 10 and -i or i, # Negative, then positive
+                'voltage': 16000, # Never changes
+                'wall': i // 7, # Changes now and then
+                'left_encoder': (65530 + i * 3) & 0xffff, # Rolls over
+            })
+        encoder = DeltaEncoder(keyframe_interval = 6)
+        decoder = DeltaDecoder()
+        stream = encoder.schema()
+        kinds = []
+        for sample in samples:
+            data = encoder.encode(sample, NAMES)
+            kinds.append(data[0])
+            stream += data
+        self.assertEqual(kinds.count('K'), 4) # Every sixth message
+        messages = decoder.feed(stream[:7]) + decoder.feed(stream[7:]) # Split mid-message
+        self.assertEqual(messages[0][0], 'schema')
+        self.assertEqual(len(messages), len(samples) + 1)
+        values = {}
+        for (kind, body), sample in zip(messages[1:], samples):
+            self.assertEqual(kind, 'sample')
+            values.update(body)
+            self.assertEqual(values, sample)
+        self.assertEqual(decoder.values, samples[-1])
+        self.assertEqual(decoder.gaps, 0)
+
+    def test_unchanged_not_sent(self):
+        encoder = DeltaEncoder()
+        sample = {'voltage': 16000, 'wall': 1}
+        self.assertNotEqual(encoder.encode(sample, NAMES), None) # Keyframe
+        self.assertEqual(encoder.encode(sample, NAMES), None)
+        decoder = DeltaDecoder()
+        decoder.feed(encoder.schema())
+        encoder.keyframe()
+        kind, body = decoder.feed(encoder.encode(sample, NAMES))[0]
+        self.assertEqual(body, sample)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+"""Tests for HandlerPool's overflow policies:
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+from threading import Event
+from threading import Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyroomba import HandlerPool
+
+class OverflowTest(unittest.TestCase):
+    """A handler subscribed to two sensors, one changing far more often than the other, falls behind"""
+
+    def setUp(self):
+        self.started = Event()
+        self.gate = Event()
+        self.calls = []
+
+    def handler(self, robot, name, value):
+        self.started.set()
+        self.gate.wait()
+        self.calls.append((name, value))
+
+    def pool(self, policy, queue_size = 4):
+        """Returns a pool whose only worker is held up by the handler until the gate opens"""
+        pool = HandlerPool(1, queue_size, policy)
+        self.addCleanup(pool.close)
+        self.addCleanup(self.gate.set)
+        pool.submit(self.handler, (None, 'wall', 0))
+        self.started.wait(1.0)
+        return pool
+
+    def flood(self, pool):
+        pool.submit(self.handler, (None, 'angle', 1))
+        for value in range(10):
+            pool.submit(self.handler, (None, 'distance', value))
+        self.gate.set()
+        pool.join()
+
+    def test_coalesce(self):
+        pool = self.pool('coalesce')
+        self.flood(pool)
+        self.assertEqual(self.calls, [('wall', 0), ('angle', 1), ('distance', 9)])
+        self.assertEqual(pool.stats()['coalesced'], 9)
+
+    def test_drop_oldest(self):
+        pool = self.pool('drop-oldest')
+        self.flood(pool)
+        self.assertEqual(self.calls, [('wall', 0), ('angle', 1), ('distance', 7), ('distance', 8), ('distance', 9)])
+        self.assertEqual(pool.stats()['dropped'], 7)
+
+    def test_block(self):
+        pool = self.pool('block', queue_size = 2)
+        submitter = Thread(target = lambda: [ pool.submit(self.handler, (None, 'distance', value)) for value in range(5) ])
+        submitter.start()
+        submitter.join(0.1)
+        self.assertTrue(submitter.is_alive()) # Waiting for room
+        self.assertEqual(pool.depth(), 2)
+        self.gate.set()
+        submitter.join(1.0)
+        self.assertFalse(submitter.is_alive())
+        pool.join()
+        self.assertEqual(self.calls, [('wall', 0)] + [ ('distance', value) for value in range(5) ])
+        self.assertEqual(pool.stats()['dropped'] + pool.stats()['coalesced'], 0)
+
+if __name__ == '__main__':
+    unittest.main()